@@ -7,8 +7,10 @@ import json
 import csv
 import glob
 import copy
+import collections
+import pandas as pd
 from cStringIO import StringIO
-from scilifelab.utils.misc import filtered_walk
+from scilifelab.utils.fileindex import indexed_walk
 from scilifelab.log import minimal_logger
 
 LOG = minimal_logger(__name__)
@@ -19,16 +21,30 @@ LOG = minimal_logger(__name__)
 ## FIX ME: make generic flowcell object, that then Illumina, MiSeq,
 ## SOLiD subclass from
 
-## FIX ME: the representation of flowcells and samples is still
-## cumbersome. One solution would be to use DataFrame from pandas. For
-## casava structure, grouping/collection of files should be done on a
-## sample-level basis, making the flowcell object slightly obsolete in
-## these cases.
+## Lane files, as in 1_120829_AA001AAAXX_nophix.bc_metrics and 1_120829_AA001AAAXX_nophix_1_fastq.txt
+re_lane_file = re.compile('^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?\.(filter|bc)_metrics|^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?_[12]_fastq.txt')
+## Sample files, as in 1_120829_AA001AAAXX_nophix_10.bam
+re_sample_file = re.compile('^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?_([0-9]+|unmatched).*')
+## Pipeline output, collected but currently not classified
+re_pipeline_file = re.compile('^[0-1][0-9].*\.txt|^bcbb_software_versions\.txt')
+re_casava_fastq = re.compile('fastq(\.gz)?$')
+
+## Classification of a file: lane, sample key (lane_sequence; None
+## for lane files), and group, one of 'lane_files', 'files' and
+## 'results'
+FileClassification = collections.namedtuple("FileClassification", ["path", "lane", "key", "group"])
+
+## FIX ME: for casava structure, grouping/collection of files should
+## be done on a sample-level basis, making the flowcell object slightly
+## obsolete in these cases.
 
 class Flowcell(object):
     """Class for handling (Illumina) run information.
 
-    Run information is stored as a table."""
+    Run information is stored as a table of columns, with indexes of
+    the rows of each sample key, lane and name. Subsets share the
+    columns of the flowcell they are taken from, so that entries set in
+    a subset are also set in the flowcell, and vice versa."""
     ## Run information
     fc_name = None
     fc_date = None
@@ -41,13 +57,6 @@ class Flowcell(object):
     ## csv keys
     _csv_keys = ['flowcell_id', 'lane', 'name', 'genome_build', 'sequence', 'sample_prj', 'control', 'recipe', 'operator', 'sample_prj']
 
-    ## sample keys
-    samples = dict()
-    ## lane files
-    lane_files = dict()
-    ## results
-    results = list()
-    
     # keys to be printed for yaml output
     _out_yaml_keys = dict(lane= ['lane', 'lane_description', 'flowcell_id', 'lane_analysis', 'genome_build'],
                      mp = ['mp_analysis', 'barcode_id', 'barcode_type', 'sample_prj', 'name', 'sequence', 'files', 'genomes_filter_out', 'mp_description'])
@@ -57,13 +66,42 @@ class Flowcell(object):
     def __init__(self, infile=None):
         self.filename = None
         self.path = None
-        self.data = None
-        self.i = 0
+        ## Columns, shared with subsets, and the rows of the flowcell
+        self._columns = None
+        self._rows = []
+        ## sample keys, lanes and names to rows
+        self.samples = dict()
+        self._lane_rows = dict()
+        self._name_rows = dict()
+        ## lane files
+        self.lane_files = dict()
+        ## results
+        self.results = list()
+        self._classifier = None
         if not infile:
             return
         self.data = self._read(infile)
         self._set_sample_dict()
 
+    @property
+    def data(self):
+        """Run information as a list of rows"""
+        if self._columns is None:
+            return None
+        return [self._row_values(r) for r in self._rows]
+
+    @data.setter
+    def data(self, rows):
+        if rows is None:
+            self._columns = None
+            self._rows = []
+            return
+        self._columns = dict((k, [row[i] for row in rows]) for i, k in enumerate(self.keys))
+        self._rows = range(0, len(rows))
+
+    def _row_values(self, r):
+        return [self._columns[k][r] for k in self.keys]
+
     def fc_id(self):
         m = re.search("([0-9]+)_[A-Za-z0-9]+_[A-Za-z0-9]+_([A-Z0-9]+)", os.path.dirname(self.filename))
         if m:
@@ -71,15 +109,8 @@ class Flowcell(object):
         return "{}_{}".format(self.fc_date, self.fc_name)
         
     def __iter__(self):
-        return self
-
-    def next(self):
-        if self.i >= len(self.data):
-            self.i = 0
-            raise StopIteration
-        row = self.data[self.i]
-        self.i = self.i + 1 
-        return dict(zip(self.keys, row))
+        for r in self._rows:
+            yield dict((k, self._columns[k][r]) for k in self.keys)
 
     def __repr__(self):
         return "Flowcell(filename={})".format(self.filename)
@@ -98,9 +129,7 @@ class Flowcell(object):
         return fh.getvalue()
 
     def __len__(self):
-        if not self.data:
-            return 0
-        return len(self.data)
+        return len(self._rows)
 
     def _read(self, infile):
         """Read infile. Pass to correct read wrapper."""
@@ -133,6 +162,7 @@ class Flowcell(object):
                 d['results'] = None
                 newrow = [d[k] for k in self.keys]
                 out.append(newrow)
+                self.lane_files.setdefault(d['lane'], [])
         self.filename = os.path.abspath(infile)
         return out
         
@@ -149,13 +179,19 @@ class Flowcell(object):
         return self._tab_to_yaml()
 
     def _set_sample_dict(self):
-        i = 0
+        """Index the rows by sample key, lane and name"""
         self.samples = {}
-        for row in self.data:
-            d = dict(zip(self.keys, row))
-            key = "{}_{}".format(d['lane'], d['sequence'])
-            self.samples[key] = i
-            i += 1
+        self._lane_rows = {}
+        self._name_rows = {}
+        self._classifier = None
+        if self._columns is None:
+            return
+        for r in self._rows:
+            lane = self._columns['lane'][r]
+            key = "{}_{}".format(lane, self._columns['sequence'][r])
+            self.samples[key] = r
+            self._lane_rows.setdefault(lane, []).append(r)
+            self._name_rows.setdefault(self._columns['name'][r], []).append(r)
             
     def _yaml_to_tab(self, runinfo_yaml):
         """Convert yaml to internal representation"""
@@ -207,25 +243,44 @@ class Flowcell(object):
         return yaml.dump(yaml_out_final)
     
     def get_sample(self, key):
-        return self.data[self.samples[key]]
+        return self._row_values(self.samples[key])
 
     def get_entry(self, key, label):
-        return self.data[self.samples[key]][self.keys.index(label)]
+        return self._columns[label][self.samples[key]]
 
     def set_entry(self, key, label, value):
-        self.data[self.samples[key]][self.keys.index(label)] = value
+        self._columns[label][self.samples[key]] = value
 
     def append_to_entry(self, key, label, value):
-        if not self.data[self.samples[key]][self.keys.index(label)]:
-            self.data[self.samples[key]][self.keys.index(label)] = []
-        self.data[self.samples[key]][self.keys.index(label)].append(value)
-                
-    def _column(self, label):
-        i = self.keys.index(label)
-        return [row[i] for row in self.data if not row[i] is None]
+        r = self.samples[key]
+        if not self._columns[label][r]:
+            self._columns[label][r] = []
+        self._columns[label][r].append(value)
+
+    def _column(self, label, rows=None):
+        col = self._columns[label]
+        return [col[r] for r in (self._rows if rows is None else rows) if not col[r] is None]
 
     def _row(self, i):
-        return self.data[i]
+        return self._row_values(self._rows[i])
+
+    def name_key(self, name):
+        """Get the sample key of the first row of a sample name
+
+        :param name: sample name
+
+        :returns: key, or None if there is no such sample
+        """
+        rows = self._name_rows.get(name, None)
+        if not rows:
+            return None
+        return "{}_{}".format(self._columns['lane'][rows[0]], self._columns['sequence'][rows[0]])
+
+    def to_dataframe(self):
+        """Get the run information as a pandas DataFrame, with one row per sample run and the columns of Flowcell.keys"""
+        if self._columns is None:
+            return pd.DataFrame(columns=self.keys)
+        return pd.DataFrame(dict((k, [self._columns[k][r] for r in self._rows]) for k in self.keys), columns=self.keys)
 
     def projects(self):
         """List flowcell projects"""
@@ -237,18 +292,15 @@ class Flowcell(object):
 
     def barcodes(self, lane):
         """List barcodes for a lane"""
-        fc = self.subset("lane", lane)
-        return list(fc._column("barcode_id"))
+        return self._column("barcode_id", self._lane_rows.get(lane, []))
 
     def names(self, lane):
         """List names for a lane"""
-        fc = self.subset("lane", lane)
-        return list(fc._column("name"))
+        return self._column("name", self._lane_rows.get(lane, []))
 
     def barcode_sequences(self, lane):
         """List barcode sequences for a lane"""
-        fc = self.subset("lane", lane)
-        return list(fc._column("sequence"))
+        return self._column("sequence", self._lane_rows.get(lane, []))
 
     def barcode_id_to_name(self, lane):
         """Map barcode id to name"""
@@ -274,23 +326,27 @@ class Flowcell(object):
         """Transform flowcell to one with unique lane numbers"""
         new_fc = copy.deepcopy(self)
         new_fc.filename = self.filename.replace(".yaml", "-unique-lane.yaml")
-        lane_index = new_fc.keys.index("lane")
         lane = 1
-        for j in range(0, len(new_fc.data)):
-            new_fc.data[j][lane_index] = str(lane)
+        for r in new_fc._rows:
+            new_fc._columns['lane'][r] = str(lane)
             lane = lane + 1
         new_fc.unique_lanes = True
+        new_fc._set_sample_dict()
         return new_fc
             
     def subset(self, column, query):
         """Subset runinfo. Returns new flowcell object."""
         pruned_fc = Flowcell()
-        vals = list(self._column(column))
-        i = [j for j in range(0, len(vals)) if vals[j]==query]
-        pruned_fc.data = [self.data[j] for j in i]
+        pruned_fc._columns = self._columns
+        if column == "lane":
+            pruned_fc._rows = list(self._lane_rows.get(query, []))
+        elif column == "name":
+            pruned_fc._rows = list(self._name_rows.get(query, []))
+        elif self._columns is not None:
+            pruned_fc._rows = [r for r in self._rows if self._columns[column][r] == query]
         pruned_fc.filename = self.filename.replace(".yaml", "-pruned.yaml")
         pruned_fc._set_sample_dict()
-        pruned_fc.lane_files = dict((x, self.lane_files[x]) for x in pruned_fc.lanes())
+        pruned_fc.lane_files = dict((x, self.lane_files.setdefault(x, [])) for x in pruned_fc.lanes())
         pruned_fc.fc_date = self.fc_date
         pruned_fc.fc_name = self.fc_name
         return pruned_fc
@@ -367,55 +423,39 @@ class Flowcell(object):
     # P003_101_index6_CGTTAA_L004_R2_001.fastq
     # 09_realign_sample.txt
     # P003_101_index6-bcbb-command.txt
-    def classify_file(self, f):
-        """Classify file by lane and sample. Generate unique keys from
+    def classifier(self):
+        """Get the file classifier of the flowcell, built once per
+        run information"""
+        if self._classifier is None:
+            self._classifier = FileClassifier(self)
+        return self._classifier
+
+    def classify_files(self, files):
+        """Classify files by lane and sample. Generate unique keys from
         lane and barcode sequence. Updates flowcell object during file
         classification.
 
+        :param files: list of file names
+
+        :returns: list of FileClassification
+        """
+        classified = self.classifier().classify(files)
+        for c in classified:
+            if c.group == "lane_files":
+                self.lane_files.setdefault(c.lane, []).append(c.path)
+            else:
+                LOG.debug("Adding file {} to {}, key {}".format(c.path, c.group, c.key))
+                self.append_to_entry(c.key, c.group, c.path)
+        return classified
+
+    def classify_file(self, f):
+        """Classify file by lane and sample, see classify_files.
+
         :param f: file name
         
         :returns: None
         """
-        re_lane = re.compile('^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?\.(filter|bc)_metrics|^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?_[12]_fastq.txt')
-        m_lane = re_lane.search(os.path.basename(f))
-        if m_lane:
-            lane = os.path.basename(f).split("_")[0]
-            sample = None
-            self.lane_files[lane].append(os.path.abspath(f))
-            return
-        re_sample = re.compile('^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?_([0-9]+|unmatched).*')
-        m_sample = re_sample.search(os.path.basename(f))
-        if m_sample:
-            lane = m_sample.group(1)
-            sample = m_sample.group(3)
-            if sample == "unmatched":
-                self.lane_files[lane].append(os.path.abspath(f))
-                return
-            sequence = self.barcode_id_to_sequence(lane).get(int(sample), None)
-            key = "{}_{}".format(lane, sequence)
-            if f.find("fastq.txt") > 0:
-                self.append_to_entry(key, "files", os.path.abspath(f))
-                return
-            else:
-                self.append_to_entry(key, "results", os.path.abspath(f))
-                return
-
-        names = self._column("name")
-        pattern = "|".join("^({}).*".format(x) for x in names)
-        re_casava_sample = re.compile(pattern)
-        m_casava_sample = re_casava_sample.search(os.path.basename(f))
-        if m_casava_sample:
-            row = self._row(names.index(m_casava_sample.group(1)))
-            key = "{}_{}".format(row[0], row[10])
-            if re.search("fastq(\.gz)?$", f):
-                LOG.debug("Adding sequence file {} to files, key {}".format(f, key))
-                self.append_to_entry(key, "files", os.path.abspath(f))
-                return
-            else:
-                LOG.debug("Adding file {} to results, key {}".format(f, key))
-                self.append_to_entry(key, "results", os.path.abspath(f))
-                return
-        return
+        self.classify_files([f])
 
     def collect_files(self, path, project=None):
         """Collect files for a given project.
@@ -426,13 +466,90 @@ class Flowcell(object):
             fc = self.subset("sample_prj", project)
         else:
             fc = self
-        pattern = "|".join(fc.glob_pfx_str())
-        def file_filter(f):
-            if not pattern:
-                return
-            return re.search(pattern, f) != None
-        flist = filtered_walk(path, file_filter)
-        for f in flist:
-            self.classify_file(f)
+        flist = indexed_walk(path, fc.classifier().collect)
+        self.classify_files(flist)
         fc.path = path
         return fc
+
+class FileClassifier(object):
+    """Classifier of the files of a flowcell, built once from the run
+    information, see Flowcell.classify_files. Sample file prefixes are
+    matched with one regular expression per lane, flowcell and barcode id
+    prefix, and casava sample names are looked up by prefix in a dict
+    instead of being matched with an alternation over all samples.
+
+    :param fc: Flowcell
+    """
+    def __init__(self, fc):
+        ## Patterns of glob_pfx_str, without duplicates. The trailing
+        ## character of the barcode id is optional in these, and is
+        ## dropped so that samples of a lane share patterns
+        patterns = []
+        for sample in fc:
+            pattern = "{}_[0-9]+_.?{}(?:_nophix)?_{}".format(sample['lane'], sample['flowcell_id'], str(sample['barcode_id'])[:-1])
+            if not pattern in patterns:
+                patterns.append(pattern)
+        self.re_prefix = re.compile("|".join(patterns)) if patterns else None
+        ## Casava sample names; the key of a name is that of the first row in which it occurs
+        self.names = {}
+        for name in set(fc._column("name")) if len(fc) else []:
+            self.names[name] = fc.name_key(name)
+        self.name_lengths = sorted(set(len(x) for x in self.names), reverse=True)
+        self.sequences = {}
+        self.fc = fc
+
+    def _barcode_id_to_sequence(self, lane):
+        if not lane in self.sequences:
+            self.sequences[lane] = self.fc.barcode_id_to_sequence(lane)
+        return self.sequences[lane]
+
+    def name_prefixes(self, f):
+        """Get the casava sample names that prefix a file name, longest first"""
+        return [f[0:n] for n in self.name_lengths if f[0:n] in self.names]
+
+    def collect(self, f):
+        """Check if a file name belongs to the flowcell, see Flowcell.glob_pfx_str
+
+        :param f: file name
+
+        :returns: boolean
+        """
+        if self.re_prefix is not None and self.re_prefix.search(f):
+            return True
+        for name in self.name_prefixes(f):
+            if f[len(name):len(name) + 1] in ("_", "-"):
+                return True
+        return re_pipeline_file.search(f) != None
+
+    def classify(self, files):
+        """Classify files by lane and sample
+
+        :param files: list of file names
+
+        :returns: list of FileClassification, in the order of files
+        """
+        classified = []
+        for f in files:
+            c = self._classify(f)
+            if not c is None:
+                classified.append(c)
+        return classified
+
+    def _classify(self, f):
+        fn = os.path.basename(f)
+        if re_lane_file.search(fn):
+            return FileClassification(os.path.abspath(f), fn.split("_")[0], None, "lane_files")
+        m_sample = re_sample_file.search(fn)
+        if m_sample:
+            lane = m_sample.group(1)
+            sample = m_sample.group(3)
+            if sample == "unmatched":
+                return FileClassification(os.path.abspath(f), lane, None, "lane_files")
+            sequence = self._barcode_id_to_sequence(lane).get(int(sample), None)
+            key = "{}_{}".format(lane, sequence)
+            return FileClassification(os.path.abspath(f), lane, key, "files" if f.find("fastq.txt") > 0 else "results")
+        prefixes = self.name_prefixes(fn)
+        if prefixes:
+            key = self.names[prefixes[0]]
+            return FileClassification(os.path.abspath(f), key.split("_")[0], key, "files" if re_casava_fastq.search(f) else "results")
+        return None
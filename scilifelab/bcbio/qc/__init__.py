@@ -13,6 +13,7 @@ import xml.etree.cElementTree as ET
 from bs4 import BeautifulSoup
 
 from cement.core import backend
+from scilifelab.utils.fileindex import indexed_walk
 LOG = backend.minimal_logger("bcbio")
 
 from bcbio.broad.metrics import PicardMetricsParser
@@ -433,11 +434,7 @@ class RunMetricsParser(dict):
             return
         if not os.path.exists(self.path):
             raise IOError
-        self.files = []
-        for root, dirs, files in os.walk(self.path):
-            if re.search(self.reignore, root):
-                continue
-            self.files = self.files + [os.path.join(root, x) for x in files]
+        self.files = indexed_walk(self.path, exclude_dirs=[self.ignore])
 
     def filter_files(self, pattern, filter_fn=None):
         """Take file list and return those files that pass the filter_fn criterium"""
@@ -447,22 +444,91 @@ class RunMetricsParser(dict):
             filter_fn = filter_function
         return filter(filter_fn, self.files)
 
+class MetricsFileIndex(object):
+    """Index of the metrics files of a sample run directory, or of a
+    flowcell directory holding several sample runs. The files are
+    classified once, with one combined regular expression, into
+    buckets keyed on (lane, barcode_id, metric), so that looking up
+    the files of a sample run is a dict access.
+
+    Metrics are 'picard', 'fastq_screen', 'fastqc', 'filter' and 'bc'.
+    bc metrics are per lane, and have barcode_id None, as have filter
+    metrics of a lane, e.g. 1_120829_AA001AAAXX_nophix.filter_metrics.
+
+    :param files: list of file names
+    """
+    _lane = "(?:^|/)(?P<{0}_lane>[0-9]+)_[0-9]+_[0-9A-Za-z]+"
+    ## nophix is not a barcode id
+    _barcode = "(?:_nophix)?_(?P<{0}_barcode_id>(?!nophix(?![0-9A-Za-z]))[0-9A-Za-z]+)(?:_nophix)?"
+    classifier = re.compile("|".join([
+        (_lane + _barcode + "-[^/]*\.(?:align|hs|insert|dup)_metrics$").format("picard"),
+        (_lane + _barcode + "_[12]_screen\.txt$").format("fastq_screen"),
+        ("fastqc" + _lane + _barcode + "[^/]*/fastqc_data\.txt$").format("fastqc"),
+        (_lane + _barcode + "\.filter_metrics$").format("filter"),
+        (_lane + "(?:_nophix)?\.filter_metrics$").format("lane_filter"),
+        (_lane + "(?:_nophix)?[\\._]bc[\\._]metrics$").format("bc"),
+        ## Other files that the sample run metrics depend on
+        "(?P<other>[\\._]metrics$|_screen\.txt$|fastqc/.*fastqc_data\.txt$|-bcbb-config\.yaml$)",
+        ]))
+    metrics = ["picard", "fastq_screen", "fastqc", "filter", "bc"]
+    ## Classifier groups, as (group, metric, per barcode id)
+    _groups = [("picard", "picard", True), ("fastq_screen", "fastq_screen", True), ("fastqc", "fastqc", True),
+               ("filter", "filter", True), ("lane_filter", "filter", False), ("bc", "bc", False)]
+
+    def __init__(self, files):
+        self.files = files
+        self.buckets = collections.defaultdict(list)
+        self.metrics_files = []
+        for f in files:
+            m = self.classifier.search(f)
+            if m is None:
+                continue
+            self.metrics_files.append(f)
+            if m.group("other"):
+                continue
+            for group, metric, per_barcode in self._groups:
+                lane = m.group("{}_lane".format(group))
+                if lane is not None:
+                    barcode_id = m.group("{}_barcode_id".format(group)) if per_barcode else None
+                    self.buckets[(lane, barcode_id, metric)].append(f)
+                    break
+
+    def get(self, lane, barcode_id, metric):
+        """Get the files of a metric for a sample run
+
+        :param lane: lane
+        :param barcode_id: barcode id; None for bc metrics
+        :param metric: metric, one of MetricsFileIndex.metrics
+
+        :returns: list of file names, in walk order
+        """
+        return self.buckets.get((str(lane), None if barcode_id is None else str(barcode_id), metric), [])
+
 class SampleRunMetricsParser(RunMetricsParser):
-    """Sample-level class for parsing run metrics data"""
+    """Sample-level class for parsing run metrics data.
 
+    The directory is walked and its files classified once per parser,
+    so parse all sample runs of a directory with the same parser.
+
+    :param path: sample run directory
+    """
     def __init__(self, path):
         RunMetricsParser.__init__(self)
         self.path = path
         self._collect_files()
-        
+        self.index = MetricsFileIndex(self.files)
+
+    def metrics_files(self):
+        """Return the metrics files that the sample run metrics are parsed from"""
+        return self.index.metrics_files
+
+
     def read_picard_metrics(self, barcode_name, sample_prj, lane, flowcell, barcode_id, **kw):
         self.log.debug("read_picard_metrics for sample {}, project {}, lane {} in run {}".format(barcode_name, sample_prj, lane, flowcell))
         picard_parser = ExtendedPicardMetricsParser()
-        pattern = "|".join(["{}_[0-9]+_[0-9A-Za-z]+(_nophix)?_{}-.*.(align|hs|insert|dup)_metrics".format(lane, barcode_id),
-                            "{}_[0-9]+_[0-9A-Za-z]+_{}(_nophix)?-.*.(align|hs|insert|dup)_metrics".format(lane, barcode_id)])
-        files = self.filter_files(pattern)
+        files = self.index.get(lane, barcode_id, "picard")
         if len(files) == 0:
-            self.log.warn("no picard metrics files for sample {}; pattern {}".format(barcode_name, pattern))
+            self.log.warn("no picard metrics files for sample {}, lane {}, barcode id {}".format(barcode_name, lane, barcode_id))
             return {}
         try:
             self.log.debug("files {}".format(",".join(files)))
@@ -475,9 +541,7 @@ class SampleRunMetricsParser(RunMetricsParser):
     def parse_fastq_screen(self, barcode_name, sample_prj, lane, flowcell, barcode_id, **kw):
         self.log.debug("parse_fastq_screen for sample {}, project {}, lane {} in run {}".format(barcode_name, sample_prj, lane, flowcell))
         parser = MetricsParser()
-        pattern = "|".join(["{}_[0-9]+_[0-9A-Za-z]+(_nophix)?_{}_[12]_screen.txt".format(lane, barcode_id),
-                            "{}_[0-9]+_[0-9A-Za-z]+_{}(_nophix)?_[12]_screen.txt".format(lane, barcode_id)])
-        files = self.filter_files(pattern)
+        files = self.index.get(lane, barcode_id, "fastq_screen")
         self.log.debug("files {}".format(",".join(files)))
         try:
             fp = open(files[0])
@@ -492,8 +556,7 @@ class SampleRunMetricsParser(RunMetricsParser):
         self.log.debug("read_fastqc_metrics for sample {}, project {}, lane {} in run {}".format(barcode_name, sample_prj, lane, flowcell))
         if barcode_name == "unmatched":
             return
-        pattern = "fastqc/{}_[0-9]+_[0-9A-Za-z]+(_nophix)?_{}-*".format(lane, barcode_id)
-        files = self.filter_files(pattern)
+        files = self.index.get(lane, barcode_id, "fastqc")
         self.log.debug("files {}".format(",".join(files)))
         try:
             fastqc_dir = os.path.dirname(files[0])
@@ -502,14 +565,13 @@ class SampleRunMetricsParser(RunMetricsParser):
             return {'stats':stats}
         except Exception as e:
             self.log.warn("Exception: {}".format(e))
-            self.log.warn("no fastqc metrics for sample {} using pattern '{}'".format(barcode_name, pattern))
+            self.log.warn("no fastqc metrics for sample {}, lane {}, barcode id {}".format(barcode_name, lane, barcode_id))
             return {'stats':{}}
 
-    def parse_filter_metrics(self, **kw):
+    def parse_filter_metrics(self, lane, barcode_id, sample_prj=None, flowcell=None, **kw):
         """CASAVA: Parse filter metrics at sample level"""
         self.log.debug("parse_filter_metrics for lane {}, project {} in flowcell {}".format(lane, sample_prj, flowcell))
-        pattern = "{}_[0-9]+_[0-9A-Za-z]+_{}(_nophix)?.filter_metrics".format(lane, barcode_id)
-        files = self.filter_files(pattern)
+        files = self.index.get(lane, barcode_id, "filter")
         self.log.debug("files {}".format(",".join(files)))
         try:
             fp = open(files[0])
@@ -531,10 +593,9 @@ class SampleRunMetricsParser(RunMetricsParser):
             if sample_lane in demux_stats_dict:
                 self.log.debug("sample {}, lane {} found in demultiplex_stats - using this information".format(barcode_name, lane))
                 return int(demux_stats_dict[sample_lane]["# Reads"].replace(",", ""))/2
-        pattern = "{}_[0-9]+_[0-9A-Za-z]+(_nophix)?[\._]bc[\._]metrics".format(lane)
-        files = self.filter_files(pattern)
+        files = self.index.get(lane, None, "bc")
         if len(files) == 0:
-            self.log.debug("no bc metrics files for sample {}, lane {}; pattern {}".format(barcode_name, lane, pattern))
+            self.log.debug("no bc metrics files for sample {}, lane {}".format(barcode_name, lane))
             return None
         self.log.debug("files {}".format(",".join(files)))
         try:
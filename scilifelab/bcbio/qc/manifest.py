@@ -0,0 +1,165 @@
+"""Manifest of the metrics files parsed and the qc documents uploaded
+for the sample runs of a flowcell. Used to parse and upload only the
+sample runs whose metrics have changed since the last upload."""
+import os
+import json
+import hashlib
+import threading
+
+from scilifelab.db.statusdb import content_hash
+from scilifelab.log import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+MANIFEST_VERSION = 1
+MANIFEST_FILE = "qc_manifest.json"
+# Directory of the manifests, one per flowcell, unless the runqc
+# manifest_dir is configured. Flowcell directories may be read-only.
+DEFAULT_MANIFEST_DIR = os.path.join(os.path.expanduser("~"), ".pm", "qc_manifest")
+
+def file_sha1(path, blocksize=1 << 20):
+    """Compute the sha1 hex digest of the content of a file"""
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(blocksize), ""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+class QCManifest(object):
+    """Manifest of the metrics files of a flowcell and the qc documents
+    derived from them. For each file, the size, mtime and content hash
+    are stored, so that only files whose size or mtime have changed
+    are hashed again. For each qc document, keyed on name, the hash of
+    its input files and the content hash of the last uploaded document
+    are stored.
+
+    Changes are staged while parsing and committed per document once
+    the document has been saved, so that failed uploads are retried on
+    the next run. Sample runs may be checked from several threads, as
+    long as each document is checked by one thread.
+
+    :param path: manifest file name
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.documents = {}
+        self._staged = {}
+        self.hashed = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self.load()
+
+    def __repr__(self):
+        return "<{} {}>".format(self.__class__.__name__, self.path)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as fh:
+                data = json.load(fh)
+        except ValueError as e:
+            LOG.warn("Could not read qc manifest {}: {}; starting a new manifest".format(self.path, e))
+            return
+        if data.get("version", None) != MANIFEST_VERSION:
+            LOG.info("qc manifest {} has version {}; starting a new manifest".format(self.path, data.get("version", None)))
+            return
+        self.files = data.get("files", {})
+        self.documents = data.get("documents", {})
+
+    def save(self):
+        """Write the manifest, replacing the previous file atomically.
+        A manifest that can not be written is only warned about, as the
+        documents have been uploaded regardless.
+
+        :returns: True if the manifest was written
+        """
+        tmp = "{}.tmp".format(self.path)
+        try:
+            if not os.path.exists(os.path.dirname(os.path.abspath(self.path))):
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)))
+            with open(tmp, "w") as fh:
+                json.dump({"version":MANIFEST_VERSION, "files":self.files, "documents":self.documents}, fh, sort_keys=True)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            LOG.warn("Could not write qc manifest {}: {}; all sample runs will be checked again on the next upload".format(self.path, e))
+            return False
+        return True
+
+    def file_hash(self, path):
+        """Get the content hash of a file, from the manifest if the size
+        and mtime of the file have not changed
+
+        :param path: file name
+
+        :returns: hex digest
+        """
+        st = os.stat(path)
+        entry = self.files.get(path, None)
+        if entry is not None and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+            return entry["sha1"]
+        with self._lock:
+            self.hashed += 1
+        self.files[path] = {"size":st.st_size, "mtime":st.st_mtime, "sha1":file_sha1(path)}
+        return self.files[path]["sha1"]
+
+    def input_hash(self, files, extra=None):
+        """Hash the content of a set of input files
+
+        :param files: list of file names
+        :param extra: additional json serializable input, e.g. demultiplex stats
+
+        :returns: hex digest
+        """
+        sha1 = hashlib.sha1()
+        for f in sorted(files):
+            sha1.update("{}\t{}\n".format(f, self.file_hash(f)))
+        if extra is not None:
+            sha1.update(json.dumps(extra, sort_keys=True, default=str))
+        return sha1.hexdigest()
+
+    def known(self, name):
+        """Check if a document has been uploaded"""
+        return name in self.documents
+
+    def inputs_changed(self, name, files, extra=None):
+        """Check if the input files of a document have changed since the
+        last upload, staging the new input hash if so
+
+        :param name: document name
+        :param files: list of input file names
+        :param extra: additional input, see input_hash
+
+        :returns: boolean
+        """
+        inputs = self.input_hash(files, extra)
+        if self.documents.get(name, {}).get("inputs", None) == inputs:
+            with self._lock:
+                self.skipped += 1
+            return False
+        self._staged.setdefault(name, {})["inputs"] = inputs
+        return True
+
+    def document_changed(self, doc):
+        """Check if the content of a document has changed since the last
+        upload, staging the new content hash if so
+
+        :param doc: document
+
+        :returns: boolean
+        """
+        digest = content_hash(doc)
+        if self.documents.get(doc["name"], {}).get("content", None) == digest:
+            self.skipped += 1
+            return False
+        self._staged.setdefault(doc["name"], {})["content"] = digest
+        return True
+
+    def commit(self, name):
+        """Record the staged hashes of a document after a successful upload"""
+        self.documents.setdefault(name, {}).update(self._staged.pop(name, {}))
+
+    def summary(self):
+        return "{} documents in manifest, {} skipped as unchanged, {} files hashed".format(len(self.documents), self.skipped, self.hashed)
@@ -8,6 +8,7 @@ import pandas as pd
 import datetime
 
 from scilifelab.utils.misc import filtered_walk, query_yes_no, prune_option_list
+from scilifelab.utils.fileindex import indexed_walk
 from scilifelab.utils.dry import dry_write, dry_backup, dry_unlink, dry_rmdir, dry_makedir
 from scilifelab.log import minimal_logger
 from scilifelab.bcbio import sort_sample_config_fastq, update_sample_config, update_pp_platform_args, merge_sample_config
@@ -227,13 +228,13 @@ def find_samples(path, sample=None, pattern = "-bcbb-config.yaml$", only_failed=
             if len(flist) == 0:
                 flist = [os.path.join(path, x.rstrip()) for x in samplelist if len(x) > 1]
                 # Make sure there actually is a config file in path
-                flist = list(chain.from_iterable([filtered_walk(x, bcbb_yaml_filter, exclude_dirs=kw.get("exclude_dirs", None), include_dirs=kw.get("include_dirs", None)) for x in flist]))
+                flist = list(chain.from_iterable([indexed_walk(x, bcbb_yaml_filter, exclude_dirs=kw.get("exclude_dirs", None), include_dirs=kw.get("include_dirs", None)) for x in flist]))
             if len(flist) == 0:
                 return flist
         else:
             pattern = "{}{}".format(sample, pattern)
     if not flist:
-        flist = filtered_walk(path, bcbb_yaml_filter, exclude_dirs=kw.get("exclude_dirs", None), include_dirs=kw.get("include_dirs", None))
+        flist = indexed_walk(path, bcbb_yaml_filter, exclude_dirs=kw.get("exclude_dirs", None), include_dirs=kw.get("include_dirs", None))
     if only_failed:
         status = {x:_sample_status(x) for x in flist}
         flist = [x for x in flist if _sample_status(x)=="FAIL"]
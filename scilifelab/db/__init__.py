@@ -1,10 +1,12 @@
 """Database module"""
 import os
 import sys
+import collections
 import couchdb
 
 from scilifelab.log import minimal_logger
-from scilifelab.utils.http import check_url
+from scilifelab.db.connection import get_server, is_available, DEFAULT_TIMEOUT, DEFAULT_RETRIES
+from scilifelab.db.cache import get_cache
 
 class ConnectionError(Exception):
     """Exception raised for connection errors.
@@ -20,6 +22,151 @@ class ConnectionError(Exception):
     def __str__(self):
         return self.msg
 
+# Keyword arguments of the Couch connections that set connection and caching options
+DB_OPTIONS = ["db_timeout", "db_retries", "db_cache_dir", "no_db_cache", "db_mirror", "db_mirror_writes"]
+
+def db_options(kw):
+    """Return the connection and caching options in a dict of keyword
+    arguments, e.g. the parsed arguments of a pm command, to be passed on
+    to Couch connections
+
+    :param kw: dict of keyword arguments
+    """
+    return {k:kw[k] for k in DB_OPTIONS if kw.get(k, None) is not None}
+
+# Default number of view rows cached per view
+DEFAULT_VIEW_CACHE_SIZE = 10000
+
+# Marker for keys that are cached as missing from a view
+_MISSING = object()
+
+def get_docs(db, ids):
+    """Fetch several documents with one _all_docs request
+
+    :param db: couch database
+    :param ids: list of document ids
+
+    :returns: dict mapping the ids of existing documents to the documents
+    """
+    if len(ids) == 0:
+        return {}
+    return {row.id:row.doc for row in db.view("_all_docs", keys=list(ids), include_docs=True) if row.doc}
+
+class ViewProxy(object):
+    """Lazy, read-only dict-like access to a couchdb view, keyed on the
+    view key. Rows are fetched on demand with key/keys queries and the
+    values are kept in a size-bounded LRU cache, so that looking up a
+    few names does not require downloading the entire view. Iterating
+    over the proxy streams the complete view.
+
+    :param db: couchdb database
+    :param viewname: view name, e.g. names/name
+    :param value: function mapping a view row to the value of the key. Defaults to the row itself
+    :param cache_size: maximum number of keys cached
+    """
+
+    def __init__(self, db, viewname, value=None, cache_size=DEFAULT_VIEW_CACHE_SIZE):
+        self.db = db
+        self.viewname = viewname
+        self._value = value or (lambda row: row)
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self.queries = 0
+
+    def __repr__(self):
+        return "<{} {}>".format(self.__class__.__name__, self.viewname)
+
+    def _query(self, **kw):
+        self.queries += 1
+        return self.db.view(self.viewname, reduce=False, **kw)
+
+    def _cache_put(self, key, value):
+        self._cache.pop(key, None)
+        self._cache[key] = value
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _cache_get(self, key):
+        value = self._cache.pop(key)
+        self._cache[key] = value
+        return value
+
+    def _fetch(self, keys):
+        """Query the view for the keys that are not cached. Duplicate keys
+        resolve to the last row, as in a dict built from the view.
+        """
+        keys = [k for k in keys if k not in self._cache]
+        if len(keys) == 0:
+            return
+        found = {}
+        rows = self._query(key=keys[0]) if len(keys) == 1 else self._query(keys=keys)
+        for row in rows:
+            found[row.key] = self._value(row)
+        for k in keys:
+            self._cache_put(k, found.get(k, _MISSING))
+
+    def prefetch(self, keys):
+        """Fetch the values of a list of keys in one query
+
+        :param keys: list of view keys
+        """
+        self._fetch(list(keys))
+
+    def get(self, key, default=None):
+        if key not in self._cache:
+            self._fetch([key])
+        value = self._cache_get(key)
+        return default if value is _MISSING else value
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    has_key = __contains__
+
+    def iteritems(self, startkey=None, endkey=None):
+        """Iterate over the (key, value) pairs of the view, optionally
+        restricted to the keys from startkey to endkey (inclusive)
+        """
+        kw = {}
+        if startkey is not None:
+            kw["startkey"] = startkey
+        if endkey is not None:
+            kw["endkey"] = endkey
+        for row in self._query(**kw):
+            yield row.key, self._value(row)
+
+    def iterkeys(self, startkey=None, endkey=None):
+        return (k for k, v in self.iteritems(startkey, endkey))
+
+    def itervalues(self, startkey=None, endkey=None):
+        return (v for k, v in self.iteritems(startkey, endkey))
+
+    def items(self, startkey=None, endkey=None):
+        return list(self.iteritems(startkey, endkey))
+
+    def keys(self, startkey=None, endkey=None):
+        return list(self.iterkeys(startkey, endkey))
+
+    def values(self, startkey=None, endkey=None):
+        return list(self.itervalues(startkey, endkey))
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def __len__(self):
+        return self._query(limit=0).total_rows
+
+    def clear_cache(self):
+        """Drop all cached values, e.g. after the database has been updated
+        """
+        self._cache.clear()
+
 class Database(object):
     """Main database connection object for noSQL databases"""
 
@@ -41,6 +188,9 @@ class Database(object):
 class Couch(Database):
     _doc_type = None
     _update_fn = None
+    _update_many_fn = None
+    _use_doc_cache = False
+    _doc_cache_dir = None
 
     def __init__(self, log=None, url="localhost", **kwargs):
         self.db = None
@@ -49,6 +199,10 @@ class Couch(Database):
         self.user = kwargs.get("username", None)
         self.pw = kwargs.get("password", None)
         self.url_string = "http://{}:{}".format(self.url, self.port)
+        self.view_cache_size = kwargs.get("view_cache_size", DEFAULT_VIEW_CACHE_SIZE)
+        self.mirror = kwargs.get("db_mirror", None)
+        self._use_doc_cache = not kwargs.get("no_db_cache", False) and not self.mirror
+        self._doc_cache_dir = kwargs.get("db_cache_dir", None)
         if log:
             self.log = log
         super(Couch, self).__init__(**kwargs)        
@@ -56,13 +210,23 @@ class Couch(Database):
             raise ConnectionError("Connection failed for url {}".format(self.url_string))
 
     def connect(self, username=None, password=None, url="localhost", port=5984, **kw):
+        if kw.get("db_mirror", None):
+            # Imported here since the mirror depends on the statusdb views
+            from scilifelab.db.mirror import Mirror
+            self.con = Mirror(kw["db_mirror"], writable=kw.get("db_mirror_writes", False))
+            self.log.debug("Using database mirror @{}".format(kw["db_mirror"]))
+            return
         if not username or not password or not url:
             self.log.warn("please supply username, password, and url")
             return None
-        if not check_url(self.url_string):
+        timeout = kw.get("db_timeout", None)
+        retries = kw.get("db_retries", None)
+        server = get_server(self.url_string, timeout=DEFAULT_TIMEOUT if timeout is None else float(timeout),
+                            retries=DEFAULT_RETRIES if retries is None else int(retries))
+        if not is_available(server):
             self.log.warn("No such url {}".format(self.url_string))
             return None
-        self.con = couchdb.Server(url=self.url_string)
+        self.con = server
         self.log.debug("Connected to server @{}".format(self.url_string))
         self.user = username
         self.pw = password
@@ -77,6 +241,59 @@ class Couch(Database):
         except:
             return None
 
+    def view_proxy(self, viewname, value=None):
+        """Return a lazy dict-like proxy for a view of the database
+
+        :param viewname: view name
+        :param value: function mapping a view row to the value of the key
+        """
+        return ViewProxy(self.db, viewname, value, self.view_cache_size)
+
+    @property
+    def doc_cache(self):
+        """The shared document cache of the database, or None if caching is disabled"""
+        if not self._use_doc_cache or self.db is None:
+            return None
+        return get_cache(self.db, self._doc_cache_dir)
+
+    def get_doc(self, dbid):
+        """Get a document by id, through the document cache if enabled
+
+        :param dbid: document id
+
+        :returns: the document, or None if it does not exist
+        """
+        cache = self.doc_cache
+        if cache is None:
+            return self.db.get(dbid)
+        return cache.get(dbid)
+
+    def _invalidate(self, dbid):
+        cache = self.doc_cache
+        if cache is not None:
+            cache.invalidate(dbid)
+
+    def install_views(self, views):
+        """Create the views that are missing from the design documents of
+        the database. Existing views are left untouched.
+
+        :param views: dict mapping design document names to dicts of view names and map functions, as in statusdb.VIEWS
+        """
+        for design, functions in views.items():
+            doc_id = "_design/{}".format(design)
+            try:
+                doc = self.db.get(doc_id, None) or {"_id": doc_id, "language": "javascript"}
+                doc.setdefault("views", {})
+                missing = [name for name in functions.keys() if name not in doc["views"]]
+                if len(missing) == 0:
+                    continue
+                for name in missing:
+                    doc["views"][name] = {"map": functions[name]}
+                self.db.save(doc)
+                self.log.info("Installed views {} in design document {}".format(", ".join(missing), doc_id))
+            except (couchdb.HTTPError, couchdb.ServerError) as e:
+                self.log.warn("Could not install views in design document {}: {}".format(doc_id, e))
+
     def get_entry(self, name, field=None):
         """Retrieve entry from db for a given name, subset to field if
         that value is passed.
@@ -87,15 +304,75 @@ class Couch(Database):
         if not self._doc_type:
             return
         self.log.debug("retrieving field entry in field '{}' for name '{}'".format(field, name))
-        if self.name_view.get(name, None) is None:
+        dbid = self.name_view.get(name, None)
+        if dbid is None:
             self.log.warn("no field '{}' for name '{}'".format(field, name))
             return None
-        doc = self._doc_type(**self.db.get(self.name_view.get(name)))
+        doc = self._doc_type(**self.get_doc(dbid))
         if field:
             return doc[field]
         else:
             return doc
 
+    def get_entries(self, names):
+        """Retrieve the entries of several names, looking up the ids with
+        one view query and fetching the documents with one _all_docs request
+
+        :param names: list of unique name identifiers
+
+        :returns: dict mapping each name to its document, or None if missing
+        """
+        if not self._doc_type:
+            return
+        names = list(names)
+        self.log.debug("retrieving entries for {} names".format(len(names)))
+        self.name_view.prefetch(names)
+        dbids = {name:self.name_view.get(name, None) for name in names}
+        ids = set([x for x in dbids.values() if x is not None])
+        cache = self.doc_cache
+        docs = get_docs(self.db, ids) if cache is None else cache.get_many(ids)
+        entries = {}
+        for name, dbid in dbids.items():
+            if docs.get(dbid, None) is None:
+                self.log.warn("no entry for name '{}'".format(name))
+                entries[name] = None
+            else:
+                entries[name] = self._doc_type(**docs[dbid])
+        return entries
+
+    def save_many(self, objs, **kwargs):
+        """Save/update several database objects with one bulk request.
+        As for save, if <update_many_fn> is defined, objects are only
+        written if they have been modified.
+
+        :param objs: list, or other iterable, of database objects to save
+
+        :returns: dict mapping the id of each object to 'saved', 'unchanged' or the error of a failed write, e.g. a conflict
+        """
+        objs = list(objs)
+        status = {}
+        if not self._update_many_fn:
+            new_objs = objs
+        else:
+            new_objs = []
+            for obj, (new_obj, dbid) in zip(objs, self._update_many_fn(self.db, objs, **kwargs)):
+                if new_obj is None:
+                    self.log.info("Object {} with id '{}' present and not in need of updating".format(repr(obj), dbid.id))
+                    status[dbid.id] = "unchanged"
+                else:
+                    new_objs.append(new_obj)
+        if len(new_objs) == 0:
+            return status
+        for obj, (success, dbid, res) in zip(new_objs, self.db.update(new_objs)):
+            if success:
+                self.log.info("Saving object {} with id '{}'".format(repr(obj), dbid))
+                status[dbid] = "saved"
+                self._invalidate(dbid)
+            else:
+                self.log.warn("Failed to save object {} with id '{}': {}".format(repr(obj), dbid, res))
+                status[dbid] = res
+        return status
+
     def save(self, obj, **kwargs):
         """Save/update database object <obj>. If <obj> already exists
         and <update_fn> is defined, update will only take place if
@@ -105,12 +382,14 @@ class Couch(Database):
         """
         if not self._update_fn:
             self.db.save(obj)
+            self._invalidate(obj["_id"])
             self.log.info("Saving object {} with id {}".format(repr(obj), obj["_id"]))
         else:
             (new_obj, dbid) = self._update_fn(self.db, obj, **kwargs)
             if not new_obj is None:
                 self.log.info("Saving object {} with id '{}'".format(repr(new_obj), new_obj["_id"]))
                 self.db.save(new_obj)
+                self._invalidate(new_obj["_id"])
             else:
                 self.log.info("Object {} with id '{}' present and not in need of updating".format(repr(obj), dbid.id))
 
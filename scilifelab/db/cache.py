@@ -0,0 +1,236 @@
+"""Read-through cache of couchdb documents, invalidated by the changes feed"""
+import os
+import re
+import copy
+import json
+import time
+import sqlite3
+import couchdb
+
+from scilifelab.log import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+# Minimum number of seconds between two polls of the changes feed
+DEFAULT_POLL_INTERVAL = 10
+
+# Seconds to wait for another process to release the on-disk cache
+DEFAULT_LOCK_TIMEOUT = 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, rev TEXT, doc TEXT);
+"""
+
+class DocumentCache(object):
+    """Read-through cache of the documents of a database, keyed on the
+    document id. Cached documents are stored with their revision, and
+    the changes feed of the database is polled, at most every
+    poll_interval seconds, for documents whose revision has changed
+    since the last poll. Changed documents are dropped from the cache and
+    fetched again on the next get.
+
+    If path is given, the documents and the last polled update sequence
+    are also stored in a sqlite file on disk, so that later processes only
+    fetch the documents that have changed in between. The file may be
+    shared by concurrent processes, as sqlite locks it on writes.
+
+    :param db: couchdb database
+    :param path: file name of the on-disk cache, or None to cache in memory only
+    :param poll_interval: minimum number of seconds between polls of the changes feed
+    """
+
+    def __init__(self, db, path=None, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.db = db
+        self.path = path
+        self.poll_interval = poll_interval
+        self.hits = 0
+        self.misses = 0
+        self._docs = {}
+        self._seq = None
+        self._polled = None
+        self._store = None
+        if path is not None:
+            self._open(path)
+
+    def __repr__(self):
+        return "<{} {}>".format(self.__class__.__name__, self.path or "in memory")
+
+    def _open(self, path):
+        url = getattr(getattr(self.db, "resource", None), "url", None)
+        try:
+            self._store = sqlite3.connect(path, timeout=DEFAULT_LOCK_TIMEOUT)
+            with self._store:
+                self._store.executescript(_SCHEMA)
+                if self._get_meta("url") != url:
+                    self._store.execute("DELETE FROM docs")
+                    self._store.execute("DELETE FROM meta")
+                    self._set_meta("url", url)
+                self._seq = self._get_meta("seq")
+        except sqlite3.Error as e:
+            LOG.warn("Could not open document cache {}: {}; caching in memory only".format(path, e))
+            self._store = None
+
+    def _get_meta(self, key, default=None):
+        row = self._store.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _set_meta(self, key, value):
+        self._store.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def _put(self, docid, doc):
+        self._put_many({docid:doc})
+
+    def _put_many(self, docs):
+        """Store documents, keyed on id, writing them to disk in one transaction"""
+        for docid, doc in docs.items():
+            self._docs[docid] = (doc["_rev"], doc)
+        if self._store is not None:
+            with self._store:
+                self._store.executemany("INSERT OR REPLACE INTO docs (id, rev, doc) VALUES (?, ?, ?)",
+                                        [(docid, doc["_rev"], json.dumps(doc)) for docid, doc in docs.items()])
+
+    def _lookup(self, docid):
+        entry = self._docs.get(docid, None)
+        if entry is None and self._store is not None:
+            row = self._store.execute("SELECT rev, doc FROM docs WHERE id = ?", (docid,)).fetchone()
+            if row is not None:
+                entry = (row[0], json.loads(row[1]))
+                self._docs[docid] = entry
+        return entry
+
+    def _set_seq(self, seq):
+        self._seq = seq
+        if self._store is not None:
+            with self._store:
+                self._set_meta("seq", seq)
+
+    def poll(self, force=False):
+        """Drop the documents that have changed since the last poll. The
+        changes feed is read at most every poll_interval seconds, unless
+        force is set.
+
+        :param force: poll regardless of the time of the last poll
+
+        :returns: the number of documents dropped from the cache
+        """
+        now = time.time()
+        if not force and self._polled is not None and now - self._polled < self.poll_interval:
+            return 0
+        self._polled = now
+        if self._seq is None:
+            # Nothing is cached yet; changes are counted from the current sequence
+            self._set_seq(self.db.info()["update_seq"])
+            return 0
+        try:
+            changes = self.db.changes(since=self._seq)
+        except (couchdb.HTTPError, couchdb.ServerError) as e:
+            LOG.warn("Could not read the changes feed: {}; clearing the document cache".format(e))
+            self.clear()
+            return 0
+        dropped = 0
+        for change in changes["results"]:
+            entry = self._lookup(change["id"])
+            if entry is None:
+                continue
+            revs = [c["rev"] for c in change.get("changes", [])]
+            if entry[0] not in revs or change.get("deleted", False):
+                self.invalidate(change["id"])
+                dropped += 1
+        self._set_seq(changes["last_seq"])
+        LOG.debug("Polled {} changes; dropped {} cached documents".format(len(changes["results"]), dropped))
+        return dropped
+
+    def get(self, docid, default=None):
+        """Get a document, from the cache if it has not changed
+
+        :param docid: document id
+        :param default: value returned if the document does not exist
+
+        :returns: a copy of the document
+        """
+        self.poll()
+        entry = self._lookup(docid)
+        if entry is None:
+            self.misses += 1
+            doc = self.db.get(docid, None)
+            if doc is None:
+                return default
+            entry = (doc["_rev"], dict(doc))
+            self._put(docid, entry[1])
+        else:
+            self.hits += 1
+        return copy.deepcopy(entry[1])
+
+    def get_many(self, ids):
+        """Get several documents, fetching the uncached documents with one
+        _all_docs request
+
+        :param ids: list of document ids
+
+        :returns: dict mapping the ids of existing documents to copies of the documents
+        """
+        self.poll()
+        docs = {}
+        missing = []
+        for docid in ids:
+            entry = self._lookup(docid)
+            if entry is None:
+                missing.append(docid)
+            else:
+                docs[docid] = entry[1]
+        self.hits += len(docs)
+        self.misses += len(missing)
+        if len(missing) > 0:
+            fetched = {row.id:dict(row.doc) for row in self.db.view("_all_docs", keys=missing, include_docs=True) if row.doc}
+            self._put_many(fetched)
+            docs.update(fetched)
+        return {docid:copy.deepcopy(doc) for docid, doc in docs.items()}
+
+    def invalidate(self, docid):
+        """Drop a document from the cache, e.g. after saving it"""
+        self._docs.pop(docid, None)
+        if self._store is not None:
+            with self._store:
+                self._store.execute("DELETE FROM docs WHERE id = ?", (docid,))
+
+    def clear(self):
+        """Drop all documents from the cache"""
+        self._docs.clear()
+        self._seq = None
+        if self._store is not None:
+            with self._store:
+                self._store.execute("DELETE FROM docs")
+                self._store.execute("DELETE FROM meta WHERE key = ?", ("seq",))
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+# Shared caches, per database url and cache file
+_CACHES = {}
+
+def cache_path(cache_dir, db):
+    """Return the file name of the on-disk cache of a database in cache_dir"""
+    url = db.resource.url
+    return os.path.join(cache_dir, re.sub(r'[^A-Za-z0-9_.-]+', "_", url.split("://")[-1]).strip("_") + ".sqlite")
+
+def get_cache(db, cache_dir=None, poll_interval=DEFAULT_POLL_INTERVAL):
+    """Return the shared document cache of a database
+
+    :param db: couchdb database
+    :param cache_dir: directory of the on-disk caches, or None to cache in memory only
+    :param poll_interval: minimum number of seconds between polls of the changes feed
+
+    :returns: a DocumentCache
+    """
+    path = None
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        path = cache_path(cache_dir, db)
+    key = (db.resource.url, path)
+    if key not in _CACHES:
+        _CACHES[key] = DocumentCache(db, path, poll_interval)
+    return _CACHES[key]
@@ -0,0 +1,183 @@
+"""Shared, pooled connections to couchdb servers"""
+import time
+import socket
+import couchdb
+import couchdb.http
+
+from scilifelab.log import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+# Default socket timeout in seconds
+DEFAULT_TIMEOUT = 120
+# Default number of retries of idempotent requests that failed with a server error
+DEFAULT_RETRIES = 3
+# Delay in seconds before the first retry; doubled for each subsequent retry
+DEFAULT_BACKOFF = 0.5
+# Upper bounds in seconds of the request latency histogram bins
+LATENCY_BINS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, float("inf")]
+# Methods that can be sent again after a server error. PUTs address the
+# document (or database) by id, so a replay cannot create a second copy
+IDEMPOTENT_METHODS = ["GET", "HEAD", "PUT"]
+# Read-only requests that are POSTed because of long key lists
+READ_ONLY_POSTS = ["/_all_docs", "/_view/"]
+
+class ConnectionStats(object):
+    """Counters of the requests made to couchdb servers"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency = [0 for b in LATENCY_BINS]
+
+    def add(self, seconds, sent=0, received=0, error=False):
+        """Record a request
+
+        :param seconds: the time taken by the request
+        :param sent: the number of bytes in the request body
+        :param received: the number of bytes in the response body
+        :param error: the request failed
+        """
+        self.requests += 1
+        self.bytes_sent += sent
+        self.bytes_received += received
+        if error:
+            self.errors += 1
+        for i, bound in enumerate(LATENCY_BINS):
+            if seconds <= bound:
+                self.latency[i] += 1
+                break
+
+    def histogram(self):
+        """Return a list of (upper bound in seconds, number of requests) tuples"""
+        return zip(LATENCY_BINS, self.latency)
+
+    def summary(self):
+        """Return a one-line summary of the counters"""
+        latency = ", ".join(["<={}s: {}".format(b, n) for b, n in self.histogram() if n > 0])
+        return "{} requests ({} retries, {} errors), {} bytes sent, {} bytes received; latency {}".format(
+            self.requests, self.retries, self.errors, self.bytes_sent, self.bytes_received, latency or "n/a")
+
+# Process-wide request counters
+STATS = ConnectionStats()
+
+def _content_length(headers):
+    try:
+        return int(headers.get("Content-Length", headers.get("content-length", 0)) or 0)
+    except (TypeError, ValueError, AttributeError):
+        return 0
+
+class RetryingSession(couchdb.http.Session):
+    """A couchdb session with keep-alive connection pooling (inherited from
+    couchdb.http.Session) that retries idempotent requests failing with a
+    server error, with exponentially increasing delays, and records every
+    request in STATS. Conflicts are not retried, since the same document
+    revision conflicts again, and neither are POSTs that may have created
+    a document before the server failed.
+
+    :param timeout: socket timeout in seconds
+    :param retries: number of retries of idempotent requests failing with 5xx
+    :param backoff: delay in seconds before the first retry
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, stats=STATS):
+        couchdb.http.Session.__init__(self, timeout=timeout,
+                                      retry_delays=[backoff*2**i for i in xrange(retries)])
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = stats
+
+    def _retryable(self, e, method, url):
+        if not method in IDEMPOTENT_METHODS and not (method == "POST" and any(x in url for x in READ_ONLY_POSTS)):
+            return False
+        if isinstance(e, couchdb.http.ServerError):
+            try:
+                return int(e.args[0][0]) >= 500
+            except (IndexError, TypeError, ValueError):
+                return False
+        return False
+
+    def request(self, method, url, body=None, headers=None, credentials=None, num_redirects=0):
+        if headers is None:
+            headers = {}
+        # File-like bodies cannot be sent again
+        retries = self.retries if not hasattr(body, "read") else 0
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                status, msg, data = couchdb.http.Session.request(self, method, url, body, headers, credentials, num_redirects)
+            except (couchdb.HTTPError, socket.error) as e:
+                self.stats.add(time.time() - start, _content_length(headers), error=True)
+                if attempt >= retries or not self._retryable(e, method, url):
+                    raise
+                delay = self.backoff*2**attempt
+                attempt += 1
+                self.stats.retries += 1
+                LOG.debug("{} {} failed ({}); retrying in {} seconds".format(method, url, e, delay))
+                time.sleep(delay)
+                continue
+            self.stats.add(time.time() - start, _content_length(headers), _content_length(msg))
+            return status, msg, data
+
+# Shared sessions and servers, per set of options and per url
+_SESSIONS = {}
+_SERVERS = {}
+
+def get_session(timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+    """Return the shared session for a set of options"""
+    key = (timeout, retries, backoff)
+    if key not in _SESSIONS:
+        _SESSIONS[key] = RetryingSession(timeout, retries, backoff)
+    return _SESSIONS[key]
+
+def get_server(url, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+    """Return the shared couchdb server for a url. The server and its pool of
+    keep-alive connections are created on first use and reused by all
+    connections to the url in the process.
+
+    :param url: server url, e.g. http://localhost:5984
+    :param timeout: socket timeout in seconds
+    :param retries: number of retries of idempotent requests failing with 5xx
+    :param backoff: delay in seconds before the first retry
+
+    :returns: a couchdb.Server
+    """
+    key = (url.rstrip("/"), timeout, retries, backoff)
+    if key not in _SERVERS:
+        _SERVERS[key] = couchdb.Server(url, session=get_session(timeout, retries, backoff))
+    return _SERVERS[key]
+
+def is_available(server):
+    """Check that a server responds, using its pooled connection"""
+    try:
+        server.version()
+        return True
+    except (couchdb.HTTPError, socket.error, IOError) as e:
+        LOG.debug("Server {} not available: {}".format(server.resource.url, e))
+        return False
+
+def save_documents(db, docs):
+    """Save documents with one bulk request. As for db.save, failed
+    writes, e.g. conflicts, raise an error, but only after the other
+    documents have been saved.
+
+    :param db: a couchdb.Database
+    :param docs: list of documents
+
+    :returns: list of the ids of the saved documents
+    """
+    results = db.update(docs)
+    failed = [(dbid, error) for success, dbid, error in results if not success]
+    for dbid, error in failed:
+        LOG.error("Failed to save document with id '{}' in {}: {}".format(dbid, db.name, error))
+    if failed:
+        raise couchdb.HTTPError("{} of {} documents could not be saved in {}: {}".format(
+            len(failed), len(results), db.name, ", ".join("{} ({})".format(dbid, error) for dbid, error in failed)))
+    return [dbid for success, dbid, error in results]
@@ -0,0 +1,329 @@
+"""Local mirrors of the statusdb databases.
+
+A mirror is a directory with one sqlite file per database, holding the
+documents and the rows of the python equivalents of the statusdb views
+(statusdb.PY_VIEWS). MirrorDatabase answers the get and view queries
+used by the statusdb connections, so that the connections can run
+against a mirror with no server (see the db_mirror option of Couch).
+Mirrors are created and updated with sync_statusdb, or pm db sync.
+Documents saved in a mirror are not propagated to the source database,
+so saving fails unless the mirror is opened as writable (the
+db_mirror_writes option of Couch).
+"""
+import os
+import json
+import sqlite3
+import couchdb
+from uuid import uuid4
+from couchdb.client import Row
+
+from scilifelab.db.statusdb import view_functions
+from scilifelab.log import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+# Number of documents fetched per request when syncing
+DEFAULT_BATCH_SIZE = 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, rev TEXT, doc TEXT);
+CREATE TABLE IF NOT EXISTS rows (view TEXT, key TEXT, id TEXT, value TEXT);
+CREATE INDEX IF NOT EXISTS rows_view_key ON rows (view, key);
+CREATE INDEX IF NOT EXISTS rows_id ON rows (id);
+"""
+
+def _encode(key):
+    return json.dumps(key, sort_keys=True)
+
+def _collate(key):
+    """Sort key approximating the couchdb collation of view keys:
+    null < booleans < numbers < strings < arrays < objects
+    """
+    if key is None:
+        return (0,)
+    if isinstance(key, bool):
+        return (1, key)
+    if isinstance(key, (int, long, float)):
+        return (2, key)
+    if isinstance(key, basestring):
+        return (3, key.lower(), key)
+    if isinstance(key, (list, tuple)):
+        return (4, [_collate(k) for k in key])
+    return (5, sorted(key.items()))
+
+class ViewRows(list):
+    """Rows of a mirror view query. As for couchdb view results, total_rows
+    holds the number of rows of the view"""
+    total_rows = 0
+
+class MirrorDatabase(object):
+    """A database in a local mirror
+
+    :param path: the sqlite file
+    :param dbtype: the database type, one of samples, flowcells or projects. Read from the file if not given
+    :param writable: allow documents to be saved in the mirror
+    """
+
+    def __init__(self, path, dbtype=None, writable=False):
+        self.path = path
+        self.writable = writable
+        self.con = sqlite3.connect(path)
+        self.con.executescript(_SCHEMA)
+        if dbtype is None:
+            dbtype = self._get_meta("dbtype")
+        else:
+            self._set_meta("dbtype", dbtype)
+            self.con.commit()
+        self.dbtype = dbtype
+        self.views = view_functions(dbtype) if dbtype else {}
+
+    def __repr__(self):
+        return "<{} {}>".format(self.__class__.__name__, self.path)
+
+    @property
+    def name(self):
+        return os.path.splitext(os.path.basename(self.path))[0]
+
+    def _get_meta(self, key, default=None):
+        row = self.con.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _set_meta(self, key, value):
+        self.con.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    @property
+    def update_seq(self):
+        """The update sequence of the source database at the last full sync"""
+        return self._get_meta("update_seq")
+
+    def info(self):
+        return {"db_name":self.name, "doc_count":len(self), "update_seq":self.update_seq}
+
+    def __len__(self):
+        return self.con.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def __contains__(self, docid):
+        return self.con.execute("SELECT 1 FROM docs WHERE id = ?", (docid,)).fetchone() is not None
+
+    def get(self, docid, default=None):
+        row = self.con.execute("SELECT doc FROM docs WHERE id = ?", (docid,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _put(self, doc):
+        """Store a document and its view rows, replacing any previous version"""
+        self._remove(doc["_id"])
+        self.con.execute("INSERT INTO docs (id, rev, doc) VALUES (?, ?, ?)", (doc["_id"], doc.get("_rev"), json.dumps(doc)))
+        if doc["_id"].startswith("_design/"):
+            return
+        rows = [(view, _encode(k), doc["_id"], json.dumps(v)) for view, fn in self.views.items() for k, v in fn(doc)]
+        self.con.executemany("INSERT INTO rows (view, key, id, value) VALUES (?, ?, ?, ?)", rows)
+
+    def _remove(self, docid):
+        self.con.execute("DELETE FROM docs WHERE id = ?", (docid,))
+        self.con.execute("DELETE FROM rows WHERE id = ?", (docid,))
+
+    def load(self, docs, deleted=[], update_seq=None):
+        """Store documents from the source database in one transaction
+
+        :param docs: list of documents
+        :param deleted: list of ids of deleted documents
+        :param update_seq: the update sequence of the source database, if the mirror is complete up to it
+        """
+        with self.con:
+            for doc in docs:
+                self._put(doc)
+            for docid in deleted:
+                self._remove(docid)
+            if update_seq is not None:
+                self._set_meta("update_seq", update_seq)
+
+    def save(self, doc):
+        """Save a document in the mirror. Changes are not propagated to the source database."""
+        return self.update([doc])[0][1:]
+
+    def update(self, docs):
+        """Save several documents in the mirror, as couchdb.Database.update.
+        Raises couchdb.Forbidden unless the mirror is writable.
+
+        :returns: list of (success, id, rev or exception) tuples
+        """
+        if not self.writable:
+            raise couchdb.Forbidden(("forbidden", "{} is a read-only mirror; documents saved in a mirror are not propagated "
+                                     "to the database. Use db_mirror_writes to save them in the mirror anyway".format(self.path)))
+        LOG.warn("Saving {} documents in the mirror {} only; the changes are not propagated to the database".format(len(docs), self.path))
+        res = []
+        with self.con:
+            for doc in docs:
+                doc.setdefault("_id", uuid4().hex)
+                row = self.con.execute("SELECT rev FROM docs WHERE id = ?", (doc["_id"],)).fetchone()
+                current = row[0] if row else None
+                if current != doc.get("_rev", None):
+                    res.append((False, doc["_id"], couchdb.ResourceConflict("Document update conflict.")))
+                    continue
+                doc["_rev"] = "{}-mirror".format(int((current or "0").split("-")[0]) + 1)
+                self._put(doc)
+                res.append((True, doc["_id"], doc["_rev"]))
+        return res
+
+    def _all_docs(self, key=None, keys=None, include_docs=False):
+        if keys is None and key is not None:
+            keys = [key]
+        if keys is None:
+            found = self.con.execute("SELECT id, rev, doc FROM docs ORDER BY id").fetchall()
+        else:
+            found = []
+            for docid in keys:
+                row = self.con.execute("SELECT id, rev, doc FROM docs WHERE id = ?", (docid,)).fetchone()
+                if row:
+                    found.append(row)
+        return [Row(id=docid, key=docid, value={"rev":rev}, doc=json.loads(doc) if include_docs else None) for docid, rev, doc in found]
+
+    def view(self, name, wrapper=None, key=None, keys=None, startkey=None, endkey=None, limit=None, skip=0,
+             include_docs=False, descending=False, reduce=False, **kw):
+        """Query a view, as couchdb.Database.view. Reduce functions are not supported."""
+        if name == "_all_docs":
+            rows = self._all_docs(key, keys, include_docs)
+        else:
+            if name not in self.views:
+                raise couchdb.ResourceNotFound(("not_found", "missing_named_view {}".format(name)))
+            if keys is None and key is not None:
+                keys = [key]
+            if keys is None:
+                found = self.con.execute("SELECT key, id, value FROM rows WHERE view = ?", (name,)).fetchall()
+            else:
+                found = []
+                for k in keys:
+                    found.extend(self.con.execute("SELECT key, id, value FROM rows WHERE view = ? AND key = ?", (name, _encode(k))).fetchall())
+            rows = [Row(id=docid, key=json.loads(k), value=json.loads(v)) for k, docid, v in found]
+            if keys is None:
+                rows.sort(key=lambda r: (_collate(r.key), r.id))
+            if include_docs:
+                docs = {r.id:r.doc for r in self._all_docs(keys=list(set([r.id for r in rows])), include_docs=True)}
+                for r in rows:
+                    r["doc"] = docs.get(r.id)
+        if startkey is not None:
+            rows = [r for r in rows if _collate(r.key) >= _collate(startkey)]
+        if endkey is not None:
+            rows = [r for r in rows if _collate(r.key) <= _collate(endkey)]
+        if descending:
+            rows.reverse()
+        result = ViewRows(rows[skip:(skip + limit) if limit is not None else None])
+        result.total_rows = self._total_rows(name)
+        if wrapper is not None:
+            result = ViewRows([wrapper(r) for r in result])
+        return result
+
+    def _total_rows(self, name):
+        if name == "_all_docs":
+            return len(self)
+        return self.con.execute("SELECT COUNT(*) FROM rows WHERE view = ?", (name,)).fetchone()[0]
+
+    def close(self):
+        self.con.close()
+
+class Mirror(object):
+    """A directory of mirrored databases, used in place of a couchdb.Server
+
+    :param path: the mirror directory
+    :param writable: allow documents to be saved in the mirrored databases
+    """
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.writable = writable
+
+    def __repr__(self):
+        return "<{} {}>".format(self.__class__.__name__, self.path)
+
+    def _dbfile(self, dbname):
+        return os.path.join(self.path, "{}.sqlite".format(dbname))
+
+    def __contains__(self, dbname):
+        return os.path.exists(self._dbfile(dbname))
+
+    def __getitem__(self, dbname):
+        if not dbname in self:
+            raise couchdb.ResourceNotFound(("not_found", "no mirror of database {} in {}; please run pm db sync".format(dbname, self.path)))
+        return MirrorDatabase(self._dbfile(dbname), writable=self.writable)
+
+    def create(self, dbname, dbtype):
+        """Create or open the mirror of a database
+
+        :param dbname: database name
+        :param dbtype: the database type, one of samples, flowcells or projects
+        """
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        return MirrorDatabase(self._dbfile(dbname), dbtype)
+
+    def version(self):
+        return "mirror"
+
+def _batches(rows, batch_size):
+    for i in xrange(0, len(rows), batch_size):
+        yield rows[i:i + batch_size]
+
+def sync_database(source, target, batch_size=DEFAULT_BATCH_SIZE):
+    """Pull the documents that changed since the last sync from a
+    database into its mirror, reading the changes feed in batches
+
+    :param source: couchdb database
+    :param target: MirrorDatabase
+    :param batch_size: number of changes read per request
+
+    :returns: the number of documents stored or removed
+    """
+    since = target.update_seq or 0
+    n = 0
+    while True:
+        changes = source.changes(since=since, include_docs=True, limit=batch_size)
+        results = changes["results"]
+        if len(results) == 0:
+            break
+        docs = [c["doc"] for c in results if not c.get("deleted", False) and c.get("doc") and not c["id"].startswith("_design/")]
+        deleted = [c["id"] for c in results if c.get("deleted", False)]
+        since = changes["last_seq"]
+        target.load(docs, deleted, since)
+        n += len(docs) + len(deleted)
+        LOG.debug("Synced {} changes of {} up to sequence {}".format(len(results), target.name, since))
+    return n
+
+def _sync_view_docs(source, target, viewname, keys, batch_size=DEFAULT_BATCH_SIZE):
+    """Pull the documents of the rows of keys in a view of the source database"""
+    docs = []
+    for batch in _batches(list(keys), batch_size):
+        docs.extend([row.doc for row in source.view(viewname, keys=batch, include_docs=True, reduce=False) if row.doc])
+    target.load(docs)
+    return docs
+
+def sync_statusdb(server, mirror_dir, dbnames, project_name=None, batch_size=DEFAULT_BATCH_SIZE):
+    """Pull the samples, flowcells and projects databases into a mirror.
+    If project_name is given, only the project summary, the samples of
+    the project and the flowcells they were run on are pulled.
+
+    :param server: couchdb server
+    :param mirror_dir: mirror directory
+    :param dbnames: dict mapping samples, flowcells and projects to the database names
+    :param project_name: project name, as in J.Doe_00_01
+    :param batch_size: number of documents fetched per request
+
+    :returns: dict mapping the database types to the number of documents synced
+    """
+    mirror = Mirror(mirror_dir)
+    targets = {dbtype:mirror.create(dbname, dbtype) for dbtype, dbname in dbnames.items()}
+    sources = {dbtype:server[dbname] for dbtype, dbname in dbnames.items()}
+    counts = {}
+    if project_name is None:
+        for dbtype in dbnames.keys():
+            counts[dbtype] = sync_database(sources[dbtype], targets[dbtype], batch_size)
+        return counts
+    if "projects" in dbnames:
+        counts["projects"] = len(_sync_view_docs(sources["projects"], targets["projects"], "project/project_name", [project_name], batch_size))
+    if "samples" in dbnames:
+        samples = _sync_view_docs(sources["samples"], targets["samples"], "sample_ids/project", [[project_name]], batch_size)
+        counts["samples"] = len(samples)
+        if "flowcells" in dbnames:
+            fc_names = set(["{}_{}".format(s.get("date"), s.get("flowcell")) for s in samples])
+            counts["flowcells"] = len(_sync_view_docs(sources["flowcells"], targets["flowcells"], "names/name", fc_names, batch_size))
+    return counts
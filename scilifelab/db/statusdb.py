@@ -1,8 +1,13 @@
 """Database backend for connecting to statusdb"""
 import re
+import json
+import hashlib
 import collections
+import couchdb
+import numpy as np
+import pandas as pd
 from itertools import izip
-from scilifelab.db import Couch
+from scilifelab.db import Couch, get_docs
 from scilifelab.utils.timestamp import utc_time
 from scilifelab.utils.misc import query_yes_no
 from uuid import uuid4
@@ -10,22 +15,84 @@ from scilifelab.log import minimal_logger
 
 LOG = minimal_logger(__name__)
 
-# Statusdb views essential for pm qc functionality
-# FIXME: import ViewDefinition from couchdb.design and create views if not present
+# Statusdb views essential for pm qc functionality. Missing views are 
+# created when connecting to the database (see Couch.install_views)
 VIEWS = {'samples' : {'names': {'name' : '''function(doc) {if (!doc["name"].match(/_[0-9]+$/)) {emit(doc["name"], null);}}''',
                                 'name_fc' : '''function(doc) {if (!doc["name"].match(/_[0-9]+$/)) {emit(doc["name"], doc["flowcell"]);}}''',
                                 'name_fc_proj' : '''var list; function(doc) {if (!doc["name"].match(/_[0-9]+$/)) {list = [doc["flowcell"], doc["sample_prj"]];emit(doc["name"], list);}}''',
                                 'name_proj' : '''function(doc) {if (!doc["name"].match(/_[0-9]+$/)) {emit(doc["name"], doc["sample_prj"]);}}''',
                                 'id_to_name' : '''function(doc) {emit(doc["_id"], doc["name"]);}''',
-                                }},
+                                },
+                      'name_to_id': {'name' : '''function(doc) {emit(doc["name"], null);}'''},
+                      'sample_ids': {'flowcell' : '''function(doc) {if (!doc["name"].match(/_[0-9]+$/)) {emit([doc["flowcell"]], null);}}''',
+                                     'project' : '''function(doc) {if (!doc["name"].match(/_[0-9]+$/)) {emit([doc["sample_prj"]], null);}}''',
+                                     'project_flowcell' : '''function(doc) {if (!doc["name"].match(/_[0-9]+$/)) {emit([doc["sample_prj"], doc["flowcell"]], null);}}''',
+                                     },
+                      'qc': {'project_flowcell' : '''function(doc) {if (!doc["name"].match(/_[0-9]+$/)) {var pm = doc["picard_metrics"] || {}; var al = pm["AL_PAIR"] || {}; var dup = pm["DUP_metrics"] || {}; var ins = pm["INS_metrics"] || {}; var hs = pm["HS_metrics"] || {}; var qv = ((doc["fastqc"] || {})["stats"] || {})["Per sequence quality scores"] || {}; emit([doc["sample_prj"], doc["flowcell"]], {"name":doc["name"], "barcode_name":doc["barcode_name"], "sample_prj":doc["sample_prj"], "lane":doc["lane"], "flowcell":doc["flowcell"], "date":doc["date"], "TOTAL_READS":al["TOTAL_READS"], "PCT_PF_READS_ALIGNED":al["PCT_PF_READS_ALIGNED"], "PERCENT_DUPLICATION":dup["PERCENT_DUPLICATION"], "MEAN_INSERT_SIZE":ins["MEAN_INSERT_SIZE"], "GENOME_SIZE":hs["GENOME_SIZE"], "FOLD_ENRICHMENT":hs["FOLD_ENRICHMENT"], "TARGET_TERRITORY":hs["TARGET_TERRITORY"], "PCT_USABLE_BASES_ON_TARGET":hs["PCT_USABLE_BASES_ON_TARGET"], "PCT_TARGET_BASES_10X":hs["PCT_TARGET_BASES_10X"], "QV_COUNT":qv["Count"], "QV_QUALITY":qv["Quality"]});}}''',
+                             }},
          'flowcells' : {'names' : {'name' : '''function(doc) {emit(doc["name"], null);}''',
-                                   'id_to_name' : '''function(doc) {emit(doc["_id"], doc["name"]);}'''}},
+                                   'id_to_name' : '''function(doc) {emit(doc["_id"], doc["name"]);}'''},
+                        'name_to_id' : {'name' : '''function(doc) {emit(doc["name"], null);}'''}},
          'projects' : {'project' : {'project_id' : '''function(doc) {emit(doc.project_id, doc._id)}''',
                                     'project_name' : '''function(doc) {emit(doc.project_name, doc._id)}'''},
                        'names' : {'id_to_name' : '''function(doc) {emit(doc["_id"], doc["project_name"]);}''',
-                                  'name' : '''function(doc) {emit(doc["project_name"], null);}'''}},
+                                  'name' : '''function(doc) {emit(doc["project_name"], null);}'''},
+                       'name_to_id' : {'name' : '''function(doc) {emit(doc["project_name"], null);}'''}},
          }
 
+def _sample_run(doc):
+    """Python equivalent of the name filter of the samples views"""
+    return doc.get("name") is not None and not re.search(r"_[0-9]+$", doc["name"])
+
+# Picard metrics used in qc reports, as (metric, picard_metrics section) tuples
+QC_METRICS = [("TOTAL_READS", "AL_PAIR"), ("PCT_PF_READS_ALIGNED", "AL_PAIR"),
+              ("PERCENT_DUPLICATION", "DUP_metrics"), ("MEAN_INSERT_SIZE", "INS_metrics"),
+              ("GENOME_SIZE", "HS_metrics"), ("FOLD_ENRICHMENT", "HS_metrics"), ("TARGET_TERRITORY", "HS_metrics"),
+              ("PCT_USABLE_BASES_ON_TARGET", "HS_metrics"), ("PCT_TARGET_BASES_10X", "HS_metrics")]
+
+def _qc_projection(doc):
+    """Python equivalent of the qc/project_flowcell view value"""
+    picard_metrics = doc.get("picard_metrics") or {}
+    qv = ((doc.get("fastqc") or {}).get("stats") or {}).get("Per sequence quality scores") or {}
+    value = {k:doc.get(k) for k in ["name", "barcode_name", "sample_prj", "lane", "flowcell", "date"]}
+    value.update({metric:(picard_metrics.get(section) or {}).get(metric) for metric, section in QC_METRICS})
+    value.update({"QV_COUNT":qv.get("Count"), "QV_QUALITY":qv.get("Quality")})
+    return value
+
+# Python equivalents of VIEWS, used to index local mirrors of the
+# databases (see scilifelab.db.mirror). Each function maps a document to
+# the list of (key, value) pairs emitted by the corresponding view.
+PY_VIEWS = {'samples' : {'names': {'name' : lambda doc: [(doc["name"], None)] if _sample_run(doc) else [],
+                                   'name_fc' : lambda doc: [(doc["name"], doc.get("flowcell"))] if _sample_run(doc) else [],
+                                   'name_fc_proj' : lambda doc: [(doc["name"], [doc.get("flowcell"), doc.get("sample_prj")])] if _sample_run(doc) else [],
+                                   'name_proj' : lambda doc: [(doc["name"], doc.get("sample_prj"))] if _sample_run(doc) else [],
+                                   'id_to_name' : lambda doc: [(doc["_id"], doc.get("name"))],
+                                   },
+                         'name_to_id': {'name' : lambda doc: [(doc.get("name"), None)]},
+                         'sample_ids': {'flowcell' : lambda doc: [([doc.get("flowcell")], None)] if _sample_run(doc) else [],
+                                        'project' : lambda doc: [([doc.get("sample_prj")], None)] if _sample_run(doc) else [],
+                                        'project_flowcell' : lambda doc: [([doc.get("sample_prj"), doc.get("flowcell")], None)] if _sample_run(doc) else [],
+                                        },
+                         'qc': {'project_flowcell' : lambda doc: [([doc.get("sample_prj"), doc.get("flowcell")], _qc_projection(doc))] if _sample_run(doc) else [],
+                                }},
+            'flowcells' : {'names' : {'name' : lambda doc: [(doc.get("name"), None)],
+                                      'id_to_name' : lambda doc: [(doc["_id"], doc.get("name"))]},
+                           'name_to_id' : {'name' : lambda doc: [(doc.get("name"), None)]}},
+            'projects' : {'project' : {'project_id' : lambda doc: [(doc.get("project_id"), doc["_id"])],
+                                       'project_name' : lambda doc: [(doc.get("project_name"), doc["_id"])]},
+                          'names' : {'id_to_name' : lambda doc: [(doc["_id"], doc.get("project_name"))],
+                                     'name' : lambda doc: [(doc.get("project_name"), None)]},
+                          'name_to_id' : {'name' : lambda doc: [(doc.get("project_name"), None)]}},
+            }
+
+def view_functions(dbtype):
+    """Return the python view functions of a database type, keyed on
+    view name as in design/view
+
+    :param dbtype: one of samples, flowcells or projects
+    """
+    return {"{}/{}".format(design, name):fn for design, views in PY_VIEWS[dbtype].items() for name, fn in views.items()}
+
 # Regular expressions for general use
 re_project_id = "^(P[0-9][0-9][0-9])"
 re_project_id_nr = "^P([0-9][0-9][0-9])"
@@ -48,7 +115,148 @@ def _return_extensive_match_result(name_map, barcode_name, force=False):
         return name_map
     else:
         return None
-                        
+
+# Confidence of barcode name to project sample name matches. Matches
+# that need review come from the extensive matching rules for barcode
+# names that do not follow the PXXX_ naming convention.
+MATCH_EXACT = "exact"
+MATCH_PREFIX = "prefix"
+MATCH_REVIEW = "review"
+
+# Library prep suffixes stripped from project sample names when matching
+LIBRARY_PREP_SUFFIXES = "FBCDE"
+
+SampleMatch = collections.namedtuple("SampleMatch", ["barcode_name", "sample_name", "project_sample", "rule", "confidence", "candidates"])
+
+class ProjectSampleMatcher(object):
+    """Match barcode names, as they appear in sample sheets, to the
+    sample names of a project summary. The sample names, their variants
+    without library prep suffixes and the customer names are indexed
+    once, so that matching a barcode name only requires dict lookups of
+    its prefixes. The rules, in decreasing order of precedence, are:
+
+      exact: the barcode name is a sample name
+      prefix: the barcode name, as in PXXX_XXX[BCDEF]_indexXX, starts with a
+        sample name, possibly without library prep suffix. The longest
+        matching sample name is used.
+      prefix_without_project_id: as prefix, after removing the PXXX_ project id
+      sample_number, project_sample_number, index_sample_name, index_customer_name,
+        index_customer_well: extensive matching rules for barcode names that
+        do not follow the PXXX_ convention. These matches need review.
+
+    Barcode names matching several sample names with the same rule are
+    not matched; the candidates are listed in the match.
+
+    :param project_samples: dictionary of project samples as obtained from statusdb project_summary
+    """
+
+    def __init__(self, project_samples):
+        self.project_samples = project_samples or {}
+        self._prefixes = collections.defaultdict(set)
+        self._customer_names = collections.defaultdict(set)
+        self._customer_wells = collections.defaultdict(set)
+        for name, sample in self.project_samples.items():
+            name = str(name)
+            for variant in set([name] + [name.rstrip(c) for c in LIBRARY_PREP_SUFFIXES]):
+                if variant:
+                    self._prefixes[variant].add(name)
+            customer_name = (sample or {}).get("customer_name", None)
+            if customer_name is not None:
+                self._customer_names[str(customer_name)].add(name)
+                # customer well names contain a 0, as in 11A07; run names don't always
+                self._customer_wells[str(customer_name).replace("0", "")].add(name)
+
+    def _match(self, barcode_name, sample_names, rule, confidence):
+        sample_names = sorted(sample_names)
+        if len(sample_names) == 1:
+            return SampleMatch(barcode_name, sample_names[0], self.project_samples[sample_names[0]], rule, confidence, sample_names)
+        LOG.warn("Barcode name {} matches several project samples ({}) with rule {}; not matching".format(barcode_name, ", ".join(sample_names), rule))
+        return SampleMatch(barcode_name, None, None, rule, None, sample_names)
+
+    def _longest_prefix(self, name):
+        for i in xrange(len(name), 0, -1):
+            if name[0:i] in self._prefixes:
+                return self._prefixes[name[0:i]]
+        return None
+
+    def match(self, barcode_name, extensive_matching=False):
+        """Match a barcode name to a project sample name
+
+        :param barcode_name: barcode name as it appears in sample sheet
+        :param extensive_matching: apply the extensive matching rules to barcode names not following the PXXX_ convention
+
+        :returns: a SampleMatch; sample_name is None if there is no unique match
+        """
+        nomatch = SampleMatch(barcode_name, None, None, None, None, [])
+        if barcode_name is None:
+            return nomatch
+        barcode_name = str(barcode_name)
+        if barcode_name in self.project_samples:
+            return SampleMatch(barcode_name, barcode_name, self.project_samples[barcode_name], "exact", MATCH_EXACT, [barcode_name])
+        if re.search(re_project_id_nr, barcode_name):
+            names = self._longest_prefix(barcode_name)
+            if names:
+                return self._match(barcode_name, names, "prefix", MATCH_PREFIX)
+            prj_id = barcode_name.split("_")[0]
+            names = self._longest_prefix(barcode_name.replace("{}_".format(prj_id), ""))
+            if names:
+                return self._match(barcode_name, names, "prefix_without_project_id", MATCH_PREFIX)
+            return nomatch
+        if not extensive_matching or len(self.project_samples) == 0:
+            return nomatch
+        # Project id could be project number without a P, i.e. XXX_XXX_indexXX
+        sample_id = re.search("(\d+_)?(\d+)_?([A-Z])?_", barcode_name)
+        if not sample_id:
+            LOG.warn("No regular expression match for barcode name {}; implement new case".format(barcode_name))
+            return nomatch
+        (prj_id, smp_id, _) = sample_id.groups()
+        prj_smp_id = "P{}_{}".format((prj_id or "").rstrip("_"), smp_id)
+        rules = [("sample_number", smp_id in self.project_samples and set([smp_id])),
+                 ("project_sample_number", prj_smp_id in self.project_samples and set([prj_smp_id]))]
+        # Sometimes barcode name is of format XX_indexXX, where the number is the sample number
+        m = re.search("(_index[0-9]+)", barcode_name)
+        if m:
+            name = re.search("([A-Za-z0-9\_]+)(\_index[0-9]+)?", barcode_name.replace(m.group(1), "")).group(1)
+            rules += [("index_sample_name", name in self.project_samples and set([name])),
+                      ("index_customer_name", self._customer_names.get(name, None)),
+                      ("index_customer_well", self._customer_wells.get(name, None))]
+        for rule, names in rules:
+            if names:
+                return self._match(barcode_name, names, rule, MATCH_REVIEW)
+        return nomatch
+
+    def match_all(self, barcode_names, extensive_matching=False):
+        """Match several barcode names, e.g. those of a flowcell
+
+        :param barcode_names: list of barcode names
+        :param extensive_matching: apply the extensive matching rules
+
+        :returns: dict mapping each barcode name to its SampleMatch
+        """
+        report = {bc:self.match(bc, extensive_matching) for bc in set(barcode_names)}
+        counts = collections.Counter([m.confidence for m in report.values()])
+        LOG.debug("Matched {} barcode names: {}".format(len(report), ", ".join(["{} {}".format(n, c or "unmatched") for c, n in counts.items()])))
+        return report
+
+def review_matches(report, force=False):
+    """Review a match report: matches that need review are accepted
+    interactively, unless force is set
+
+    :param report: dict mapping barcode names to SampleMatch objects, as returned by ProjectSampleMatcher.match_all
+    :param force: accept all matches without asking
+
+    :returns: dict mapping barcode names to dict(sample_name:project sample name, project_sample:project sample dict), for the accepted matches
+    """
+    accepted = {}
+    for bc, m in sorted(report.items()):
+        if m.sample_name is None:
+            continue
+        name_map = {'sample_name':m.sample_name, 'project_sample':m.project_sample}
+        if m.confidence == MATCH_REVIEW:
+            name_map = _return_extensive_match_result(name_map, bc, force=force)
+        if name_map:
+            accepted[bc] = name_map
+    return accepted
 
 def _match_barcode_name_to_project_sample(barcode_name, project_samples, extensive_matching=False, force=False):
     """Take a barcode name and map it to a list of project sample names.
@@ -60,74 +268,8 @@ def _match_barcode_name_to_project_sample(barcode_name, project_samples, extensi
     
     :returns: dictionary with keys project sample name and project sample or None
     """
-    if barcode_name in project_samples.keys():
-        return {'sample_name':barcode_name, 'project_sample':project_samples[barcode_name]}
-    for project_sample_name in project_samples.keys():
-        # Look for cases where barcode name is formatted in a way that does not conform to convention
-        # NB: only do this interactively!!!
-        if not re.search(re_project_id_nr, barcode_name):
-            if not extensive_matching:
-                return None
-            # Project id could be project number without a P, i.e. XXX_XXX_indexXX
-            sample_id = re.search("(\d+_)?(\d+)_?([A-Z])?_",barcode_name)
-            # Fall back if no hit
-            if not sample_id:
-                LOG.warn("No regular expression match for barcode name {}; implement new case".format(barcode_name))
-                return None
-            (prj_id, smp_id, _) = sample_id.groups()
-            if not prj_id:
-                prj_id=""
-            if str(smp_id) == str(project_sample_name):
-                return _return_extensive_match_result({'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}, barcode_name, force=force)
-            elif str("P{}_{}".format(prj_id.rstrip("_"), smp_id)) == str(project_sample_name):
-                return _return_extensive_match_result({'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}, barcode_name, force=force)
-
-            # Sometimes barcode name is of format XX_indexXX, where the number is the sample number
-            m = re.search("(_index[0-9]+)", barcode_name)
-            if not m:
-                index = ""
-            else:
-                index = m.group(1)
-                sample_id = re.search("([A-Za-z0-9\_]+)(\_index[0-9]+)?", barcode_name.replace(index, ""))
-                if str(sample_id.group(1)) == str(project_sample_name):
-                    return _return_extensive_match_result({'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}, barcode_name, force=force)
-                if str(sample_id.group(1)) == str(project_samples[project_sample_name].get("customer_name", None)):
-                    return _return_extensive_match_result({'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}, barcode_name, force=force)
-                # customer well names contain a 0, as in 11A07; run names don't always
-                # FIXME: a function should convert customer name to standard forms in cases like these
-                if str(sample_id.group(1)) == str(project_samples[project_sample_name].get("customer_name", "").replace("0", "")):
-                    return _return_extensive_match_result({'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}, barcode_name, force=force)
-        else:
-            prj_id = barcode_name.split("_")[0]
-            # Matches project id naming convention PXXX_
-            # Look for case barcode: PXXX_XXX[BCDEF]_indexXX, project_sample_name: PXXX_XXX
-            if str(barcode_name).startswith(str(project_sample_name)):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-            elif str(barcode_name).startswith(str(project_sample_name).rstrip("F")):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-            elif str(barcode_name).startswith(str(project_sample_name).rstrip("B")):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-            elif str(barcode_name).startswith(str(project_sample_name).rstrip("C")):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-            elif str(barcode_name).startswith(str(project_sample_name).rstrip("D")):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-            elif str(barcode_name).startswith(str(project_sample_name).rstrip("E")):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-            
-            # Look for cases barcode: PXXX_XX[BCDEF]_indexXX matching to project_sample_name: XX_indexXX
-            elif str(barcode_name.replace("{}_".format(prj_id), "")).startswith(str(project_sample_name)):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-            elif str(barcode_name.replace("{}_".format(prj_id), "")).startswith(str(project_sample_name).rstrip("F")):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-            elif str(barcode_name.replace("{}_".format(prj_id), "")).startswith(str(project_sample_name).rstrip("B")):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-            elif str(barcode_name.replace("{}_".format(prj_id), "")).startswith(str(project_sample_name).rstrip("C")):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-            elif str(barcode_name.replace("{}_".format(prj_id), "")).startswith(str(project_sample_name).rstrip("D")):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-            elif str(barcode_name.replace("{}_".format(prj_id), "")).startswith(str(project_sample_name).rstrip("E")):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-    return None
+    m = ProjectSampleMatcher(project_samples).match(barcode_name, extensive_matching)
+    return review_matches({barcode_name:m}, force=force).get(barcode_name, None)
 
 ##############################
 # Documents
@@ -205,41 +347,85 @@ class SampleRunMetricsDocument(StatusDocument):
             self["project_id"] = m.group(1)
         return 
 
-# Updating function for object comparison        
-def update_fn(cls, db, obj, viewname = "names/id_to_name", key="name"):
+# Updating functions for object comparison        
+# Document fields that are disregarded when comparing documents
+META_FIELDS = ["_id", "_rev", "creation_time", "modification_time"]
+
+def _equal(a, b):
+    """Compare two documents, disregarding ids, revisions and timestamps"""
+    a_keys = [str(x) for x in a.keys() if x not in META_FIELDS]
+    b_keys = [str(x) for x in b.keys() if x not in META_FIELDS]
+    keys = list(set(a_keys + b_keys))
+    return {k:a.get(k, None) for k in keys} == {k:b.get(k, None) for k in keys}
+
+def content_hash(doc):
+    """Hash the content of a document, disregarding ids, revisions and
+    timestamps. Documents that are equal according to _equal, apart
+    from fields set to None, have the same hash.
+
+    :param doc: document
+
+    :returns: hex digest
+    """
+    content = {k:v for k, v in doc.items() if k not in META_FIELDS and v is not None}
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str)).hexdigest()
+
+def _name_rows(db, names, viewname):
+    """Look up the view rows of several names in a view keyed on name.
+    Fall back to scanning the id_to_name view if the view is missing.
+    """
+    try:
+        return {row.key:row for row in db.view(viewname, keys=list(names), reduce=False)}
+    except couchdb.ResourceNotFound:
+        LOG.warn("No view {}; scanning names/id_to_name".format(viewname))
+        names = set(names)
+        return {row.value:row for row in db.view("names/id_to_name") if row.value in names}
+
+def update_many_fn(cls, db, objs, viewname="name_to_id/name", key="name"):
+    """Compare objects with the objects in db, if present. The database
+    ids are looked up with one view query and the current documents are
+    fetched with one _all_docs request.
+
+    :param cls: calling class
+    :param db: couch database
+    :param objs: database objects to save
+    :param viewname: view mapping names to document ids
+    :param key: document field holding the name
+
+    :returns: list with the database object to save (None if up to date) and the database id if present, for each object
+    """
+    t_utc = utc_time()
+    dbids = _name_rows(db, set([obj[key] for obj in objs]), viewname)
+    dbobjs = get_docs(db, set([row.id for row in dbids.values()]))
+    res = []
+    for obj in objs:
+        dbid = dbids.get(obj[key], None)
+        dbobj = dbobjs.get(dbid.id, None) if dbid else None
+        if dbobj is None:
+            obj["creation_time"] = t_utc
+            res.append((obj, dbid))
+        elif _equal(obj, dbobj):
+            res.append((None, dbid))
+        else:
+            obj["creation_time"] = dbobj.get("creation_time")
+            obj["modification_time"] = t_utc
+            obj["_rev"] = dbobj.get("_rev")
+            obj["_id"] = dbobj.get("_id")
+            res.append((obj, dbid))
+    return res
+
+def update_fn(cls, db, obj, viewname="name_to_id/name", key="name"):
     """Compare object with object in db if present.
 
     :param cls: calling class
     :param db: couch database
     :param obj: database object to save
+    :param viewname: view mapping names to document ids
+    :param key: document field holding the name
 
     :returns: database object to save and database id if present
     """
-    t_utc = utc_time()
-    def equal(a, b):
-        a_keys = [str(x) for x in a.keys() if x not in ["_id", "_rev", "creation_time", "modification_time"]]
-        b_keys = [str(x) for x in b.keys() if x not in ["_id", "_rev", "creation_time", "modification_time"]]
-        keys = list(set(a_keys + b_keys))
-        return {k:a.get(k, None) for k in keys} == {k:b.get(k, None) for k in keys}
-
-    view = db.view(viewname)
-    d_view = {k.value:k for k in view}
-    dbid =  d_view.get(obj[key], None)
-    dbobj = None
-
-    if dbid:
-        dbobj = db.get(dbid.id, None)
-    if dbobj is None:
-        obj["creation_time"] = t_utc
-        return (obj, dbid)
-    if equal(obj, dbobj):
-        return (None, dbid)
-    else:
-        obj["creation_time"] = dbobj.get("creation_time")
-        obj["modification_time"] = t_utc
-        obj["_rev"] = dbobj.get("_rev")
-        obj["_id"] = dbobj.get("_id")
-        return (obj, dbid)
+    return update_many_fn(cls, db, [obj], viewname, key)[0]
 
 ##############################
 # functions that operate on status_document objects
@@ -263,6 +449,95 @@ def calc_avg_qv(srm):
         return None
 
 
+# Columns of the qc frame, with the defaults of missing numeric values.
+# Percentages are scaled to 0-100 after filling in the defaults.
+QC_COLUMNS = ["sample", "project", "lane", "flowcell", "date", "application"]
+QC_NUMERIC_DEFAULTS = collections.OrderedDict([("TOTAL_READS", -1), ("PERCENT_DUPLICATION", -1.0), ("MEAN_INSERT_SIZE", -1.0),
+                                               ("GENOME_SIZE", -1), ("FOLD_ENRICHMENT", -1.0), ("PCT_USABLE_BASES_ON_TARGET", -1.0),
+                                               ("PCT_TARGET_BASES_10X", -1.0), ("PCT_PF_READS_ALIGNED", -1.0), ("TARGET_TERRITORY", -1.0)])
+QC_INTEGER_COLUMNS = ["TOTAL_READS", "GENOME_SIZE"]
+QC_PERCENT_COLUMNS = ["PERCENT_DUPLICATION", "PCT_USABLE_BASES_ON_TARGET", "PCT_TARGET_BASES_10X", "PCT_PF_READS_ALIGNED"]
+
+def _to_numeric(values, default):
+    """Convert a column of numbers, possibly strings with decimal commas, filling in default for missing values"""
+    values = pd.Series(values, dtype=object)
+    strings = values.map(lambda x: isinstance(x, basestring))
+    values[strings] = values[strings].str.replace(",", ".")
+    return pd.to_numeric(values, errors="coerce").fillna(default)
+
+def avg_qv(counts, qualities):
+    """Vectorized calc_avg_qv: compute the average quality values of
+    several samples from the FastQC 'Per sequence quality scores'
+
+    :param counts: list of lists of counts, or None for missing values
+    :param qualities: list of lists of quality values, or None for missing values
+
+    :returns: numpy array of average quality values, rounded to one decimal, with nan for missing values
+    """
+    result = np.empty(len(counts))
+    result.fill(np.nan)
+    valid, count, quality, lengths = [], [], [], []
+    for i, (c, q) in enumerate(izip(counts, qualities)):
+        try:
+            n = min(len(c), len(q))
+            c, q = [float(x) for x in c[0:n]], [int(x) for x in q[0:n]]
+        except (TypeError, ValueError):
+            continue
+        if n == 0 or sum(c) == 0:
+            continue
+        valid.append(i)
+        count.extend(c)
+        quality.extend(q)
+        lengths.append(n)
+    if len(valid) > 0:
+        count, quality = np.array(count), np.array(quality)
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        result[valid] = np.round(np.add.reduceat(count * quality, offsets) / np.add.reduceat(count, offsets), 1)
+    return result
+
+def qc_frame(rows, application=None):
+    """Build a data frame of qc metrics, with one row per sample run,
+    from the values of the qc/project_flowcell view. The numeric columns
+    are converted in one pass, and PERCENT_ON_TARGET and avg_qv are
+    computed for all rows at once.
+
+    :param rows: list of qc/project_flowcell view values
+    :param application: project application
+
+    :returns: pandas DataFrame indexed on sample run name
+    """
+    rows = list(rows)
+    raw = pd.DataFrame(rows, columns=["name", "barcode_name", "sample_prj", "lane", "flowcell", "date", "QV_COUNT", "QV_QUALITY"] + QC_NUMERIC_DEFAULTS.keys())
+    df = pd.DataFrame({"sample":raw["barcode_name"], "project":raw["sample_prj"], "lane":raw["lane"],
+                       "flowcell":raw["flowcell"], "date":raw["date"], "application":application},
+                      columns=QC_COLUMNS)
+    for col, default in QC_NUMERIC_DEFAULTS.items():
+        df[col] = _to_numeric(raw[col], default)
+    for col in QC_INTEGER_COLUMNS:
+        df[col] = df[col].astype(np.int64)
+    for col in QC_PERCENT_COLUMNS:
+        df[col] = df[col] * 100
+    on_target = (df["FOLD_ENRICHMENT"] != 0) & (df["GENOME_SIZE"] != 0) & (df["TARGET_TERRITORY"] != 0)
+    df["PERCENT_ON_TARGET"] = (df["FOLD_ENRICHMENT"] / (df["GENOME_SIZE"].astype(float) / df["TARGET_TERRITORY"]) * 100).where(on_target)
+    df["avg_qv"] = avg_qv(raw["QV_COUNT"].tolist(), raw["QV_QUALITY"].tolist())
+    df.index = raw["name"]
+    return df
+
+def get_qc_frame(sample_prj, p_con, s_con, fc_id=None):
+    """Get qc data for a project, possibly subset by flowcell, as a data frame.
+    Only the metrics used in qc reports are fetched, with the qc/project_flowcell view.
+
+    :param sample_prj: project identifier
+    :param p_con: object of type <ProjectSummaryConnection>
+    :param s_con: object of type <SampleRunMetricsConnection>
+    :param fc_id: flowcell id
+
+    :returns: pandas DataFrame, see qc_frame
+    """
+    project = p_con.get_entry(sample_prj)
+    application = project.get("application", None) if project else None
+    return qc_frame(s_con.get_qc_rows(fc_id=fc_id, sample_prj=sample_prj), application)
+
 def get_qc_data(sample_prj, p_con, s_con, fc_id=None):
     """Get qc data for a project, possibly subset by flowcell.
     
@@ -272,34 +547,15 @@ def get_qc_data(sample_prj, p_con, s_con, fc_id=None):
 
     :returns: dictionary of qc results
     """
-    project = p_con.get_entry(sample_prj)
-    application = project.get("application", None) if project else None
-    samples = s_con.get_samples(fc_id=fc_id, sample_prj=sample_prj)
+    df = get_qc_frame(sample_prj, p_con, s_con, fc_id)
+    columns = QC_COLUMNS + [c for c in QC_NUMERIC_DEFAULTS.keys() if c != "TARGET_TERRITORY"]
     qcdata = {}
-    for s in samples:
-        qcdata[s["name"]]={"sample":s.get("barcode_name", None),
-                           "project":s.get("sample_prj", None),
-                           "lane":s.get("lane", None),
-                           "flowcell":s.get("flowcell", None),
-                           "date":s.get("date", None),
-                           "application":application,
-                           "TOTAL_READS":int(s.get("picard_metrics", {}).get("AL_PAIR", {}).get("TOTAL_READS", -1)),
-                           "PERCENT_DUPLICATION":s.get("picard_metrics", {}).get("DUP_metrics", {}).get("PERCENT_DUPLICATION", "-1.0"),
-                           "MEAN_INSERT_SIZE":float(s.get("picard_metrics", {}).get("INS_metrics", {}).get("MEAN_INSERT_SIZE", "-1.0").replace(",", ".")),
-                           "GENOME_SIZE":int(s.get("picard_metrics", {}).get("HS_metrics", {}).get("GENOME_SIZE", -1)),
-                           "FOLD_ENRICHMENT":float(s.get("picard_metrics", {}).get("HS_metrics", {}).get("FOLD_ENRICHMENT", "-1.0").replace(",", ".")),
-                           "PCT_USABLE_BASES_ON_TARGET":s.get("picard_metrics", {}).get("HS_metrics", {}).get("PCT_USABLE_BASES_ON_TARGET", "-1.0"),
-                           "PCT_TARGET_BASES_10X":s.get("picard_metrics", {}).get("HS_metrics", {}).get("PCT_TARGET_BASES_10X", "-1.0"),
-                           "PCT_PF_READS_ALIGNED":s.get("picard_metrics", {}).get("AL_PAIR", {}).get("PCT_PF_READS_ALIGNED", "-1.0"),
-                           }
-        target_territory = float(s.get("picard_metrics", {}).get("HS_metrics", {}).get("TARGET_TERRITORY", -1))
-        pct_labels = ["PERCENT_DUPLICATION", "PCT_USABLE_BASES_ON_TARGET", "PCT_TARGET_BASES_10X",
-                      "PCT_PF_READS_ALIGNED"]
-        for l in pct_labels:
-            if qcdata[s["name"]][l]:
-                qcdata[s["name"]][l] = float(qcdata[s["name"]][l].replace(",", ".")) * 100
-        if qcdata[s["name"]]["FOLD_ENRICHMENT"] and qcdata[s["name"]]["GENOME_SIZE"] and target_territory:
-            qcdata[s["name"]]["PERCENT_ON_TARGET"] = float(qcdata[s["name"]]["FOLD_ENRICHMENT"]/ (float(qcdata[s["name"]]["GENOME_SIZE"]) / float(target_territory))) * 100
+    for name, row in izip(df.index, df[columns + ["PERCENT_ON_TARGET"]].itertuples(index=False)):
+        qcdata[name] = dict(izip(columns, row))
+        for col in QC_INTEGER_COLUMNS:
+            qcdata[name][col] = int(qcdata[name][col])
+        if not np.isnan(row[-1]):
+            qcdata[name]["PERCENT_ON_TARGET"] = float(row[-1])
     return qcdata
 
 def get_scilife_to_customer_name(project_name, p_con, s_con):
@@ -313,11 +569,12 @@ def get_scilife_to_customer_name(project_name, p_con, s_con):
     :returns: dictionary with keys scilife name and values customer name
     """
     barcode_names = [s.get("barcode_name", None) for s in s_con.get_samples(sample_prj=project_name)]
+    matches = review_matches(p_con.match_project_samples(project_name, barcode_names))
     name_d = {}
     for bcname in barcode_names:
-        s = p_con.get_project_sample(project_name, bcname)
-        name_d[bcname] = {'scilife_name': s['project_sample'].get('scilife_name', bcname),
-                          'customer_name' : s['project_sample'].get('customer_name', None)
+        project_sample = matches.get(bcname, {}).get('project_sample', None) or {}
+        name_d[bcname] = {'scilife_name': project_sample.get('scilife_name', bcname),
+                          'customer_name' : project_sample.get('customer_name', None)
                           }
     return name_d
 
@@ -325,21 +582,58 @@ def get_scilife_to_customer_name(project_name, p_con, s_con):
 ##############################
 # Connections
 ##############################
+def _row_id(row):
+    """View proxy value for name views that map a name to the document id"""
+    return row.id
+
 class SampleRunMetricsConnection(Couch):
     _doc_type = SampleRunMetricsDocument
     _update_fn = update_fn
+    _update_many_fn = update_many_fn
     def __init__(self, dbname="samples", **kwargs):
         super(SampleRunMetricsConnection, self).__init__(**kwargs)
         self.db = self.con[dbname]
-        self.name_view = {k.key:k.id for k in self.db.view("names/name", reduce=False)}
-        self.name_fc_view = {k.key:k for k in self.db.view("names/name_fc", reduce=False)}
-        self.name_proj_view = {k.key:k for k in self.db.view("names/name_proj", reduce=False)}
-        self.name_fc_proj_view = {k.key:k for k in self.db.view("names/name_fc_proj", reduce=False)}
+        self.install_views(VIEWS['samples'])
+        self.name_view = self.view_proxy("names/name", _row_id)
+        self.name_fc_view = self.view_proxy("names/name_fc")
+        self.name_proj_view = self.view_proxy("names/name_proj")
+        self.name_fc_proj_view = self.view_proxy("names/name_fc_proj")
 
     def set_db(self, dbname):
         """Make sure we don't change db from samples"""
         pass
 
+    def _sample_rows(self, fc_id=None, sample_prj=None, include_docs=False, limit=None):
+        """Query the sample_ids views for the samples of a flowcell and/or project.
+        Fall back to scanning the names/name_fc_proj view if the view is missing.
+
+        :param fc_id: flowcell id
+        :param sample_prj: sample project name
+        :param include_docs: include the documents in the rows
+        :param limit: maximum number of rows
+
+        :returns: list of view rows
+        """
+        if fc_id and sample_prj:
+            viewname, key = "sample_ids/project_flowcell", [sample_prj, fc_id]
+        elif fc_id:
+            viewname, key = "sample_ids/flowcell", [fc_id]
+        elif sample_prj:
+            viewname, key = "sample_ids/project", [sample_prj]
+        else:
+            return []
+        kw = {"limit":limit} if limit else {}
+        try:
+            return list(self.db.view(viewname, key=key, include_docs=include_docs, reduce=False, **kw))
+        except couchdb.ResourceNotFound:
+            self.log.warn("No view {}; scanning names/name_fc_proj".format(viewname))
+            rows = [row for row in self.db.view("names/name_fc_proj", include_docs=include_docs, reduce=False)
+                    if (not fc_id or row.value[0] == fc_id) and (not sample_prj or row.value[1] == sample_prj)]
+            return rows[0:limit] if limit else rows
+
+    def _has_samples(self, fc_id=None, sample_prj=None):
+        return len(self._sample_rows(fc_id, sample_prj, limit=1)) > 0
+
     def get_sample_ids(self, fc_id=None, sample_prj=None):
         """Retrieve sample ids subset by fc_id and/or sample_prj
 
@@ -349,25 +643,33 @@ class SampleRunMetricsConnection(Couch):
         :returns sample_ids: list of couchdb sample ids
         """
         self.log.debug("retrieving sample ids subset by flowcell '{}' and sample_prj '{}'".format(fc_id, sample_prj))
-        fc_sample_ids = [self.name_fc_view[k].id for k in self.name_fc_view.keys() if self.name_fc_view[k].value == fc_id] if fc_id else []
-        prj_sample_ids = [self.name_proj_view[k].id for k in self.name_proj_view.keys() if self.name_proj_view[k].value == sample_prj] if sample_prj else []
-        # | -> union, & -> intersection
-        if len(fc_sample_ids) > 0 and len(prj_sample_ids) > 0:
-            sample_ids = list(set(fc_sample_ids) & set(prj_sample_ids))
-        else:
-            sample_ids = list(set(fc_sample_ids) | set(prj_sample_ids))
-        # Set to empty list if we actually had supplied a flowcell id and project id but one of them is non-existent
-        if fc_id and sample_prj:
-            if len(fc_sample_ids)==0:
-                sample_ids = []
+        sample_ids = [row.id for row in self._sample_rows(fc_id, sample_prj)]
+        # Warn about which of flowcell id and project id is non-existent
+        if fc_id and sample_prj and len(sample_ids) == 0:
+            if not self._has_samples(fc_id=fc_id):
                 self.log.warn("No such flowcell '{}' for project '{}'".format(fc_id, sample_prj))
-            elif len(prj_sample_ids)==0:
-                sample_ids = []
+            elif not self._has_samples(sample_prj=sample_prj):
                 self.log.warn("No such project '{}' for flowcell '{}'".format(sample_prj, fc_id))
-
-        self.log.debug("Number of samples: {}, number of fc samples: {}, number of project samples: {}".format(len(sample_ids), len(fc_sample_ids), len(prj_sample_ids)))
+        self.log.debug("Number of samples: {}".format(len(sample_ids)))
         return sample_ids
 
+    def get_qc_rows(self, fc_id=None, sample_prj=None):
+        """Retrieve the qc metrics of samples subset by fc_id and/or sample_prj,
+        as the values of the qc/project_flowcell view
+
+        :param fc_id: flowcell id
+        :param sample_prj: sample project name
+
+        :returns: list of dicts, see get_qc_frame
+        """
+        if not sample_prj:
+            return [_qc_projection(s) for s in self.get_samples(fc_id=fc_id)]
+        if fc_id:
+            rows = self.db.view("qc/project_flowcell", key=[sample_prj, fc_id], reduce=False)
+        else:
+            rows = self.db.view("qc/project_flowcell", startkey=[sample_prj], endkey=[sample_prj, {}], reduce=False)
+        return [row.value for row in rows]
+
     def get_samples(self, fc_id=None, sample_prj=None):
         """Retrieve samples subset by fc_id and/or sample_prj
 
@@ -377,18 +679,17 @@ class SampleRunMetricsConnection(Couch):
         :returns samples: list of sample_run_metrics documents
         """
         self.log.debug("retrieving samples subset by flowcell '{}' and sample_prj '{}'".format(fc_id, sample_prj))
-        sample_ids = self.get_sample_ids(fc_id, sample_prj)
-        inv_view = {v:k for k,v in self.name_view.iteritems()}
-        sample_names = [inv_view[x] for x in sample_ids]
-        return [self.get_entry(x) for x in sample_names]
+        return [self._doc_type(**row.doc) for row in self._sample_rows(fc_id, sample_prj, include_docs=True)]
 
 class FlowcellRunMetricsConnection(Couch):
     _doc_type = FlowcellRunMetricsDocument
     _update_fn = update_fn
+    _update_many_fn = update_many_fn
     def __init__(self, dbname="flowcells", **kwargs):
         super(FlowcellRunMetricsConnection, self).__init__(**kwargs)
         self.db = self.con[dbname]
-        self.name_view = {k.key:k.id for k in self.db.view("names/name", reduce=False)}
+        self.install_views(VIEWS['flowcells'])
+        self.name_view = self.view_proxy("names/name", _row_id)
 
     def set_db(self):
         """Make sure we don't change db from flowcells"""
@@ -435,10 +736,13 @@ class FlowcellRunMetricsConnection(Couch):
 class ProjectSummaryConnection(Couch):
     _doc_type = ProjectSummaryDocument
     _update_fn = update_fn
+    _update_many_fn = update_many_fn
     def __init__(self, dbname="projects", **kwargs):
         super(ProjectSummaryConnection, self).__init__(**kwargs)
         self.db = self.con[dbname]
-        self.name_view = {k.key:k.id for k in self.db.view("project/project_name", reduce=False)}
+        self.install_views(VIEWS['projects'])
+        self.name_view = self.view_proxy("project/project_name", _row_id)
+        self._matchers = {}
 
     def set_db(self, dbname):
         """Make sure we don't change db from projects"""
@@ -455,11 +759,39 @@ class ProjectSummaryConnection(Couch):
         """
         if not barcode_name:
             return None
-        project = self.get_entry(project_name)
-        if not project:
+        matcher = self.get_matcher(project_name)
+        if matcher is None:
             return None
-        project_samples = project.get('samples', None)
-        return _match_barcode_name_to_project_sample(barcode_name, project_samples, extensive_matching)
+        return review_matches({barcode_name:matcher.match(barcode_name, extensive_matching)}).get(barcode_name, None)
+
+    def get_matcher(self, project_name):
+        """Get the barcode name matcher of a project. The matcher is built
+        once per project and connection.
+
+        :param project_name: the project name
+
+        :returns: a ProjectSampleMatcher, or None if there is no such project
+        """
+        if project_name not in self._matchers:
+            project = self.get_entry(project_name)
+            self._matchers[project_name] = ProjectSampleMatcher(project.get('samples', None)) if project else None
+        return self._matchers[project_name]
+
+    def match_project_samples(self, project_name, barcode_names, extensive_matching=False):
+        """Match the barcode names of several sample runs, e.g. those of a
+        flowcell, to project sample names. Matches are not reviewed; see
+        review_matches.
+
+        :param project_name: the project name
+        :param barcode_names: list of barcode names
+        :param extensive_matching: do extensive matching of barcode names
+
+        :returns: dict mapping each barcode name to its SampleMatch, or an empty dict if there is no such project
+        """
+        matcher = self.get_matcher(project_name)
+        if matcher is None:
+            return {}
+        return matcher.match_all(barcode_names, extensive_matching)
 
     def _get_sample_run_metrics(self, v):
         if v.get('library_prep', None):
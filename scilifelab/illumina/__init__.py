@@ -4,15 +4,48 @@ A module for handling the files and directories from an illumina run
 
 import os
 import glob
+import itertools
+import collections
 from scilifelab.illumina.index_definitions import BASIC_LOOKUP
-from scilifelab.utils.string import hamming_distance
+from scilifelab.utils.string import hamming_distance, hamming_neighbours
 from scilifelab.bcbio.flowcell import Flowcell
 from scilifelab.bcbio.qc import FlowcellRunMetricsParser
- 
-def map_index_name(index, mismatch=0):
-    """Map the index sequences to the known names, if possible. Requires the samplesheet module.
+
+# Bases covered by the precomputed index neighbourhoods
+INDEX_ALPHABET = "ACGTN"
+# Separators of the two indexes of a dual index
+DUAL_INDEX_SEPARATORS = "-+"
+
+# Lookup tables from index sequence to names, per number of mismatches
+_INDEX_TABLES = {}
+
+def _index_table(mismatch=0):
+    """Return the table from all sequences within mismatch mismatches of the 
+    sequences in BASIC_LOOKUP to the names, bucketed by sequence length. The 
+    7 base bucket holds the 6 base indexes followed by the A read in the 7th
+    index cycle. The tables are built on first use and cached.
+    """
+    if mismatch not in _INDEX_TABLES:
+        table = collections.defaultdict(lambda: collections.defaultdict(list))
+        for name, sequence in BASIC_LOOKUP.items():
+            sequences = [sequence, "{}A".format(sequence)] if len(sequence) == 6 else [sequence]
+            for seq in sequences:
+                for n in hamming_neighbours(seq, mismatch, INDEX_ALPHABET):
+                    table[len(n)][n].append(name)
+        _INDEX_TABLES[mismatch] = {length: dict(t) for length, t in table.items()}
+    return _INDEX_TABLES[mismatch]
+
+def split_index(index):
+    """Split a (possibly dual) index sequence into its parts
+    """
+    for sep in DUAL_INDEX_SEPARATORS:
+        if sep in index:
+            return index.split(sep)
+    return [index]
+
+def _scan_index_name(index, mismatch=0):
+    """Map an index sequence to the known names by comparing it to each of them
     """
-    
     names = []
     for name, sequence in BASIC_LOOKUP.items():
         try:
@@ -24,6 +57,47 @@ def map_index_name(index, mismatch=0):
         
     return names
 
+def map_index_name(index, mismatch=0):
+    """Map the index sequences to the known names, if possible. A dual index 
+    is mapped to the combinations of the names of its parts, e.g. index1-index2.
+    
+    :param index: the index sequence
+    :param mismatch: the number of mismatches allowed (in each part of a dual index)
+    
+    :returns: a list of names
+    """
+    parts = split_index(index)
+    if len(parts) > 1:
+        return ["-".join(n) for n in itertools.product(*[map_index_name(p, mismatch) for p in parts])]
+    if not set(index).issubset(INDEX_ALPHABET):
+        return _scan_index_name(index, mismatch)
+    return list(_index_table(mismatch).get(len(index),{}).get(index,[]))
+
+def map_index_names(indexes, mismatch=0):
+    """Map a list of index sequences to the known names
+    
+    :param indexes: list of index sequences
+    :param mismatch: the number of mismatches allowed
+    
+    :returns: a dict with the list of names for each distinct index sequence
+    """
+    return {index: map_index_name(index, mismatch) for index in set(indexes)}
+
+def ambiguous_indexes(mismatch=1):
+    """Find the sequences that lie within mismatch mismatches of more than one
+    distinct index sequence, and so cannot be mapped unambiguously
+    
+    :param mismatch: the number of mismatches allowed
+    
+    :returns: a dict with the list of names for each ambiguous sequence
+    """
+    ambiguous = {}
+    for table in _index_table(mismatch).values():
+        for sequence, names in table.items():
+            if len(set([BASIC_LOOKUP[name] for name in names])) > 1:
+                ambiguous[sequence] = list(names)
+    return ambiguous
+
 class IlluminaRun(object):
     
     def __init__(self, run_dir, samplesheet=None):
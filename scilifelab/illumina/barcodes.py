@@ -0,0 +1,179 @@
+"""Counting and naming of barcode (index) sequences in fastq files"""
+import os
+import csv
+import itertools
+import multiprocessing
+import numpy as np
+from scilifelab.illumina import map_index_names
+from scilifelab.utils.fastq_utils import BarcodeExtractor, record_boundary
+from scilifelab.utils.sketch import SpaceSaving
+from scilifelab.utils.string import hamming_neighbours
+
+# Default number of barcodes tracked by the counter
+DEFAULT_CAPACITY = 100000
+# Default number of barcodes counted per chunk
+DEFAULT_CHUNK_SIZE = 1000000
+
+def exclusion_set(expected, mismatch=False):
+    """Return the set of barcodes to exclude from counting, i.e. the expected
+    barcodes and, optionally, all barcodes with one mismatch to them
+
+    :param expected: list of expected barcodes
+    :param mismatch: also exclude barcodes with one mismatch
+
+    :returns: a set of barcodes
+    """
+    excluded = set()
+    for bc in expected:
+        excluded.update(hamming_neighbours(bc, int(mismatch)))
+    return excluded
+
+def shard_offsets(fqfile, shards):
+    """Split an uncompressed fastq file into byte ranges starting at record
+    boundaries
+
+    :param fqfile: the fastq file
+    :param shards: the number of byte ranges
+
+    :returns: a list of (start, end) tuples, excluding empty ranges
+    """
+    size = os.path.getsize(fqfile)
+    with open(fqfile, "rb") as fh:
+        offsets = [record_boundary(fh, i*size/shards) for i in xrange(shards)] + [size]
+    return [(start, end) for start, end in zip(offsets[:-1], offsets[1:]) if end > start]
+
+def is_compressed(fqfile):
+    """Return True if the file is compressed, as judged by the extension
+    """
+    return os.path.splitext(fqfile)[1] in [".gz", ".bz2"]
+
+class BarcodeCounts:
+    """The result of counting the barcodes of a fastq file. Wraps the
+       SpaceSaving counter, so the counts are upper bounds of the true
+       counts if more than capacity distinct barcodes were seen. The rows
+       method returns the lane, sequence, count and index_name of the most
+       common barcodes, the format of the undemultiplexed barcode metrics
+       that are uploaded to statusdb."""
+
+    header = ['lane', 'sequence', 'count', 'index_name']
+
+    def __init__(self, counter, lane=None, mismatch=0):
+        self.counter = counter
+        self.lane = lane
+        self.mismatch = mismatch
+
+    @property
+    def total(self):
+        """The number of reads processed"""
+        return self.counter.total
+
+    def most_common(self, n=None):
+        return self.counter.most_common(n)
+
+    def rows(self, n=None):
+        """Return a list of dicts with the metrics of the n most common barcodes
+        """
+        top = self.most_common(n)
+        names = map_index_names([bc for bc, count in top], self.mismatch)
+        return [dict(zip(self.header, [self.lane, bc, count, ','.join(names[bc])])) for bc, count in top]
+
+    def to_dict(self, n=None):
+        """Return the metrics of the n most common barcodes as a dict of lists,
+        in the format stored under undemultiplexed_barcodes in the flowcell document
+        """
+        rows = self.rows(n)
+        return {c: [str(r[c]) for r in rows] for c in self.header if c != 'lane'}
+
+    def write_metrics(self, fh, n=None):
+        """Write the metrics of the n most common barcodes as tab-separated values
+        """
+        csvw = csv.DictWriter(fh, fieldnames=self.header, dialect=csv.excel_tab)
+        csvw.writeheader()
+        csvw.writerows(self.rows(n))
+
+def _chunks(barcodes, chunk_size):
+    """Generate lists of at most chunk_size barcodes
+    """
+    while True:
+        chunk = list(itertools.islice(barcodes, chunk_size))
+        if len(chunk) == 0:
+            break
+        yield chunk
+
+_WORKER = {}
+
+def _init_worker(capacity, excluded):
+    _WORKER['capacity'] = capacity
+    _WORKER['excluded'] = excluded
+
+def _count_chunk(chunk):
+    """Count the barcodes of a chunk, skipping the excluded barcodes
+    """
+    barcodes = np.array(chunk)
+    if len(_WORKER['excluded']) > 0:
+        barcodes = barcodes[~np.in1d(barcodes, _WORKER['excluded'])]
+    counter = SpaceSaving(_WORKER['capacity'])
+    counter.update(barcodes)
+    counter.total = len(chunk)
+    return counter
+
+def _count_shard(args):
+    """Count the barcodes in a byte range of an uncompressed fastq file
+    """
+    fqfile, start, end, casava18, offset, length, chunk_size = args
+    barcodes = itertools.chain.from_iterable(BarcodeExtractor(fqfile, casava18, offset, length, start=start, end=end).batches())
+    counter = SpaceSaving(_WORKER['capacity'])
+    for chunk in _chunks(barcodes, chunk_size):
+        counter.merge(_count_chunk(chunk))
+    return counter
+
+def count_barcodes(fqfile, casava18=True, offset=101, length=6, excluded=set(), capacity=DEFAULT_CAPACITY, workers=1, max_reads=None, chunk_size=DEFAULT_CHUNK_SIZE, lane=None, mismatch=0):
+    """Count the barcodes in a fastq file with bounded memory. The barcodes
+    are counted in chunks of chunk_size records, and the per-chunk counts are
+    merged into a SpaceSaving counter that tracks at most capacity barcodes.
+    With several workers, an uncompressed file is split into one byte range
+    per worker, whereas the barcodes of a compressed file are read in this
+    process and counted by the workers.
+
+    :param fqfile: the fastq file, possibly compressed
+    :param casava18: the barcode is in the header as for CASAVA 1.8+, see fastq_utils.index_sequences
+    :param offset: the offset of the barcode in the read for CASAVA 1.7 files, or None to
+      use the barcode in the header
+    :param length: the length of the barcode for CASAVA 1.7 files
+    :param excluded: a set of barcodes that are not counted, e.g. from exclusion_set
+    :param capacity: the maximum number of barcodes tracked
+    :param workers: the number of worker processes
+    :param max_reads: only count the barcodes of the first max_reads reads
+    :param chunk_size: the number of barcodes counted per chunk
+    :param lane: the lane of the fastq file, reported in the metrics
+    :param mismatch: the number of mismatches allowed when naming the barcodes
+
+    :returns: a BarcodeCounts object
+    """
+    excluded = np.array(sorted(excluded))
+    counter = SpaceSaving(capacity)
+    if workers > 1 and max_reads is None and not is_compressed(fqfile):
+        shards = [(fqfile, start, end, casava18, offset, length, chunk_size) for start, end in shard_offsets(fqfile, workers)]
+        pool = multiprocessing.Pool(workers, _init_worker, (capacity, excluded))
+        try:
+            for shard_counter in pool.imap_unordered(_count_shard, shards):
+                counter.merge(shard_counter)
+        finally:
+            pool.terminate()
+        return BarcodeCounts(counter, lane, mismatch)
+    barcodes = itertools.chain.from_iterable(BarcodeExtractor(fqfile, casava18, offset, length).batches())
+    if max_reads is not None:
+        barcodes = itertools.islice(barcodes, max_reads)
+    chunks = _chunks(barcodes, chunk_size)
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, _init_worker, (capacity, excluded))
+        try:
+            for chunk_counter in pool.imap_unordered(_count_chunk, chunks):
+                counter.merge(chunk_counter)
+        finally:
+            pool.terminate()
+    else:
+        _init_worker(capacity, excluded)
+        for chunk in chunks:
+            counter.merge(_count_chunk(chunk))
+    return BarcodeCounts(counter, lane, mismatch)
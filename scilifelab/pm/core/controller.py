@@ -8,6 +8,7 @@ from cement.core import interface, handler, controller, backend
 
 from scilifelab.pm.lib.help import PmHelpFormatter
 from scilifelab.utils.misc import filtered_output, query_yes_no, filtered_walk
+from scilifelab.utils.fileindex import indexed_walk
 
 class AbstractBaseController(controller.CementBaseController):
     """
@@ -206,7 +207,7 @@ class AbstractExtendedBaseController(AbstractBaseController):
         if self.pargs.input_file:
             flist = [self.pargs.input_file]
         else:
-            flist = filtered_walk(os.path.join(self._meta.root_path, self._meta.path_id), self._filter_fn)
+            flist = indexed_walk(os.path.join(self._meta.root_path, self._meta.path_id), self._filter_fn)
 
         if len(flist) == 0:
             self.app.log.info("No files matching pattern '{}' found".format(self._meta.pattern))
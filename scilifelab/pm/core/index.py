@@ -0,0 +1,72 @@
+"""Pm index module"""
+import os
+import time
+
+from cement.core import controller
+from scilifelab.pm.core.controller import AbstractBaseController
+from scilifelab.utils.fileindex import FileIndex, INDEX_FILE
+
+class IndexController(AbstractBaseController):
+    """
+    Functionality for managing the file indexes of project directories.
+    """
+    class Meta:
+        label = 'index'
+        description = 'Manage file indexes of project directories'
+        arguments = [
+            (['path'], dict(help="Directory to index, or a project name in the project root", nargs="?", default=None)),
+            ]
+
+    def _index_root(self):
+        if os.path.isdir(self.pargs.path):
+            return os.path.abspath(self.pargs.path)
+        return os.path.join(self.app.config.get("project", "root"), self.pargs.path)
+
+    @controller.expose(hide=True)
+    def default(self):
+        print self._help_text
+
+    @controller.expose(help="Index a directory from scratch")
+    def rebuild(self):
+        if not self._check_pargs(["path"]):
+            return
+        root = self._index_root()
+        if not os.path.isdir(root):
+            self.app.log.warn("No such directory {}".format(root))
+            return
+        if self.pargs.dry_run:
+            self.app.log.info("(DRY_RUN): indexing {} in {}".format(root, os.path.join(root, INDEX_FILE)))
+            return
+        t0 = time.time()
+        index = FileIndex(root)
+        n = index.rebuild()
+        self.app._output_data["stdout"].write("Indexed {} directories of {} in {:.1f} s\n".format(n, root, time.time() - t0))
+
+    @controller.expose(help="Update the index of a directory, listing only the directories modified since the last update")
+    def update(self):
+        if not self._check_pargs(["path"]):
+            return
+        index = FileIndex.find(self._index_root())
+        if index is None:
+            self.app.log.warn("No index for {}; create one with pm index rebuild".format(self._index_root()))
+            return
+        if self.pargs.dry_run:
+            self.app.log.info("(DRY_RUN): updating index of {}".format(index.root))
+            return
+        t0 = time.time()
+        n = index.update(self._index_root())
+        self.app._output_data["stdout"].write("Listed {} modified directories of {} in {:.1f} s\n".format(n, index.root, time.time() - t0))
+
+    @controller.expose(help="Show the status of the index of a directory")
+    def status(self):
+        if not self._check_pargs(["path"]):
+            return
+        index = FileIndex.find(self._index_root())
+        if index is None:
+            self.app.log.warn("No index for {}; create one with pm index rebuild".format(self._index_root()))
+            return
+        status = index.status()
+        updated = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(status["updated"])) if status["updated"] else "never"
+        self.app._output_data["stdout"].write("root\t{}\nupdated\t{}\ndirectories\t{}\nfiles\t{}\nsize\t{:.1f}G\n".format(status["root"], updated, status["dirs"], status["files"], status["size"] / 1e9))
+        for t, n in sorted(status["types"].items(), key=lambda x: -x[1]):
+            self.app._output_data["stdout"].write("files of type {}\t{}\n".format(t, n))
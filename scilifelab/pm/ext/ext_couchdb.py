@@ -1,5 +1,7 @@
 """Couchdb extension."""
-from cement.core import hook
+from cement.core import hook, controller, handler
+from scilifelab.pm.core.controller import AbstractBaseController
+from scilifelab.db.connection import STATS, DEFAULT_TIMEOUT, DEFAULT_RETRIES, get_server
 
 def add_shared_couchdb_options(app):
     """
@@ -17,12 +19,76 @@ def add_shared_couchdb_options(app):
         password = app.config.get("db", "password") 
     if app.config.has_option("db", "url"):
         url = app.config.get("db", "url") 
+    timeout = DEFAULT_TIMEOUT
+    retries = DEFAULT_RETRIES
+    if app.config.has_option("db", "timeout"):
+        timeout = app.config.get("db", "timeout")
+    if app.config.has_option("db", "retries"):
+        retries = app.config.get("db", "retries")
+    cache_dir = None
+    if app.config.has_option("db", "cache_dir"):
+        cache_dir = app.config.get("db", "cache_dir")
+    mirror = None
+    if app.config.has_option("db", "mirror"):
+        mirror = app.config.get("db", "mirror")
     group = app.args.add_argument_group('couchdb', 'Options for couchdb connections')
     group.add_argument('--url', help="Database url (excluding http://). Default '{}'".format(url), default=url, nargs="?", type=str)
     group.add_argument('--port', help="Database port. Default 5984", nargs="?", default="5984", type=str)
     group.add_argument('--username', help="Database user. Default '{}'".format(user), nargs="?", default=user, type=str)
     group.add_argument('--password', help="Database password.", default=password, type=str)
+    group.add_argument('--db_timeout', help="Database socket timeout in seconds. Default {}".format(timeout), default=timeout, type=float)
+    group.add_argument('--db_retries', help="Number of retries of idempotent database requests failing with a server error. Default {}".format(retries), default=retries, type=int)
+    group.add_argument('--db_cache_dir', help="Directory of the on-disk cache of database documents. Default '{}'".format(cache_dir), default=cache_dir, type=str)
+    group.add_argument('--no_db_cache', help="Do not cache database documents", default=False, action="store_true")
+    group.add_argument('--db_mirror', help="Directory of a local database mirror, made with 'pm db sync'. If set, database connections read from the mirror. Default '{}'".format(mirror), default=mirror, type=str)
+    group.add_argument('--db_mirror_writes', help="Save documents in the local mirror given by --db_mirror. The documents are not saved in the database. By default, saving to a mirror fails", default=False, action="store_true")
+
+def log_couchdb_stats(app):
+    """
+    Logs the number, size and latency of the couchdb requests made during the run.
+    
+    :param app: The application object.
+    
+    """
+    if STATS.requests > 0:
+        app.log.info("couchdb: {}".format(STATS.summary()))
+
+class DatabaseController(AbstractBaseController):
+    """
+    Functionality for dealing with local mirrors of statusdb.
+    """
+    class Meta:
+        label = 'db'
+        description = "Extension for dealing with local database mirrors"
+        arguments = [
+            (['--project_name'], dict(help="Only mirror the project summary, samples and flowcells of a project, as in 'J.Doe_00_01'", default=None, action="store", type=str)),
+            (['--batch_size'], dict(help="Number of documents fetched per request. Default 1000", default=1000, action="store", type=int)),
+            ]
+
+    @controller.expose(hide=True)
+    def default(self):
+        print self._help_text
+
+    @controller.expose(help="Pull the samples, flowcells and projects databases into the local mirror given by --db_mirror")
+    def sync(self):
+        # Imported here since the mirror depends on the statusdb views
+        from scilifelab.db.mirror import sync_statusdb
+        if not self._check_pargs(["db_mirror", "url"]):
+            return
+        dbnames = {dbtype:self.app.config.get("db", dbtype) for dbtype in ["samples", "flowcells", "projects"] if self.app.config.has_option("db", dbtype)}
+        if len(dbnames) == 0:
+            self.app.log.warn("No database names in the db section of the config file; aborting")
+            return
+        server = get_server("http://{}:{}".format(self.pargs.url, self.pargs.port), timeout=self.pargs.db_timeout, retries=self.pargs.db_retries)
+        if self.pargs.dry_run:
+            self.app.log.info("(DRY_RUN): syncing {} from {} to {}".format(", ".join(dbnames.values()), self.pargs.url, self.pargs.db_mirror))
+            return
+        counts = sync_statusdb(server, self.pargs.db_mirror, dbnames, project_name=self.pargs.project_name, batch_size=self.pargs.batch_size)
+        for dbtype, n in sorted(counts.items()):
+            self.app._output_data['stdout'].write("{}\t{} documents synced\n".format(dbnames[dbtype], n))
 
 def load():
     """Called by the framework when the extension is 'loaded'."""
     hook.register('post_setup', add_shared_couchdb_options)
+    hook.register('post_run', log_couchdb_stats)
+    handler.register(DatabaseController)
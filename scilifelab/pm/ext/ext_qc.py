@@ -3,21 +3,35 @@ import os
 import csv
 import yaml
 import ast
+import time
 import itertools
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
 from cement.core import backend, controller, handler, hook
 from scilifelab.utils.misc import query_yes_no
 from scilifelab.pm.core.controller import AbstractBaseController
 from scilifelab.utils.timestamp import modified_within_days
 from scilifelab.bcbio.qc import FlowcellRunMetricsParser, SampleRunMetricsParser
+from scilifelab.bcbio.qc.manifest import QCManifest, DEFAULT_MANIFEST_DIR
 from scilifelab.pm.bcbio.utils import validate_fc_directory_format, fc_id, fc_parts, fc_fullname
-from scilifelab.db.statusdb import SampleRunMetricsConnection, FlowcellRunMetricsConnection, ProjectSummaryConnection, SampleRunMetricsDocument, FlowcellRunMetricsDocument
-from scilifelab.utils.dry import dry
+from scilifelab.db.statusdb import SampleRunMetricsConnection, FlowcellRunMetricsConnection, ProjectSummaryConnection, SampleRunMetricsDocument, FlowcellRunMetricsDocument, review_matches
 import scilifelab.log
 
 LOG = scilifelab.log.minimal_logger(__name__)
 
+## Number of qc objects matched and saved per bulk request in upload_qc
+UPLOAD_BATCH_SIZE = 50
+
+def _batches(iterable, size):
+    """Split an iterable into lists of at most size items"""
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if len(batch) == 0:
+            return
+        yield batch
+
 class RunMetricsController(AbstractBaseController):
     """
     This class is an implementation of the :ref:`ICommand
@@ -32,7 +46,9 @@ class RunMetricsController(AbstractBaseController):
             (['flowcell'], dict(help="Flowcell directory", nargs="?", default=None)),
             (['--runqc'], dict(help="Root path to qc data folder", default=None, nargs="?")),
             (['--sample'], dict(help="Sample id", default=None, action="store", type=str)),
-            (['--mtime'], dict(help="Last modification time of directory (days): skip if older. Defaults to 1 day.", default=1, action="store", type=int)),
+            (['--mtime'], dict(help="Last modification time of directory (days): skip if older. Defaults to 1 day. Only applies to sample runs that are not in the qc manifest", default=1, action="store", type=int)),
+            (['--workers'], dict(help="Number of threads parsing the sample run metrics in upload_qc. Defaults to 1", default=1, action="store", type=int)),
+            (['--no_manifest'], dict(help="Do not use the qc manifest of metrics file hashes; parse and upload all sample runs modified within --mtime days", default=False, action="store_true")),
             (['--sample_prj'], dict(help="Sample project name, as in 'J.Doe_00_01'", default=None, action="store", type=str)),
             (['--project_name'], dict(help="Project name, as in 'J.Doe_00_01'", default=None, action="store", type=str)),
             (['--project_id'], dict(help="Project id, as in 'P001'", default=None, action="store", type=str)),
@@ -45,6 +61,10 @@ class RunMetricsController(AbstractBaseController):
     def _process_args(self):
         self._meta.root_path = self.app.pargs.runqc if self.app.pargs.runqc else self.app.config.get("runqc", "root")
         self._meta.production_root_path = self.app.config.get("runqc", "production") if self.app.config.has_option("runqc", "production") else self.app.config.get("runqc", "root")
+        self._meta.manifest_dir = self.app.config.get("runqc", "manifest_dir") if self.app.config.has_option("runqc", "manifest_dir") else DEFAULT_MANIFEST_DIR
+        self._meta.manifest = None
+        self._meta.timings = defaultdict(float)
+        self._meta.sample_run_parsers = {}
 
     @controller.expose(hide=True)
     def default(self):
@@ -97,8 +117,10 @@ class RunMetricsController(AbstractBaseController):
             project_name = self.pargs.sample_prj
             if self.pargs.project_alias:
                 project_name = self.pargs.project_alias
+            report = p_con.match_project_samples(project_name, [s["barcode_name"] for s in samples], extensive_matching=True)
+            matches = review_matches(report, force=self.pargs.force)
             for s in samples:
-                project_sample = p_con.get_project_sample(project_name, s["barcode_name"], extensive_matching=True)
+                project_sample = matches.get(s["barcode_name"], None)
                 if project_sample:
                     self.app.log.info("using mapping '{} : {}'...".format(s["barcode_name"], project_sample["sample_name"]))
                     s["project_sample_name"] = project_sample["sample_name"]
@@ -108,8 +130,11 @@ class RunMetricsController(AbstractBaseController):
     ## New structures
     ##############################
     def _parse_samplesheet(self, runinfo, qc_objects, fc_date, fc_name, fcdir, as_yaml=False, demultiplex_stats=None):
-        """Parse samplesheet information and populate sample run metrics object"""
+        """Parse samplesheet information and populate sample run metrics
+        object. For csv samplesheets, the sample run metrics objects are
+        generated as they are parsed, see _iter_sample_runs."""
         if as_yaml:
+            parser = SampleRunMetricsParser(fcdir)
             for info in runinfo:
                 if not info.get("multiplex", None):
                     self.app.log.warn("No multiplex information for lane {}".format(info.get("lane")))
@@ -121,8 +146,7 @@ class RunMetricsController(AbstractBaseController):
                     sample.update({k: info.get(k, None) for k in ('analysis', 'description', 'flowcell_id', 'lane')})
                     sample_kw = dict(flowcell=fc_name, date=fc_date, lane=sample['lane'], barcode_name=sample['name'], sample_prj=sample.get('sample_prj', None),
                                      barcode_id=sample['barcode_id'], sequence=sample.get('sequence', "NoIndex"))
-                
-                    parser = SampleRunMetricsParser(fcdir)
+
                     obj = SampleRunMetricsDocument(**sample_kw)
                     obj["picard_metrics"] = parser.read_picard_metrics(**sample_kw)
                     obj["fastq_scr"] = parser.parse_fastq_screen(**sample_kw)
@@ -130,43 +154,112 @@ class RunMetricsController(AbstractBaseController):
                     obj["fastqc"] = parser.read_fastqc_metrics(**sample_kw)
                     qc_objects.append(obj)
         else:
-            for sample in runinfo[1:]:
-                LOG.debug("Getting information for sample defined by {}".format(sample))
-                d = dict(zip(runinfo[0], sample))
-                if self.app.pargs.project_name and self.app.pargs.project_name != d['SampleProject']:
-                    continue
-                if self.app.pargs.sample and self.app.pargs.sample != d['SampleID']:
-                    continue
-                
-                sampledir = os.path.join(os.path.abspath(self._meta.production_root_path), d['SampleProject'].replace("__", "."), d['SampleID'])
-                if not os.path.exists(sampledir):
-                    self.app.log.warn("No such sample directory: {}".format(sampledir))
-                    continue
-                sample_fcdir = os.path.join(sampledir, fc_fullname(self.pargs.flowcell))
-                if not os.path.exists(sample_fcdir):
-                    self.app.log.warn("No such sample flowcell directory: {}".format(sample_fcdir))
-                    continue
-                if not modified_within_days(sample_fcdir, self.pargs.mtime):
-                    continue
-                runinfo_yaml_file = os.path.join(sample_fcdir, "{}-bcbb-config.yaml".format(d['SampleID']))
-                if not os.path.exists(runinfo_yaml_file):
-                    self.app.log.warn("No such yaml file for sample: {}".format(runinfo_yaml_file))
-                    raise IOError(2, "No such yaml file for sample: {}".format(runinfo_yaml_file), runinfo_yaml_file)
-                with open(runinfo_yaml_file) as fh:
-                    runinfo_yaml = yaml.load(fh)
-                if not runinfo_yaml['details'][0].get("multiplex", None):
-                    self.app.log.warn("No multiplex information for sample {}".format(d['SampleID']))
-                    continue
-                sample_kw = dict(flowcell=fc_name, date=fc_date, lane=d['Lane'], barcode_name=d['SampleID'], sample_prj=d['SampleProject'].replace("__", "."), barcode_id=runinfo_yaml['details'][0]['multiplex'][0]['barcode_id'], sequence=runinfo_yaml['details'][0]['multiplex'][0]['sequence'])
-                parser = SampleRunMetricsParser(sample_fcdir)
-                obj = SampleRunMetricsDocument(**sample_kw)
-                obj["picard_metrics"] = parser.read_picard_metrics(**sample_kw)
-                obj["fastq_scr"] = parser.parse_fastq_screen(**sample_kw)
-                obj["bc_count"] = parser.get_bc_count(demultiplex_stats=demultiplex_stats, **sample_kw)
-                obj["fastqc"] = parser.read_fastqc_metrics(**sample_kw)
-                qc_objects.append(obj)
+            return itertools.chain(qc_objects, self._iter_sample_runs(runinfo, fc_date, fc_name, demultiplex_stats))
         return qc_objects
 
+    def _iter_sample_runs(self, runinfo, fc_date, fc_name, demultiplex_stats=None):
+        """Generate the sample run metrics objects of the samples of a
+        csv samplesheet. With --workers > 1, the samples are parsed by a
+        pool of threads and the objects are generated as they finish.
+        """
+        samples = []
+        for sample in runinfo[1:]:
+            LOG.debug("Getting information for sample defined by {}".format(sample))
+            d = dict(zip(runinfo[0], sample))
+            if self.app.pargs.project_name and self.app.pargs.project_name != d['SampleProject']:
+                continue
+            if self.app.pargs.sample and self.app.pargs.sample != d['SampleID']:
+                continue
+
+            sampledir = os.path.join(os.path.abspath(self._meta.production_root_path), d['SampleProject'].replace("__", "."), d['SampleID'])
+            if not os.path.exists(sampledir):
+                self.app.log.warn("No such sample directory: {}".format(sampledir))
+                continue
+            sample_fcdir = os.path.join(sampledir, fc_fullname(self.pargs.flowcell))
+            if not os.path.exists(sample_fcdir):
+                self.app.log.warn("No such sample flowcell directory: {}".format(sample_fcdir))
+                continue
+            if self._meta.manifest is None and not modified_within_days(sample_fcdir, self.pargs.mtime):
+                continue
+            samples.append((d, sample_fcdir, fc_date, fc_name, demultiplex_stats))
+        pool = None
+        if self.pargs.workers > 1 and len(samples) > 1:
+            pool = ThreadPool(min(self.pargs.workers, len(samples)))
+            results = pool.imap_unordered(self._collect_sample_run, samples)
+        else:
+            results = itertools.imap(self._collect_sample_run, samples)
+        try:
+            for obj, timings in results:
+                for k, v in timings.items():
+                    self._meta.timings[k] += v
+                if not obj is None:
+                    yield obj
+        finally:
+            if pool:
+                pool.terminate()
+
+    def _collect_sample_run(self, args):
+        """Parse the metrics of a sample run.
+
+        :param args: tuple of samplesheet row, sample flowcell directory, flowcell date, flowcell name and demultiplex stats
+
+        :returns: tuple of the sample run metrics object, or None if there is nothing to update, and the time spent per stage
+        """
+        (d, sample_fcdir, fc_date, fc_name, demultiplex_stats) = args
+        timings = {}
+        t0 = time.time()
+        runinfo_yaml_file = os.path.join(sample_fcdir, "{}-bcbb-config.yaml".format(d['SampleID']))
+        if not os.path.exists(runinfo_yaml_file):
+            self.app.log.warn("No such yaml file for sample: {}".format(runinfo_yaml_file))
+            raise IOError(2, "No such yaml file for sample: {}".format(runinfo_yaml_file), runinfo_yaml_file)
+        with open(runinfo_yaml_file) as fh:
+            runinfo_yaml = yaml.load(fh)
+        if not runinfo_yaml['details'][0].get("multiplex", None):
+            self.app.log.warn("No multiplex information for sample {}".format(d['SampleID']))
+            return None, timings
+        sample_kw = dict(flowcell=fc_name, date=fc_date, lane=d['Lane'], barcode_name=d['SampleID'], sample_prj=d['SampleProject'].replace("__", "."), barcode_id=runinfo_yaml['details'][0]['multiplex'][0]['barcode_id'], sequence=runinfo_yaml['details'][0]['multiplex'][0]['sequence'])
+        parser = self._sample_run_parser(sample_fcdir)
+        obj = SampleRunMetricsDocument(**sample_kw)
+        t1 = time.time()
+        timings["walk"] = t1 - t0
+        if self._meta.manifest is not None:
+            changed = self._sample_run_changed(obj, sample_fcdir, parser.metrics_files(), demultiplex_stats)
+            timings["manifest"] = time.time() - t1
+            if not changed:
+                self.app.log.debug("Metrics files of {} unchanged since last upload; skipping".format(obj["name"]))
+                return None, timings
+        t1 = time.time()
+        obj["picard_metrics"] = parser.read_picard_metrics(**sample_kw)
+        obj["fastq_scr"] = parser.parse_fastq_screen(**sample_kw)
+        obj["bc_count"] = parser.get_bc_count(demultiplex_stats=demultiplex_stats, **sample_kw)
+        obj["fastqc"] = parser.read_fastqc_metrics(**sample_kw)
+        timings["parse"] = time.time() - t1
+        return obj, timings
+
+    def _sample_run_parser(self, sample_fcdir):
+        """Get the metrics parser of a sample flowcell directory, walking
+        the directory once for all the lanes of the sample"""
+        parser = self._meta.sample_run_parsers.get(sample_fcdir, None)
+        if parser is None:
+            parser = self._meta.sample_run_parsers.setdefault(sample_fcdir, SampleRunMetricsParser(sample_fcdir))
+        return parser
+
+    def _open_manifest(self, fcdir):
+        """Open the qc manifest of a flowcell, stored in the runqc
+        manifest_dir if configured and in ~/.pm/qc_manifest otherwise"""
+        if self.pargs.no_manifest:
+            return None
+        return QCManifest(os.path.join(self._meta.manifest_dir, "{}.json".format(os.path.basename(fcdir.rstrip(os.sep)))))
+
+    def _sample_run_changed(self, obj, sample_fcdir, files, demultiplex_stats=None):
+        """Check if the metrics files of a sample run have changed since
+        the last upload. Sample runs that are not in the manifest fall
+        back on the modification time of the sample flowcell directory.
+        """
+        if not self._meta.manifest.known(obj["name"]) and not modified_within_days(sample_fcdir, self.pargs.mtime):
+            return False
+        return self._meta.manifest.inputs_changed(obj["name"], files, demultiplex_stats)
+
     def _collect_pre_casava_qc(self):
         qc_objects = []
         as_yaml = False
@@ -189,6 +282,7 @@ class RunMetricsController(AbstractBaseController):
             raise e
         fcdir = os.path.abspath(self.pargs.flowcell)
         (fc_date, fc_name) = fc_parts(self.pargs.flowcell)
+        self._meta.manifest = self._open_manifest(fcdir)
         ## Check modification time
         if modified_within_days(fcdir, self.pargs.mtime):
             fc_kw = dict(fc_date = fc_date, fc_name=fc_name)
@@ -222,6 +316,7 @@ class RunMetricsController(AbstractBaseController):
             raise e
         fcdir = os.path.join(os.path.abspath(self._meta.root_path), self.pargs.flowcell)
         (fc_date, fc_name) = fc_parts(self.pargs.flowcell)
+        self._meta.manifest = self._open_manifest(fcdir)
         ## Check modification time
         demux_stats = None
         if modified_within_days(fcdir, self.pargs.mtime):
@@ -262,25 +357,78 @@ class RunMetricsController(AbstractBaseController):
             self.log.info("Assuming casava based file structure for {}".format(fc_id(self.pargs.flowcell)))
             qc_objects = self._collect_casava_qc()
 
-        if len(qc_objects) == 0:
+        manifest = self._meta.manifest
+        cons = None
+        n_objects, n_unchanged, n_saved = 0, 0, 0
+        for batch in _batches(qc_objects, UPLOAD_BATCH_SIZE):
+            if cons is None:
+                s_con = SampleRunMetricsConnection(dbname=self.app.config.get("db", "samples"), **vars(self.app.pargs))
+                fc_con = FlowcellRunMetricsConnection(dbname=self.app.config.get("db", "flowcells"), **vars(self.app.pargs))
+                p_con = ProjectSummaryConnection(dbname=self.app.config.get("db", "projects"), **vars(self.app.pargs))
+                cons = (s_con, fc_con, p_con)
+            n_objects += len(batch)
+            (saved, unchanged) = self._upload_qc_objects(batch, *cons)
+            n_saved += saved
+            n_unchanged += unchanged
+        if n_objects == 0:
             self.log.info("No out-of-date qc objects for {}".format(fc_id(self.pargs.flowcell)))
-            return
         else:
-            self.log.info("Retrieved {} updated qc objects".format(len(qc_objects)))
+            self.log.info("Retrieved {} updated qc objects; saved {}, skipped {} unchanged since the last upload".format(n_objects, n_saved, n_unchanged))
+        if manifest is not None:
+            manifest.save()
+            self.log.info("qc manifest: {}".format(manifest.summary()))
+        self.log.info("Time spent per stage (s, summed over workers): {}".format(", ".join("{} {:.2f}".format(k, v) for k, v in sorted(self._meta.timings.items()))))
 
-        s_con = SampleRunMetricsConnection(dbname=self.app.config.get("db", "samples"), **vars(self.app.pargs))
-        fc_con = FlowcellRunMetricsConnection(dbname=self.app.config.get("db", "flowcells"), **vars(self.app.pargs))
-        p_con = ProjectSummaryConnection(dbname=self.app.config.get("db", "projects"), **vars(self.app.pargs))
+    def _upload_qc_objects(self, qc_objects, s_con, fc_con, p_con):
+        """Match the sample runs of a batch of qc objects to project
+        samples and save the objects with one bulk request per database.
+
+        :returns: tuple of the number of objects saved and the number of objects unchanged since the last upload
+        """
+        manifest = self._meta.manifest
+        fc_objects = []
+        sample_objects = []
         for obj in qc_objects:
             if self.app.pargs.debug:
                 self.log.debug("{}: {}".format(str(obj), obj["_id"]))
             if isinstance(obj, FlowcellRunMetricsDocument):
-                dry("Saving object {}".format(repr(obj)), fc_con.save(obj))
+                fc_objects.append(obj)
             if isinstance(obj, SampleRunMetricsDocument):
-                project_sample = p_con.get_project_sample(obj.get("sample_prj", None), obj.get("barcode_name", None), self.pargs.extensive_matching)
+                sample_objects.append(obj)
+        t0 = time.time()
+        # Match the barcode names of all samples of a project in one go
+        for sample_prj, objs in itertools.groupby(sorted(sample_objects, key=lambda x: x.get("sample_prj", None)), key=lambda x: x.get("sample_prj", None)):
+            objs = list(objs)
+            report = p_con.match_project_samples(sample_prj, [obj.get("barcode_name", None) for obj in objs], self.pargs.extensive_matching)
+            matches = review_matches(report, force=self.pargs.force)
+            for obj in objs:
+                project_sample = matches.get(obj.get("barcode_name", None), None)
                 if project_sample:
                     obj["project_sample_name"] = project_sample['sample_name']
-                dry("Saving object {}".format(repr(obj)), s_con.save(obj))
+        t1 = time.time()
+        self._meta.timings["match"] += t1 - t0
+        n_unchanged, n_saved = 0, 0
+        for con, objs in [(fc_con, fc_objects), (s_con, sample_objects)]:
+            if manifest is not None:
+                # Documents identical to the last upload need not be compared with the database
+                changed = [manifest.document_changed(obj) for obj in objs]
+                for obj in itertools.compress(objs, [not x for x in changed]):
+                    manifest.commit(obj["name"])
+                n_unchanged += changed.count(False)
+                objs = list(itertools.compress(objs, changed))
+            if len(objs) == 0:
+                continue
+            status = con.save_many(objs)
+            failed = [k for k, v in status.items() if v not in ["saved", "unchanged"]]
+            if len(failed) > 0:
+                self.log.warn("Failed to save {} of {} objects: {}".format(len(failed), len(objs), ", ".join(failed)))
+            n_saved += status.values().count("saved")
+            if manifest is not None:
+                for obj in objs:
+                    if obj["_id"] not in failed:
+                        manifest.commit(obj["name"])
+        self._meta.timings["upload"] += time.time() - t1
+        return n_saved, n_unchanged
 
     @controller.expose(help="Perform a multiplex QC")
     def multiplex_qc(self):
@@ -8,6 +8,7 @@ import math
 from cStringIO import StringIO
 from collections import Counter
 from scilifelab.db.statusdb import SampleRunMetricsConnection, ProjectSummaryConnection, FlowcellRunMetricsConnection, calc_avg_qv
+from scilifelab.db import db_options
 from scilifelab.utils.misc import query_ok
 from scilifelab.report import sequencing_success
 from scilifelab.report.rst import make_sample_rest_notes, make_rest_note
@@ -244,9 +245,9 @@ def sample_status_note(project_name=None, flowcell=None, username=None, password
     output_data = _update_sample_output_data(output_data, cutoffs)
 
     # Connect and run
-    s_con = SampleRunMetricsConnection(dbname=samplesdb, username=username, password=password, url=url)
-    fc_con = FlowcellRunMetricsConnection(dbname=flowcelldb, username=username, password=password, url=url)
-    p_con = ProjectSummaryConnection(dbname=projectdb, username=username, password=password, url=url)
+    s_con = SampleRunMetricsConnection(dbname=samplesdb, username=username, password=password, url=url, **db_options(kw))
+    fc_con = FlowcellRunMetricsConnection(dbname=flowcelldb, username=username, password=password, url=url, **db_options(kw))
+    p_con = ProjectSummaryConnection(dbname=projectdb, username=username, password=password, url=url, **db_options(kw))
 
     # Set up paragraphs
     paragraphs = sample_note_paragraphs()
@@ -452,9 +453,9 @@ def project_status_note(project_name=None, username=None, password=None, url=Non
 
     output_data = {'stdout':StringIO(), 'stderr':StringIO(), 'debug':StringIO()}
     # Connect and run
-    s_con = SampleRunMetricsConnection(dbname=samplesdb, username=username, password=password, url=url)
-    fc_con = FlowcellRunMetricsConnection(dbname=flowcelldb, username=username, password=password, url=url)
-    p_con = ProjectSummaryConnection(dbname=projectdb, username=username, password=password, url=url)
+    s_con = SampleRunMetricsConnection(dbname=samplesdb, username=username, password=password, url=url, **db_options(kw))
+    fc_con = FlowcellRunMetricsConnection(dbname=flowcelldb, username=username, password=password, url=url, **db_options(kw))
+    p_con = ProjectSummaryConnection(dbname=projectdb, username=username, password=password, url=url, **db_options(kw))
 
     # Set report paragraphs
     paragraphs = project_note_paragraphs()
@@ -1,11 +1,14 @@
 """report qc module"""
 import os
 import yaml
+import numpy as np
+import pandas as pd
 
 from collections import OrderedDict
 from cStringIO import StringIO
 
-from scilifelab.db.statusdb import SampleRunMetricsConnection, ProjectSummaryConnection, FlowcellRunMetricsConnection, get_qc_data
+from scilifelab.db.statusdb import SampleRunMetricsConnection, ProjectSummaryConnection, get_qc_frame
+from scilifelab.db import db_options
 from scilifelab.bcbio.qc import SampleRunMetricsParser
 from scilifelab.log import minimal_logger
 from scilifelab.bcbio.run import find_samples
@@ -68,13 +71,6 @@ def _srm_to_qc(srm, application=None):
         qcdata["PERCENT_ON_TARGET"] = float(qcdata["FOLD_ENRICHMENT"]/ (float(qcdata["GENOME_SIZE"]) / float(target_territory))) * 100
     return qcdata
 
-def _get_sample_qc_data(sample_prj, application, s_con, fc_id=None):
-    samples = s_con.get_samples(fc_id=fc_id, sample_prj=sample_prj)
-    qcdata = {}
-    for s in samples:
-        qcdata[s["name"]]=_srm_to_qc(s)
-    return qcdata
-
 def assess_qc(x, application):
     status = "PASS"
     dup_status = "OK"
@@ -86,6 +82,30 @@ def assess_qc(x, application):
         else:
             if float(x[k]) < QC_CUTOFF[application][k]:
                 status = "FAIL"
+    return format_qc(x, dup_status, status)
+
+def assess_qc_frame(df, application):
+    """Assess the qc metrics of all samples of a qc frame (see
+    statusdb.get_qc_frame) at once, adding the dup_status and status
+    columns
+
+    :param df: qc frame
+    :param application: application for which to perform qc
+
+    :returns: the qc frame
+    """
+    failed = pd.Series(False, index=df.index)
+    df["dup_status"] = "OK"
+    for k, cutoff in QC_CUTOFF[application].items():
+        if k == "PERCENT_DUPLICATION":
+            df.loc[df[k].astype(float) > cutoff, "dup_status"] = "HIGH"
+        else:
+            failed |= df[k].astype(float) < cutoff
+    df["status"] = np.where(failed, "FAIL", "PASS")
+    return df
+
+def format_qc(x, dup_status, status):
+    """Format the qc metrics and status of a sample as report columns"""
     return ["{:20}".format(x["sample"]),
             "{:>5}".format(x["lane"]),
             "{:>11}".format(x["flowcell"]),
@@ -173,13 +193,12 @@ def application_qc(project_name=None, flowcell=None, application=None,
     LOG.debug("Doing application qc for project {}, flowcell {}".format(project_name, flowcell))
 
     output_data = {'stdout':StringIO(), 'stderr':StringIO()}
-    p_con = ProjectSummaryConnection(dbname=projectdb, username=username, password=password, url=url)
-    s_con = SampleRunMetricsConnection(dbname=sampledb, username=username, password=password, url=url)
+    p_con = ProjectSummaryConnection(dbname=projectdb, username=username, password=password, url=url, **db_options(kw))
+    s_con = SampleRunMetricsConnection(dbname=sampledb, username=username, password=password, url=url, **db_options(kw))
     prj_summary = p_con.get_entry(project_name)
-    qc_data = get_qc_data(project_name, p_con, s_con, flowcell)
 
     if not prj_summary is None:
-        qc_data = get_qc_data(project_name, p_con, s_con, flowcell)
+        qc_data = get_qc_frame(project_name, p_con, s_con, flowcell)
         if prj_summary.get("application") not in APPLICATION_MAP.keys():
             if not application:
                 LOG.warn("No such application {}. Please use the application option (available choices {})".format(application, ",".join(QC_CUTOFF.keys())))
@@ -192,11 +211,12 @@ def application_qc(project_name=None, flowcell=None, application=None,
         if not application:
             LOG.warn("No application provided. Please use the application option (available choices {})".format(",".join(QC_CUTOFF.keys())))
             return output_data
-        qc_data = _get_sample_qc_data(project_name, application, s_con, flowcell)
+        qc_data = get_qc_frame(project_name, p_con, s_con, flowcell)
 
     output_data = _qc_info_header(project_name, application, output_data)
-    for k,v in sorted(qc_data.iteritems()):
-        y = [str(x) for x in assess_qc(v, application)]
+    qc_data = assess_qc_frame(qc_data, application).sort_index()
+    for x in qc_data.to_dict("records"):
+        y = [str(y) for y in format_qc(x, x["dup_status"], x["status"])]
         output_data["stdout"].write("".join(y) + "\n")
     return output_data
 
@@ -213,7 +233,7 @@ def fastq_screen(project_name=None, flowcell=None,
     """
     LOG.debug("Running fastq screen summary on project {}, flowcell ".format(project_name, flowcell))
     output_data = {'stdout':StringIO(), 'stderr':StringIO()}
-    s_con = SampleRunMetricsConnection(dbname=dbname, username=username, password=password, url=url)
+    s_con = SampleRunMetricsConnection(dbname=dbname, username=username, password=password, url=url, **db_options(kw))
     samples = s_con.get_samples(fc_id=flowcell, sample_prj=project_name)
     for s in samples:
         LOG.debug("Checking fastq_screen data for sample {}, id {}, project {}".format(s.get("name", None), s.get("_id", None), s.get("sample_prj", None)))
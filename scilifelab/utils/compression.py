@@ -0,0 +1,243 @@
+"""Compression layer for reading and writing possibly compressed files.
+
+Files are compressed or decompressed based on their extension, using
+one of the following methods:
+
+ - ``process``: pipe through an external parallel program (``pigz`` or
+   ``pbzip2``)
+ - ``threads``: compress gzip output as a series of gzip members in a
+   pool of threads (reading falls back to ``builtin``)
+ - ``builtin``: use the single-threaded :mod:`gzip` or :mod:`bz2` modules
+
+By default, files are read with the first available method in the list
+above, and gzip output is compressed in a thread pool shared by all
+writers, so that many open outputs do not each start an external program
+on all cores. The output of all methods is readable by the standard
+command line tools.
+"""
+import os
+import bz2
+import gzip
+import zlib
+import tempfile
+import subprocess
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from distutils.spawn import find_executable
+import scilifelab.log
+
+LOG = scilifelab.log.minimal_logger(__name__)
+
+# External parallel programs, keyed by file extension
+PARALLEL_PROGRAMS = {'.gz': 'pigz',
+                     '.bz2': 'pbzip2'}
+
+# Builtin single-threaded modules, keyed by file extension
+BUILTIN_MODULES = {'.gz': gzip.GzipFile,
+                   '.bz2': bz2.BZ2File}
+
+METHODS = ['process', 'threads', 'builtin']
+
+# Size of the uncompressed blocks compressed as separate gzip members
+DEFAULT_BLOCKSIZE = 1024*1024
+
+_POOL = None
+
+def _shared_pool():
+    """Return the thread pool shared by all ParallelGzipWriters in the process
+    """
+    global _POOL
+    if _POOL is None:
+        _POOL = ThreadPool(multiprocessing.cpu_count())
+    return _POOL
+
+def _compress_member(data, level):
+    """Compress data as a complete gzip member
+    """
+    c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(data) + c.flush()
+
+class ProcessFile:
+    """File-like object wrapping an external (de)compression program. In
+       read mode, the decompressed file contents are read from the program's
+       stdout. In write or append mode, data is written to the program's stdin 
+       and the compressed output is written or appended to the file. The
+       program's stderr goes to a temporary file, which is reported if the
+       program fails."""
+
+    def __init__(self, fname, mode="r", program="pigz", threads=None):
+        self.fname = fname
+        self.mode = mode
+        self.program = program
+        self._stderr = tempfile.TemporaryFile()
+        if mode.startswith("r"):
+            cl = [program, "-d", "-c", fname]
+            self._proc = subprocess.Popen(cl, stdout=subprocess.PIPE, stderr=self._stderr)
+            self._fh = self._proc.stdout
+        else:
+            cl = [program, "-c"]
+            if threads is not None:
+                cl.append("-p{}".format(threads))
+            self._out = open(fname, "{}b".format(mode[0]))
+            self._proc = subprocess.Popen(cl, stdin=subprocess.PIPE, stdout=self._out, stderr=self._stderr)
+            self._fh = self._proc.stdin
+        self.closed = False
+
+    def read(self, size=-1):
+        data = self._fh.read(size)
+        if len(data) == 0 and self._proc.wait() != 0:
+            raise IOError("{} failed to decompress {}: {}".format(self.program, self.fname, self._errors()))
+        return data
+
+    def _errors(self):
+        self._stderr.seek(0)
+        return self._stderr.read().strip()
+
+    def readline(self, size=-1):
+        return self._fh.readline(size)
+
+    def write(self, data):
+        self._fh.write(data)
+
+    def seek(self, offset, whence=0):
+        raise IOError("seek is not supported on {} when piping through an external program".format(self.fname))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._fh.close()
+        if self.mode.startswith("r"):
+            # The program may still be running if the input was not read to the end
+            if self._proc.poll() is None:
+                self._proc.terminate()
+            self._proc.wait()
+            self._stderr.close()
+            return
+        retval = self._proc.wait()
+        self._out.close()
+        errors = self._errors()
+        self._stderr.close()
+        if retval != 0:
+            raise IOError("{} failed to compress {}: {}".format(self.program, self.fname, errors))
+
+class ParallelGzipWriter:
+    """Writes gzip-compressed output as a series of gzip members. Data
+       is collected into blocks that are compressed independently in a
+       pool of threads and written to the file in order. The concatenated
+       members form a valid gzip file, so output can also be appended to an
+       existing gzip file."""
+
+    def __init__(self, fname, level=6, blocksize=DEFAULT_BLOCKSIZE, pool=None, append=False):
+        self.fname = fname
+        self.level = level
+        self.blocksize = blocksize
+        self._pool = pool or _shared_pool()
+        self._fh = open(fname, "ab" if append else "wb")
+        self._buffer = []
+        self._buffered = 0
+        self._pending = collections.deque()
+        self._members = 0
+        # Limit the number of blocks held in memory
+        self._max_pending = 2*multiprocessing.cpu_count()
+        self.closed = False
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.blocksize:
+            self._submit()
+
+    def _submit(self):
+        data = "".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._pending.append(self._pool.apply_async(_compress_member, (data, self.level)))
+        self._drain(self._max_pending)
+
+    def _drain(self, max_pending=0):
+        """Write finished members to file, waiting for the oldest ones
+        while more than max_pending are pending
+        """
+        while len(self._pending) > 0 and (self._pending[0].ready() or len(self._pending) > max_pending):
+            self._fh.write(self._pending.popleft().get())
+            self._members += 1
+
+    def flush(self):
+        if self._buffered > 0:
+            self._submit()
+        self._drain()
+        self._fh.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        # Always write at least one member so that the output is a valid gzip file
+        if self._buffered > 0 or self._members + len(self._pending) == 0:
+            self._submit()
+        self._drain()
+        self._fh.close()
+        self.closed = True
+
+def _extension(fname):
+    return os.path.splitext(fname)[1]
+
+def _resolve_method(fname, method, mode):
+    """Return the compression method to use for fname, falling back to the
+    next available method if the requested one is not available. Gzip
+    output defaults to the shared thread pool.
+    """
+    ext = _extension(fname)
+    if ext not in BUILTIN_MODULES:
+        return None
+    if method is None:
+        method = "threads" if not mode.startswith("r") and ext == ".gz" else METHODS[0]
+    if method not in METHODS:
+        raise ValueError("unknown compression method '{}', must be one of {}".format(method, ", ".join(METHODS)))
+    if method == "process" and find_executable(PARALLEL_PROGRAMS[ext]) is None:
+        LOG.debug("{} not found, falling back to the next compression method".format(PARALLEL_PROGRAMS[ext]))
+        method = "threads"
+    if method == "threads" and (mode.startswith("r") or ext != ".gz"):
+        method = "builtin"
+    return method
+
+def open_input(fname, method=None):
+    """Open a possibly compressed file for reading. The compression is
+    determined from the file extension.
+
+    :param fname: file name
+    :param method: compression method, one of METHODS. Defaults to the first available.
+
+    :returns: a file-like object
+    """
+    method = _resolve_method(fname, method, "r")
+    if method is None:
+        return open(fname, "rb")
+    if method == "process":
+        return ProcessFile(fname, "r", PARALLEL_PROGRAMS[_extension(fname)])
+    return BUILTIN_MODULES[_extension(fname)](fname, "rb")
+
+def open_output(fname, method=None, threads=None, append=False):
+    """Open a file for writing, compressing the output if the file
+    extension is .gz or .bz2. When appending to a compressed file, the
+    output is written as a new gzip member or bzip2 stream.
+
+    :param fname: file name
+    :param method: compression method, one of METHODS. Defaults to threads for gzip and to the first available otherwise.
+    :param threads: number of threads used by an external program. Defaults to all cores.
+    :param append: append to the file instead of truncating it
+
+    :returns: a file-like object
+    """
+    mode = "a" if append else "w"
+    method = _resolve_method(fname, method, mode)
+    if method is None:
+        return open(fname, "{}b".format(mode))
+    if method == "process":
+        return ProcessFile(fname, mode, PARALLEL_PROGRAMS[_extension(fname)], threads)
+    if method == "threads":
+        return ParallelGzipWriter(fname, append=append)
+    if append and _extension(fname) == ".bz2":
+        raise ValueError("appending to {} requires {}".format(fname, PARALLEL_PROGRAMS[".bz2"]))
+    return BUILTIN_MODULES[_extension(fname)](fname, "{}b".format(mode))
@@ -1,52 +1,140 @@
 """Utilities for handling FastQ data"""
 import gzip
+import bz2
+import zlib
 import os
+import csv
+import shutil
+import hashlib
+import tempfile
+import itertools
+import collections
+import numpy as np
 from scilifelab.illumina.hiseq import HiSeqRun
+from scilifelab.utils.compression import open_input, open_output
+from scilifelab.utils.string import hamming_neighbours
          
+# Number of bytes pulled from the underlying file handle per block
+DEFAULT_BLOCKSIZE = 4*1024*1024
+
+class FastQBlockReader:
+    """Block-based reader for fastq data. Reads the underlying file handle
+       in large chunks and slices the complete records out of each chunk
+       in one go. Iterates over batches of records, where each record is a 
+       tuple with 4 elements corresponding to 1) Header, 2) Nucleotide 
+       sequence, 3) Optional header, 4) Qualities. A partial record at the 
+       end of a chunk is carried over to the next one. If limit is given,
+       at most limit bytes are read from the file handle."""
+    
+    def __init__(self,fh,blocksize=DEFAULT_BLOCKSIZE,limit=None):
+        self._fh = fh
+        self.blocksize = blocksize
+        self.limit = limit
+        self.reset()
+        
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        batch = self.read_batch()
+        if len(batch) == 0:
+            raise StopIteration
+        return batch
+    
+    def reset(self):
+        """Discard any buffered data, e.g. after seeking in the underlying file handle
+        """
+        self._remainder = ""
+        self._eof = False
+        self._left = self.limit
+        
+    def read_batch(self):
+        """Return a list with the complete records in the next block. An empty 
+        list is returned when the end of the file has been reached. A truncated 
+        record at the end of the file is ignored.
+        """
+        while not self._eof:
+            if self._left is None:
+                block = self._fh.read(self.blocksize)
+            else:
+                block = self._fh.read(min(self.blocksize,self._left))
+                self._left -= len(block)
+            chunk = self._remainder + block
+            if len(block) == 0:
+                self._eof = True
+                if not chunk.endswith("\n"):
+                    chunk += "\n"
+            lines = chunk.split("\n")
+            # The last element is the (possibly empty) partial line following the last newline
+            n = 4*((len(lines) - 1)/4)
+            self._remainder = "\n".join(lines[n:])
+            if n == 0:
+                continue
+            if "\r" in chunk:
+                lines = [l.strip() for l in lines[0:n]]
+            return zip(lines[0:n:4],lines[1:n:4],lines[2:n:4],lines[3:n:4])
+        return []
+    
 class FastQParser:
-    """Parser for fastq files, possibly compressed with gzip. 
+    """Parser for fastq files, possibly compressed with gzip or bzip2. 
        Iterates over one record at a time. A record consists 
        of a list with 4 elements corresponding to 1) Header, 
-       2) Nucleotide sequence, 3) Optional header, 4) Qualities"""
+       2) Nucleotide sequence, 3) Optional header, 4) Qualities.
+       The file is read in blocks by a FastQBlockReader and whole 
+       batches of records can be obtained with the batches method.
+       The compression method is one of compression.METHODS"""
     
-    def __init__(self,file,filter=None):
+    def __init__(self,file,filter=None,blocksize=DEFAULT_BLOCKSIZE,compression=None):
         self.fname = file
         self.filter = filter
-        fh = open(file,"rb")
-        if file.endswith(".gz"):
-            self._fh = gzip.GzipFile(fileobj=fh)
-        else:
-            self._fh = fh
+        self._fh = open_input(file,compression)
+        self._reader = FastQBlockReader(self._fh,blocksize)
+        self._next_record = iter([]).next
         self._records_read = 0
-        self._next = self.setup_next()
         
     def __iter__(self):
         return self
     
     def next(self):
-        return self._next(self)
+        try:
+            record = self._next_record()
+        except StopIteration:
+            self._next_record = iter(self._next_batch()).next
+            record = self._next_record()
+        self._records_read += 1
+        return list(record)
 
-    def setup_next(self):
-        """Return the function to return the next record
+    def _next_batch(self):
+        """Return the next non-empty batch of records passing the filter. Raises
+        StopIteration when the file has been exhausted
         """
-        if self.filter is None or len(self.filter.keys()) == 0:
-            def _next(self):
-                self._records_read += 1
-                return [self._fh.next().strip() for n in range(4)]
-        else:
-            def _next(self):
-                while True:
-                    record = [self._fh.next().strip() for n in range(4)]
-                    header = parse_header(record[0])
-                    skip = False
-                    for k, v in self.filter.items():
-                        if k in header and header[k] not in v:
-                            skip = True
-                            break
-                    if not skip:
-                        self._records_read += 1
-                        return record 
-        return _next
+        while True:
+            batch = self._reader.next()
+            if self.filter is not None and len(self.filter.keys()) > 0:
+                batch = [record for record in batch if self._keep(record)]
+            if len(batch) > 0:
+                return batch
+    
+    def _keep(self,record):
+        header = parse_header(record[0])
+        for k, v in self.filter.items():
+            if k in header and header[k] not in v:
+                return False
+        return True
+    
+    def batches(self):
+        """Iterate over batches of records passing the filter. Each record in a 
+        batch is a tuple with the 4 fastq lines
+        """
+        pending = list(iter(self._next_record,None))
+        self._next_record = iter([]).next
+        if len(pending) > 0:
+            self._records_read += len(pending)
+            yield pending
+        while True:
+            batch = self._next_batch()
+            self._records_read += len(batch)
+            yield batch
     
     def name(self):
         return self.fname
@@ -56,6 +144,8 @@ class FastQParser:
 
     def seek(self,offset,whence=None):
         self._fh.seek(offset,whence)
+        self._reader.reset()
+        self._next_record = iter([]).next
         
     def close(self):
         self._fh.close()
@@ -63,16 +153,13 @@ class FastQParser:
 class FastQWriter:
     """Writes fastq records, where each record is a list with 4 elements
        corresponding to 1) Header, 2) Nucleotide sequence, 3) Optional header, 
-       4) Qualities. If the supplied filename ends with .gz, the output file 
-       will be compressed with gzip"""
+       4) Qualities. If the supplied filename ends with .gz or .bz2, the output 
+       file will be compressed with gzip or bzip2, using the compression method 
+       (one of compression.METHODS) and number of threads, if given"""
        
-    def __init__(self,file):
+    def __init__(self,file,compression=None,threads=None):
         self.fname = file
-        fh = open(file,"wb")
-        if file.endswith(".gz"):
-            self._fh = gzip.GzipFile(fileobj=fh)
-        else:    
-            self._fh = fh
+        self._fh = open_output(file,compression,threads)
         self._records_written = 0
         
     def name(self):
@@ -88,55 +175,235 @@ class FastQWriter:
     def close(self):
         self._fh.close()
 
+# Default limits for the FastQWriterPool
+DEFAULT_MAX_OPEN = 64
+DEFAULT_BUFFER_SIZE = 4*1024*1024
+DEFAULT_MAX_BUFFERED = 256*1024*1024
+
+class FastQWriterPool:
+    """Writes fastq records to a large number of output files. Records are
+       buffered in memory per output file and written in large batches. At 
+       most max_open files are kept open at any time; the least recently 
+       written file is closed when another one needs to be opened and is 
+       later reopened in append mode (gzip output gets a new gzip member).
+       The number of records and (uncompressed) bytes written is kept per 
+       output file."""
+    
+    def __init__(self,max_open=DEFAULT_MAX_OPEN,buffer_size=DEFAULT_BUFFER_SIZE,max_buffered=DEFAULT_MAX_BUFFERED,compression=None,threads=None):
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        self.max_buffered = max_buffered
+        self.compression = compression
+        self.threads = threads
+        self._handles = collections.OrderedDict()
+        self._buffers = {}
+        self._buffered = {}
+        self._total_buffered = 0
+        self._records = {}
+        self._bytes = {}
+        self._created = set()
+        
+    def writer(self,fname):
+        """Return a FastQWriter-like object writing to fname through the pool
+        """
+        self._add(fname)
+        return PooledFastQWriter(self,fname)
+    
+    def _add(self,fname):
+        if fname not in self._buffers:
+            self._buffers[fname] = []
+            self._buffered[fname] = 0
+            self._records[fname] = 0
+            self._bytes[fname] = 0
+    
+    def write(self,fname,record):
+        """Buffer a record for writing to fname
+        """
+        data = "{}\n".format("\n".join([r.strip() for r in record]))
+        if fname not in self._buffers:
+            self._add(fname)
+        self._buffers[fname].append(data)
+        self._buffered[fname] += len(data)
+        self._total_buffered += len(data)
+        self._records[fname] += 1
+        self._check_buffers(fname)
+    
+    def write_batch(self,fname,records):
+        """Buffer a batch of records for writing to fname. Unlike write, the
+        fields of the records are written as-is, so they should not contain 
+        line breaks, e.g. records as returned by FastQParser.batches
+        """
+        if len(records) == 0:
+            return
+        data = "{}\n".format("\n".join(["\n".join(r) for r in records]))
+        if fname not in self._buffers:
+            self._add(fname)
+        self._buffers[fname].append(data)
+        self._buffered[fname] += len(data)
+        self._total_buffered += len(data)
+        self._records[fname] += len(records)
+        self._check_buffers(fname)
+    
+    def _check_buffers(self,fname):
+        if self._buffered[fname] >= self.buffer_size:
+            self.flush(fname)
+        elif self._total_buffered >= self.max_buffered:
+            self.flush(max(self._buffered.iterkeys(), key=self._buffered.get))
+    
+    def _handle(self,fname):
+        """Return an open file handle to fname, closing the least recently
+        used handle if the limit of open files has been reached
+        """
+        fh = self._handles.pop(fname,None)
+        if fh is None:
+            while len(self._handles) >= self.max_open:
+                self._handles.popitem(last=False)[1].close()
+            fh = open_output(fname,self.compression,self.threads,append=(fname in self._created))
+            self._created.add(fname)
+        self._handles[fname] = fh
+        return fh
+    
+    def flush(self,fname=None):
+        """Write the buffered records for fname, or for all files if fname is None
+        """
+        if fname is None:
+            for fname in self._buffers.keys():
+                self.flush(fname)
+            return
+        if self._buffered[fname] == 0:
+            return
+        data = "".join(self._buffers[fname])
+        self._handle(fname).write(data)
+        self._bytes[fname] += len(data)
+        self._total_buffered -= self._buffered[fname]
+        self._buffers[fname] = []
+        self._buffered[fname] = 0
+    
+    def close_file(self,fname):
+        """Flush and close fname. The file is created even if no records were written to it
+        """
+        self._add(fname)
+        self.flush(fname)
+        if fname not in self._created:
+            self._handle(fname)
+        fh = self._handles.pop(fname,None)
+        if fh is not None:
+            fh.close()
+    
+    def close(self):
+        """Flush and close all files
+        """
+        for fname in self._buffers.keys():
+            self.close_file(fname)
+    
+    def rwritten(self,fname):
+        return self._records[fname]
+    
+    def stats(self):
+        """Return a dict with the number of records and bytes written per output file
+        """
+        return dict([(fname, {'records': self._records[fname], 'bytes': self._bytes[fname] + self._buffered[fname]}) for fname in self._buffers.keys()])
+
+class PooledFastQWriter:
+    """A FastQWriter interface to a single output file of a FastQWriterPool"""
+    
+    def __init__(self,pool,file):
+        self.pool = pool
+        self.fname = file
+        
+    def name(self):
+        return self.fname
+    
+    def write(self,record):
+        self.pool.write(self.fname,record)
+    
+    def rwritten(self):
+        return self.pool.rwritten(self.fname)
+    
+    def close(self):
+        self.pool.close_file(self.fname)
+
 class BarcodeExtractor():
-    """Parse a FastQ-file and extract the barcode assumed to be at the 
-       given offset and of specified length
+    """Parse a FastQ-file and extract the barcodes of the records, as
+       returned by index_sequences. Iterates over one barcode at a time, 
+       or over lists of barcodes with the batches method. For uncompressed
+       files, the extraction can be restricted to the records in the byte 
+       range from start to end, which should be record boundaries.
     """
     
-    def __init__(self,  fqfile, casava18=True, offset=101, length=6):
-        fh = open(fqfile)
-        if os.path.splitext(fqfile)[1] == ".gz":
-            self.fh = gzip.GzipFile(fileobj=fh)
-        else:
-            self.fh = fh
-        self.start = offset
-        self.end = offset+length
+    def __init__(self,  fqfile, casava18=True, offset=101, length=6, blocksize=DEFAULT_BLOCKSIZE, start=0, end=None):
+        self.fh = open_input(fqfile)
+        if start > 0:
+            self.fh.seek(start)
+        self.offset = offset
+        self.length = length
         self.casava18 = casava18
-        self._next = self.setup_next(self.start, self.end)
+        self._reader = FastQBlockReader(self.fh,blocksize,None if end is None else end - start)
+        self._barcodes = itertools.chain.from_iterable(self.batches())
         
     def __iter__(self):
         return self
     def next(self):
-        return self._next(self)
+        return self._barcodes.next()
     
-    def setup_next(self, start, end):
-        """Return the function to extract the barcode
+    def batches(self):
+        """Iterate over lists with the barcodes of the next batch of records
         """
-        if not self.casava18:
-            def _next(self):
-                _, seq, _, _ = [self.fh.next() for i in xrange(4)]
-                return seq[start:end]
-        else:
-            def _next(self):
-                header, _, _, _ = [self.fh.next() for i in xrange(4)]
-                return header.strip().rsplit(":",1)[1]
-        return _next
+        for batch in self._reader:
+            yield index_sequences(batch, self.casava18, self.offset, self.length)
+
+def quality_array(qualities,offset=33):
+    """Convert a list of quality strings into one flat uint8 array of 
+    quality scores, together with the start offset and length of each
+    quality string in the array
+    """
+    lengths = np.fromiter((len(q) for q in qualities), dtype=np.int64, count=len(qualities))
+    starts = np.zeros(len(qualities), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    scores = np.frombuffer("".join(qualities), dtype=np.uint8) - np.uint8(offset)
+    return scores, starts, lengths
 
+def quality_stats(records,offset=33):
+    """Compute quality statistics for a batch of records in one vectorized pass. 
+    Records may have different lengths.
+    
+    :param records: list of fastq records
+    :param offset: the Phred quality score offset
+    
+    :returns: a dict with numpy arrays 'avgQ' (the mean quality per record), 'gtQ30'
+      (the percentage of bases with quality >= 30 per record), 'position_mean' (the 
+      mean quality per position in the reads) and 'histogram' (the number of bases 
+      per quality score)
+    """
+    scores, starts, lengths = quality_array([r[3] for r in records],offset)
+    ends = starts + lengths
+    
+    # Sum quality scores and bases >= Q30 per record from the cumulative sums
+    qsum = np.zeros(len(scores) + 1, dtype=np.int64)
+    np.cumsum(scores, out=qsum[1:])
+    q30 = np.zeros(len(scores) + 1, dtype=np.int64)
+    np.cumsum(scores >= 30, out=q30[1:])
+    
+    # The position of each base within its read
+    positions = np.arange(len(scores)) - np.repeat(starts, lengths)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {'avgQ': (qsum[ends] - qsum[starts])/lengths.astype(np.float64),
+                'gtQ30': 100*(q30[ends] - q30[starts])/lengths.astype(np.float64),
+                'position_mean': np.bincount(positions, weights=scores)/np.bincount(positions),
+                'histogram': np.bincount(scores)}
 
 def avgQ(record,offset=33):
-    qual = record[3].strip()
-    l = len(qual)
-    s = sum([ord(c) for c in qual])
-    return round(float(s - l*offset)/l,1)
+    """Return the average quality of a record. Use quality_stats for batches of records
+    """
+    scores = np.frombuffer(record[3].strip(), dtype=np.uint8)
+    return round(float(int(scores.sum()) - len(scores)*offset)/len(scores),1)
     
 def gtQ30(record,offset=33):
-    qual = record[3].strip()
-    cutoff = 30 + offset
-    g = 0
-    for c in qual:
-        if ord(c) >= cutoff:
-            g += 1
-    return round(100*float(g)/len(qual),1)
+    """Return the percentage of bases with quality >= 30 in a record. Use quality_stats for batches of records
+    """
+    scores = np.frombuffer(record[3].strip(), dtype=np.uint8)
+    return round(100*float(np.count_nonzero(scores >= 30 + offset))/len(scores),1)
 
 def parse_header(header):
     """Parses the FASTQ header as specified by CASAVA 1.8.2 and returns the fields in a dictionary
@@ -159,6 +426,39 @@ def parse_header(header):
             'control_number': int(control_number),
             'index': str(index)} # Note that MiSeq Reporter outputs a SampleSheet index rather than the index sequence
 
+def index_sequences(records, casava18=True, offset=None, length=6):
+    """Return a list with the index sequences of a batch of records. For 
+    CASAVA 1.8, the index is the last field of the header. Otherwise, the 
+    index is the length bases starting at offset in the nucleotide sequence 
+    or, if offset is None, the field between '#' and '/' of a CASAVA 1.7 header.
+    Dual indexes are returned as they appear in the header, e.g. ATCACG-CGATGT
+    """
+    if casava18:
+        return [r[0][r[0].rfind(":")+1:] for r in records]
+    if offset is not None:
+        return [r[1][offset:offset+length] for r in records]
+    return [r[0][r[0].rfind("#")+1:].split("/")[0] for r in records]
+
+def record_boundary(fh, offset):
+    """Return the byte offset of the first record that starts at or after 
+    offset in an uncompressed fastq file. A header is a line starting with '@'
+    followed by a line starting with '+' two lines further down, which 
+    distinguishes it from a quality line starting with '@'
+    """
+    if offset <= 0:
+        return 0
+    fh.seek(offset - 1)
+    fh.readline()
+    positions, lines = [], []
+    for i in xrange(6):
+        positions.append(fh.tell())
+        lines.append(fh.readline())
+    for i in xrange(4):
+        if lines[i].startswith("@") and lines[i+2].startswith("+"):
+            return positions[i]
+    fh.seek(0, os.SEEK_END)
+    return fh.tell()
+
 def is_read_pair(rec1, rec2, casava18=True):
     """Returns true if the two records belong to the same read pair, determined by matching the header strings and disregarding
        the read field
@@ -171,12 +471,100 @@ def is_read_pair(rec1, rec2, casava18=True):
     r2 = rec2[0].split(' ')
     return (len(r1) == 2 and len(r2) == 2 and r1[0] == r2[0] and r1[1][1:] == r2[1][1:])
 
-def demultiplex_fastq(outdir, samplesheet, fastq1, fastq2=None):
+def paired_batches(parser1, parser2):
+    """Iterate over two FastQParsers in lockstep, yielding tuples with two 
+    equally long batches of records. Raises ValueError if the parsers 
+    contain different numbers of records
+    """
+    batches1 = parser1.batches()
+    batches2 = parser2.batches()
+    pending1 = []
+    pending2 = []
+    while True:
+        if len(pending1) == 0:
+            pending1 = next(batches1,[])
+        if len(pending2) == 0:
+            pending2 = next(batches2,[])
+        if len(pending1) == 0 or len(pending2) == 0:
+            if len(pending1) + len(pending2) > 0:
+                raise ValueError("The paired fastq files {} and {} contain different numbers of records".format(parser1.name(),
+                                                                                                                  parser2.name()))
+            return
+        n = min(len(pending1),len(pending2))
+        yield pending1[0:n], pending2[0:n]
+        pending1 = pending1[n:]
+        pending2 = pending2[n:]
+
+def read_pair_keys(records, casava18=True):
+    """Return the header of each record with the read field removed, so that 
+    the keys of two batches of paired records are equal if is_read_pair holds 
+    for all pairs. The key is None for CASAVA 1.8+ headers that can not be parsed
+    """
+    if not casava18:
+        return [r[0][0:-1] for r in records]
+    keys = []
+    for r in records:
+        h = r[0].split(' ')
+        keys.append("{} {}".format(h[0],h[1][1:]) if len(h) == 2 else None)
+    return keys
+
+def index_lookup(indexes, mismatches=0):
+    """Precompute a lookup table that maps each index sequence, and every
+    sequence within the given Hamming distance of it, to the index sequence.
+    Raises ValueError if a sequence would map to more than one index.
+
+    :param indexes: list of index sequences, dual indexes separated by '-'
+    :param mismatches: the number of mismatches to tolerate
+
+    :returns: a dict with sequences as keys and index sequences as values
+    """
+    lookup = {}
+    collisions = []
+    for index in indexes:
+        for seq in hamming_neighbours(index, mismatches):
+            if lookup.get(seq,index) != index:
+                collisions.append("{} ({} and {})".format(seq,lookup[seq],index))
+            lookup[seq] = index
+    if len(collisions) > 0:
+        raise ValueError("Index sequences are not unique within {} mismatches: {}".format(mismatches,
+                                                                                            ", ".join(sorted(collisions))))
+    return lookup
+
+def write_demultiplex_metrics(counts, outdir, outprefix, samples={}):
+    """Write the number of records per index to a tab-separated metrics file
+
+    :param counts: a dict with the number of records per index
+    :param outdir: output directory
+    :param outprefix: prefix of the metrics file name
+    :param samples: an optional dict with sample names per index
+
+    :returns: the name of the metrics file
+    """
+    if not os.path.exists(outdir):
+        os.mkdir(outdir)
+    
+    metrics_file = os.path.join(outdir,"%s.demultiplex_metrics" % outprefix)
+    with open(metrics_file,"wb") as fh:
+        cw = csv.writer(fh,dialect=csv.excel_tab)
+        cw.writerow(["index","samplesheet sample name","records"])
+        for index, count in counts.items():
+            cw.writerow([index,samples.get(index,"N/A"),count])
+
+    return metrics_file
+
+def demultiplex_fastq(outdir, samplesheet, fastq1, fastq2=None, mismatches=0, pool=None):
     """Demultiplex a bcl-converted illumina fastq file. Assumes it has the index sequence
-    in the header a la CASAVA 1.8+
+    in the header a la CASAVA 1.8+. Read pairs are read in one pass and dispatched
+    on the lane and index in the header, tolerating the given number of mismatches
+    in the index. The output is written through a FastQWriterPool, which limits the 
+    number of open files. The number of read pairs per index is written to a metrics 
+    file per lane.
     """
+    if pool is None:
+        pool = FastQWriterPool()
     outfiles = {}
     counts = {}
+    names = {}
     sdata = HiSeqRun.parse_samplesheet(samplesheet)
     reads = [1]
     if fastq2 is not None:
@@ -189,28 +577,52 @@ def demultiplex_fastq(outdir, samplesheet, fastq1, fastq2=None):
         if lane not in outfiles:
             outfiles[lane] = {}
             counts[lane] = {}
+            names[lane] = {}
         outfiles[lane][index] = []
         counts[lane][index] = 0
+        names[lane][index] = sd['SampleID']
         for read in reads:
             fname = "tmp_{}_{}_L00{}_R{}_001.fastq.gz".format(sd['SampleID'],
                                                               index,
                                                               lane,
                                                               read)
-            outfiles[lane][index].append(FastQWriter(os.path.join(outdir,fname)))
+            outfiles[lane][index].append(pool.writer(os.path.join(outdir,fname)))
+    
+    # Map the index sequences and their neighbours to the output files of each lane
+    dispatch = {}
+    for lane, lane_files in outfiles.items():
+        dispatch[lane] = dict([(seq, (index, lane_files[index])) for seq, index in index_lookup(lane_files.keys(),mismatches).items()])
+    unmatched = dict([(lane, 0) for lane in outfiles.keys()])
     
-    # Parse the input file(s) and write the records to the appropriate output files
+    # Parse the input file(s) in lockstep and write the records to the appropriate output files.
+    # paired_batches raises ValueError if the files contain different numbers of records
     fhs = [FastQParser(fastq1)]
     if fastq2 is not None:
         fhs.append(FastQParser(fastq2))
-        
-    for r, fh in enumerate(fhs):
-        for record in fh:
-            header = parse_header(record[0])
-            lane = str(header['lane'])
-            index = header['index']
-            if lane in outfiles and index in outfiles[lane]:
-                outfiles[lane][index][r].write(record)
-                counts[lane][index] += 1
+        records = itertools.chain.from_iterable(itertools.izip(b1, b2) for b1, b2 in paired_batches(*fhs))
+    else:
+        records = ((record,) for record in itertools.chain.from_iterable(fhs[0].batches()))
+    
+    for pair in records:
+        header = pair[0][0]
+        lane = header.split(":",4)[3]
+        if lane not in dispatch:
+            continue
+        match = dispatch[lane].get(header[header.rfind(":")+1:].strip())
+        if match is None:
+            unmatched[lane] += 1
+            continue
+        index, writers = match
+        for r, record in enumerate(pair):
+            writers[r].write(record)
+        counts[lane][index] += 1
+    
+    # Write the per-lane metrics
+    prefix = os.path.commonprefix([os.path.basename(fh.name()).split(".")[0] for fh in fhs]).strip("_")
+    for lane in outfiles.keys():
+        lane_counts = dict(counts[lane])
+        lane_counts["unmatched"] = unmatched[lane]
+        write_demultiplex_metrics(lane_counts,outdir,"{}_L00{}".format(prefix,lane),names[lane])
     
     # Close filehandles and replace the handles with the file names
     for lane in outfiles.keys():
@@ -218,21 +630,125 @@ def demultiplex_fastq(outdir, samplesheet, fastq1, fastq2=None):
             for r, fh in enumerate(outfiles[lane][index]):
                 fh.close()
                 fname = fh.name()
-                # If no sequences were written, remove the temporary file and the entry from the results
+                # If no sequences were written, remove the temporary file
                 if counts[lane][index] == 0:
                     os.unlink(fname)
-                    del outfiles[lane][index]
-                    break
+                    continue
                 
                 # Rename the temporary file to a persistent name
                 nname = fname.replace("tmp_","")
                 os.rename(fname,nname)
                 outfiles[lane][index][r] = nname
+            # Remove the entry for an index without sequences from the results
+            if counts[lane][index] == 0:
+                del outfiles[lane][index]
     
     return outfiles
 
+# Bytes of memory used per record when sorting fingerprints
+_FINGERPRINT_BYTES = 48
+DEFAULT_MAX_MEMORY = 1024*1024*1024
+_FINGERPRINT_DTYPE = np.dtype([('fp','<u8'),('q','<f4'),('idx','<i8')])
+
+def estimate_records(fname, sample_size=1024*1024):
+    """Estimate the number of records in a fastq file from the file size and
+    the number of records in the first sample_size bytes of the file
+
+    :param fname: a fastq file, possibly compressed with gzip or bzip2
+    :param sample_size: the number of (compressed) bytes to sample
+
+    :returns: the estimated number of records
+    """
+    with open(fname,"rb") as fh:
+        raw = fh.read(sample_size)
+    if len(raw) == 0:
+        return 0
+    if fname.endswith(".gz"):
+        data = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(raw)
+    elif fname.endswith(".bz2"):
+        data = bz2.BZ2Decompressor().decompress(raw)
+    else:
+        data = raw
+    records_per_byte = data.count("\n")/4.0/len(raw)
+    return int(round(records_per_byte*os.path.getsize(fname)))
+
+def sequence_fingerprints(sequences):
+    """Return 64-bit fingerprints of a list of sequences as a numpy uint64 array
+    """
+    return np.frombuffer("".join([hashlib.md5(s).digest()[0:8] for s in sequences]), dtype='<u8')
+
+def unique_records(fastq1, fastq2=None, records=None, max_memory=DEFAULT_MAX_MEMORY, offset=33, tmpdir=None):
+    """Find the records (or read pairs) to keep when removing duplicate sequences. 
+    For each distinct sequence (or pair of sequences of a read pair), the copy 
+    with the highest average quality (the mean of the average qualities of a pair) 
+    is kept; ties are resolved in favour of the first copy. Sequences are compared by 64-bit fingerprints, which are sorted in 
+    memory or, if they would exceed max_memory, in partitions spilled to disk.
+
+    :param fastq1: fastq file
+    :param fastq2: optional paired fastq file
+    :param records: the number of records in fastq1, estimated from the file size if not given
+    :param max_memory: the approximate number of bytes to use for sorting fingerprints
+    :param offset: the Phred quality score offset
+    :param tmpdir: directory for spilled partitions
+
+    :returns: a numpy boolean array with True for each record to keep
+    """
+    if records is None:
+        records = estimate_records(fastq1)
+    partitions = max(1, int(np.ceil(float(records)*_FINGERPRINT_BYTES/max_memory)))
+    spilldir = None
+    if partitions > 1:
+        spilldir = tempfile.mkdtemp(prefix="unique_records_", dir=tmpdir)
+        spills = [open(os.path.join(spilldir,"{}.bin".format(p)),"wb") for p in xrange(partitions)]
+    chunks = []
     
+    try:
+        # Compute fingerprints and average qualities for each batch and assign them to partitions
+        parsers = [FastQParser(fastq1)]
+        if fastq2 is not None:
+            parsers.append(FastQParser(fastq2))
+            batches = paired_batches(*parsers)
+        else:
+            batches = ((batch,) for batch in parsers[0].batches())
+        n = 0
+        for batch in batches:
+            entries = np.empty(len(batch[0]), dtype=_FINGERPRINT_DTYPE)
+            if len(batch) == 1:
+                entries['fp'] = sequence_fingerprints([r[1] for r in batch[0]])
+                entries['q'] = quality_stats(batch[0],offset)['avgQ']
+            else:
+                # The mates are separated so that pairs of trimmed reads of different lengths differ
+                entries['fp'] = sequence_fingerprints(["{}\t{}".format(r1[1],r2[1]) for r1, r2 in itertools.izip(*batch)])
+                entries['q'] = (quality_stats(batch[0],offset)['avgQ'] + quality_stats(batch[1],offset)['avgQ'])/2
+            entries['idx'] = np.arange(n, n + len(entries))
+            n += len(entries)
+            if partitions == 1:
+                chunks.append(entries)
+                continue
+            part = entries['fp'] % partitions
+            for p in np.unique(part):
+                entries[part == p].tofile(spills[p])
+        
+        # Sort each partition on fingerprint, decreasing quality and record number and keep the first record per fingerprint
+        keep = np.zeros(n, dtype=bool)
+        if partitions > 1:
+            for fh in spills:
+                fh.close()
+            chunks = (np.fromfile(fh.name, dtype=_FINGERPRINT_DTYPE) for fh in spills)
+        else:
+            chunks = [np.concatenate(chunks)] if len(chunks) > 0 else []
+        for entries in chunks:
+            if len(entries) == 0:
+                continue
+            order = np.lexsort((entries['idx'], -entries['q'], entries['fp']))
+            fps = entries['fp'][order]
+            first = np.ones(len(fps), dtype=bool)
+            first[1:] = fps[1:] != fps[:-1]
+            keep[entries['idx'][order][first]] = True
+    finally:
+        if spilldir is not None:
+            for fh in spills:
+                fh.close()
+            shutil.rmtree(spilldir)
     
-    
-    
-    
+    return keep
@@ -0,0 +1,297 @@
+"""Persistent index of the files of a project directory.
+
+The index is a sqlite file in the indexed root directory, holding the
+directories with their modification times and the files with their
+size, modification time, and the sample, lane and type they are
+classified to. An update only lists the directories whose modification
+time has changed since the last update, so that the walks of find_samples
+and friends need not list every directory of a project. Note that
+modifying a file in place does not change the modification time of its
+directory, so the size and mtime of such files are only refreshed by a
+rebuild.
+
+Indexes are created with pm index rebuild. indexed_walk uses the index
+of a directory, or of one of its parents, if there is one, and falls
+back on filtered_walk otherwise.
+"""
+import os
+import re
+import json
+import time
+import sqlite3
+
+from scilifelab.utils.misc import DirFilter, filtered_walk
+from scilifelab.log import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+INDEX_FILE = ".pm-index.sqlite"
+INDEX_VERSION = 1
+
+## Directories modified less than this number of seconds before an
+## update are listed again on the next update, since later changes
+## within the mtime resolution of the file system would go unnoticed
+MTIME_WINDOW = 2
+
+## Compression suffixes disregarded when classifying the file type
+COMPRESSION_SUFFIXES = (".gz", ".bz2")
+
+re_lane = re.compile("^([1-8])_[0-9]{6}_[0-9A-Za-z]+")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime REAL, link INTEGER);
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, name TEXT, size INTEGER, mtime REAL,
+                                  sample TEXT, lane TEXT, type TEXT);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE INDEX IF NOT EXISTS files_sample ON files (sample);
+CREATE INDEX IF NOT EXISTS files_type ON files (type);
+"""
+
+def file_type(name):
+    """Classify a file by its extension, disregarding compression
+    suffixes, as in 'fastq' for 1_120924_AC003CCCXX_1.fastq.gz"""
+    for suffix in COMPRESSION_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    ext = os.path.splitext(name)[1]
+    return ext[1:] if ext else None
+
+def file_lane(name):
+    """Get the lane of a file named as lane_date_flowcell..., if any"""
+    m = re_lane.match(name)
+    return m.group(1) if m else None
+
+class FileIndex(object):
+    """Index of the files under a root directory
+
+    :param root: indexed directory
+    :param path: index file name; defaults to INDEX_FILE in root
+    """
+
+    def __init__(self, root, path=None):
+        self.root = os.path.abspath(root)
+        self.path = path or os.path.join(self.root, INDEX_FILE)
+        self.con = sqlite3.connect(self.path)
+        self.con.executescript(_SCHEMA)
+        self.con.create_function("REGEXP", 2, lambda pattern, s: re.search(pattern, s) is not None)
+        if self._get_meta("version", INDEX_VERSION) != INDEX_VERSION:
+            LOG.info("Index {} has version {}; rebuilding".format(self.path, self._get_meta("version")))
+            self.clear()
+        with self.con:
+            self._set_meta("version", INDEX_VERSION)
+            self._set_meta("root", self.root)
+        self.listed = 0
+
+    def __repr__(self):
+        return "<{} {}>".format(self.__class__.__name__, self.root)
+
+    @classmethod
+    def find(cls, path):
+        """Find the index of path, or of one of its parent directories
+
+        :param path: a directory
+
+        :returns: FileIndex, or None if there is no index
+        """
+        path = os.path.abspath(path)
+        while True:
+            if os.path.exists(os.path.join(path, INDEX_FILE)):
+                return cls(path)
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+    def _get_meta(self, key, default=None):
+        row = self.con.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _set_meta(self, key, value):
+        self.con.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def _sample(self, path):
+        """The sample of a path is the first directory below the root"""
+        rel = os.path.relpath(path, self.root).split(os.sep)
+        return rel[0] if len(rel) > 1 else None
+
+    def clear(self):
+        with self.con:
+            self.con.execute("DELETE FROM dirs")
+            self.con.execute("DELETE FROM files")
+            self._set_meta("updated", None)
+
+    def _list_dir(self, path, st, now):
+        """List a directory, replacing its files and subdirectories in the index
+
+        :returns: list of subdirectories to descend into
+        """
+        self.listed += 1
+        try:
+            names = os.listdir(path)
+        except OSError as e:
+            LOG.warn("Could not list directory {}: {}".format(path, e))
+            names = []
+        files, subdirs = [], []
+        sample = self._sample(os.path.join(path, "x"))
+        for name in names:
+            if name.startswith(INDEX_FILE):
+                continue
+            fn = os.path.join(path, name)
+            try:
+                fst = os.lstat(fn)
+            except OSError:
+                continue
+            if os.path.isdir(fn):
+                subdirs.append((fn, os.path.islink(fn)))
+            else:
+                files.append((fn, path, name, fst.st_size, fst.st_mtime, sample, file_lane(name), file_type(name)))
+        mtime = st.st_mtime if now - st.st_mtime >= MTIME_WINDOW else None
+        self.con.execute("DELETE FROM files WHERE dir = ?", (path,))
+        self.con.executemany("INSERT INTO files (path, dir, name, size, mtime, sample, lane, type) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", files)
+        self.con.execute("INSERT OR REPLACE INTO dirs (path, parent, mtime, link) VALUES (?, ?, ?, 0)", (path, os.path.dirname(path), mtime))
+        known = set(self._subdirs(path, links=True))
+        for fn, link in subdirs:
+            if link:
+                self.con.execute("INSERT OR REPLACE INTO dirs (path, parent, mtime, link) VALUES (?, ?, NULL, 1)", (fn, path))
+        for fn in known.difference([x[0] for x in subdirs]):
+            self._remove_tree(fn)
+        return [fn for fn, link in subdirs if not link]
+
+    def _remove_tree(self, path):
+        prefix = path.rstrip(os.sep) + os.sep
+        self.con.execute("DELETE FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?", (path, len(prefix), prefix))
+        self.con.execute("DELETE FROM files WHERE dir = ? OR substr(dir, 1, ?) = ?", (path, len(prefix), prefix))
+
+    def _subdirs(self, path, links=False):
+        if links:
+            return [row[0] for row in self.con.execute("SELECT path FROM dirs WHERE parent = ? ORDER BY path", (path,))]
+        return [row[0] for row in self.con.execute("SELECT path FROM dirs WHERE parent = ? AND link = 0 ORDER BY path", (path,))]
+
+    def update(self, path=None):
+        """Update the index of a directory tree, listing only the
+        directories whose modification time has changed
+
+        :param path: directory to update; defaults to the root
+
+        :returns: number of directories listed
+        """
+        path = os.path.abspath(path or self.root)
+        self.listed = 0
+        now = time.time()
+        with self.con:
+            stack = [path]
+            while stack:
+                d = stack.pop()
+                try:
+                    st = os.stat(d)
+                except OSError:
+                    self._remove_tree(d)
+                    continue
+                row = self.con.execute("SELECT mtime FROM dirs WHERE path = ?", (d,)).fetchone()
+                if row is not None and row[0] == st.st_mtime:
+                    stack.extend(self._subdirs(d))
+                else:
+                    stack.extend(self._list_dir(d, st, now))
+            if path == self.root:
+                self._set_meta("updated", now)
+        LOG.debug("Updated index of {}: listed {} directories".format(path, self.listed))
+        return self.listed
+
+    def rebuild(self):
+        """Index the root directory from scratch"""
+        self.clear()
+        return self.update()
+
+    def status(self):
+        """Summarize the index
+
+        :returns: dict with the number of files and directories, their total size, the time of the last update and the number of files per type
+        """
+        (n_files, size) = self.con.execute("SELECT COUNT(*), SUM(size) FROM files").fetchone()
+        types = dict(self.con.execute("SELECT type, COUNT(*) FROM files GROUP BY type").fetchall())
+        return {"root":self.root, "files":n_files, "size":size or 0, "updated":self._get_meta("updated"),
+                "dirs":self.con.execute("SELECT COUNT(*) FROM dirs").fetchone()[0], "types":types}
+
+    def by_sample(self, sample):
+        """Get the files of a sample
+
+        :param sample: sample directory name
+
+        :returns: list of file names
+        """
+        return [row[0] for row in self.con.execute("SELECT path FROM files WHERE sample = ? ORDER BY path", (sample,))]
+
+    def by_pattern(self, pattern):
+        """Get the files whose path matches a regular expression
+
+        :param pattern: regular expression, searched for in the path
+
+        :returns: list of file names
+        """
+        return [row[0] for row in self.con.execute("SELECT path FROM files WHERE path REGEXP ? ORDER BY path", (pattern,))]
+
+    def by_extension(self, ext):
+        """Get the files with a given extension, e.g. '.fastq.gz'
+
+        :param ext: file name ending
+
+        :returns: list of file names
+        """
+        return [row[0] for row in self.con.execute("SELECT path FROM files WHERE substr(name, ?) = ? ORDER BY path", (-len(ext), ext))]
+
+    def filtered_walk(self, rootdir, filter_fn=None, include_dirs=None, exclude_dirs=None, get_dirs=False):
+        """Perform a filtered walk of a directory in the index, with the
+        semantics of misc.filtered_walk. Paths are returned relative to
+        rootdir as given.
+
+        :param rootdir: directory at or below the root
+        :param filter_fn: Filtering function of file names that returns boolean
+        :param include_dirs: Only report files in these directories (list)
+        :param exclude_dirs: Exclude these directories (list)
+        :param get_dirs: return the directories instead of the files
+
+        :returns: list of paths
+        """
+        abs_rootdir = os.path.abspath(rootdir)
+        dir_filter = DirFilter(include_dirs, exclude_dirs)
+        components = rootdir.split(os.sep)
+        if dir_filter.excluded(rootdir, components):
+            return []
+        flist = []
+        stack = [(abs_rootdir, dir_filter.include_dirs is not None and len(dir_filter.include_dirs.intersection(components)) > 0)]
+        while stack:
+            (root, inherited) = stack.pop()
+            report = inherited or dir_filter.included(root, [])
+            subdirs = []
+            for (d, link) in self.con.execute("SELECT path, link FROM dirs WHERE parent = ? ORDER BY path", (root,)).fetchall():
+                name = os.path.basename(d)
+                if dir_filter.excluded(d, [name]):
+                    continue
+                if report and get_dirs:
+                    flist.append(d)
+                if not link:
+                    subdirs.append((d, inherited or dir_filter.include_dirs is not None and name in dir_filter.include_dirs))
+            if report and not get_dirs:
+                flist.extend([row[0] for row in self.con.execute("SELECT path FROM files WHERE dir = ? ORDER BY path", (root,))
+                              if filter_fn is None or filter_fn(os.path.basename(row[0]))])
+            stack.extend(reversed(subdirs))
+        if abs_rootdir != rootdir:
+            flist = [os.path.join(rootdir, os.path.relpath(x, abs_rootdir)) for x in flist]
+        return flist
+
+def indexed_walk(rootdir, filter_fn=None, include_dirs=None, exclude_dirs=None, get_dirs=False):
+    """Perform a filtered directory walk, see misc.filtered_walk. If
+    rootdir, or one of its parents, has a file index, the index is
+    updated and queried instead of walking the whole directory.
+    """
+    try:
+        index = FileIndex.find(rootdir)
+        if index is not None:
+            index.update(rootdir)
+            return index.filtered_walk(rootdir, filter_fn, include_dirs, exclude_dirs, get_dirs)
+    except sqlite3.Error as e:
+        LOG.warn("Could not use the file index of {}: {}; walking the directory".format(rootdir, e))
+    return filtered_walk(rootdir, filter_fn, include_dirs, exclude_dirs, get_dirs)
@@ -4,8 +4,17 @@ import os
 import re
 import contextlib
 import itertools
+from multiprocessing.pool import ThreadPool
 import scilifelab.log
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 LOG = scilifelab.log.minimal_logger(__name__)
 
 ## yes or no: http://stackoverflow.com/questions/3041986/python-command-line-yes-no-input
@@ -70,6 +79,118 @@ def query_ok(statement="", force=False):
         else:
             sys.stdout.write("Please respond with <enter>")
 
+class _DirEntry(object):
+    """Minimal stand-in for the entries of os.scandir, for pythons
+    without scandir"""
+    __slots__ = ["name", "path"]
+
+    def __init__(self, root, name):
+        self.name = name
+        self.path = os.path.join(root, name)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+def _scandir(path):
+    if scandir is not None:
+        return scandir(path)
+    return [_DirEntry(path, x) for x in os.listdir(path)]
+
+class DirFilter(object):
+    """Directory include and exclude tests, with the patterns compiled once.
+    A directory matches if one of its path components is in the list,
+    or if the path matches one of the list items as a regular expression.
+    """
+    def __init__(self, include_dirs=None, exclude_dirs=None):
+        self.include_dirs = set(include_dirs) if include_dirs else None
+        self.exclude_dirs = set(exclude_dirs) if exclude_dirs else None
+        self.re_include = re.compile("|".join(include_dirs)) if include_dirs else None
+        self.re_exclude = re.compile("|".join(exclude_dirs)) if exclude_dirs else None
+
+    def included(self, path, names):
+        return self.include_dirs is None or len(self.include_dirs.intersection(names)) > 0 or self.re_include.search(path) is not None
+
+    def excluded(self, path, names):
+        return self.exclude_dirs is not None and (len(self.exclude_dirs.intersection(names)) > 0 or self.re_exclude.search(path) is not None)
+
+def _scan_dir(root, inherited, dir_filter, filter_fn=None, get_dirs=False):
+    """Scan one directory of a filtered walk.
+
+    :param root: directory
+    :param inherited: True if a parent directory name is in include_dirs
+    :param dir_filter: DirFilter
+
+    :returns: list of matching paths and list of (subdirectory, inherited) to descend into
+    """
+    try:
+        entries = list(_scandir(root))
+    except OSError:
+        return [], []
+    report = inherited or dir_filter.included(root, [])
+    matches, subdirs = [], []
+    for entry in entries:
+        if entry.is_dir():
+            if dir_filter.excluded(entry.path, [entry.name]):
+                continue
+            if report and get_dirs:
+                matches.append(entry.path)
+            # As os.walk, do not follow symlinks to directories
+            if not entry.is_symlink():
+                subdirs.append((entry.path, inherited or dir_filter.include_dirs is not None and entry.name in dir_filter.include_dirs))
+        elif report and not get_dirs and (filter_fn is None or filter_fn(entry.name)):
+            matches.append(entry.path)
+    return matches, subdirs
+
+def _walk_tree(stack, dir_filter, filter_fn=None, get_dirs=False):
+    """Walk directories depth first, in the order of os.walk"""
+    stack = list(reversed(stack))
+    while stack:
+        (root, inherited) = stack.pop()
+        matches, subdirs = _scan_dir(root, inherited, dir_filter, filter_fn, get_dirs)
+        for path in matches:
+            yield path
+        stack.extend(reversed(subdirs))
+
+def iter_filtered_walk(rootdir, filter_fn=None, include_dirs=None, exclude_dirs=None, get_dirs=False, workers=1):
+    """Perform a filtered directory walk, generating the matching paths
+    as they are found. Excluded directories are pruned, i.e. never
+    descended into. Directories are listed with os.scandir when
+    available.
+
+    :param rootdir: Root directory
+    :param filter_fn: Filtering function of file names that returns boolean
+    :param include_dirs: Only report files in these directories, or their subdirectories (list)
+    :param exclude_dirs: Exclude these directories, and their subdirectories (list)
+    :param get_dirs: generate the directories instead of the files
+    :param workers: number of threads walking the subdirectories of rootdir in parallel
+
+    :returns: generator of paths, in the order of os.walk
+    """
+    dir_filter = DirFilter(include_dirs, exclude_dirs)
+    components = rootdir.split(os.sep)
+    if dir_filter.excluded(rootdir, components):
+        return
+    top = (rootdir, dir_filter.include_dirs is not None and len(dir_filter.include_dirs.intersection(components)) > 0)
+    if workers <= 1:
+        for path in _walk_tree([top], dir_filter, filter_fn, get_dirs):
+            yield path
+        return
+    matches, subdirs = _scan_dir(top[0], top[1], dir_filter, filter_fn, get_dirs)
+    for path in matches:
+        yield path
+    if len(subdirs) == 0:
+        return
+    pool = ThreadPool(min(workers, len(subdirs)))
+    try:
+        for paths in pool.imap(lambda x: list(_walk_tree([x], dir_filter, filter_fn, get_dirs)), subdirs):
+            for path in paths:
+                yield path
+    finally:
+        pool.terminate()
+
 def walk(rootdir):
     """
     Perform a directory walk
@@ -78,13 +199,10 @@ def walk(rootdir):
 
     :returns: List of files 
     """
-    flist = []
-    for root, dirs, files in os.walk(rootdir):
-        flist = flist + [os.path.join(root, x) for x in files]
-    return flist
+    return list(iter_filtered_walk(rootdir))
 
 def filtered_walk(rootdir, filter_fn, include_dirs=None, exclude_dirs=None, get_dirs=False): 
-    """Perform a filtered directory walk.
+    """Perform a filtered directory walk. See iter_filtered_walk.
 
     :param rootdir: Root directory
     :param filter_fn: Filtering function that returns boolean
@@ -93,25 +211,7 @@ def filtered_walk(rootdir, filter_fn, include_dirs=None, exclude_dirs=None, get_
 
     :returns: Filtered file list 
     """
-    flist = []
-    dlist = []
-    for root, dirs, files in os.walk(rootdir):
-        if include_dirs and len(set(root.split(os.sep)).intersection(set(include_dirs))) == 0:
-            ## Also try re.search in case we have patterns
-            if re.search("|".join(include_dirs), root):
-                pass
-            else:
-                continue
-        if exclude_dirs and len(set(root.split(os.sep)).intersection(set(exclude_dirs))) > 0:
-            continue
-        if exclude_dirs and re.search("|".join(exclude_dirs), root):
-            continue
-        dlist = dlist + [os.path.join(root, x) for x in dirs]
-        flist = flist + [os.path.join(root, x) for x in filter(filter_fn, files)]
-    if get_dirs:
-        return dlist
-    else:
-        return flist
+    return list(iter_filtered_walk(rootdir, filter_fn, include_dirs, exclude_dirs, get_dirs))
 
 def filtered_output(pattern, data):
     """
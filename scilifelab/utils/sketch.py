@@ -0,0 +1,75 @@
+"""Bounded-memory counting of frequent items"""
+import numpy as np
+
+class SpaceSaving:
+    """Approximate counter of the most frequent items, using at most
+       capacity counters (the space-saving algorithm of Metwally et al.).
+       The count of a tracked item overestimates the true count by at most
+       the item's error, and an item that is not tracked occurs at most
+       floor times. Counters are mergeable (Berinde et al.), so items can be
+       counted in chunks or in separate processes and combined afterwards."""
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.floor = 0
+        self.total = 0
+
+    def update(self, items):
+        """Count a chunk of items, e.g. a list or numpy array of strings
+        """
+        if len(items) == 0:
+            return
+        values, counts = np.unique(np.asarray(items), return_counts=True)
+        self.update_counts(dict(zip(values.tolist(), counts.tolist())))
+
+    def update_counts(self, counts):
+        """Add exact counts from a dict of items and counts
+        """
+        chunk = SpaceSaving(self.capacity)
+        chunk.counts = counts
+        chunk.errors = dict.fromkeys(counts.iterkeys(), 0)
+        chunk.total = sum(counts.itervalues())
+        chunk._truncate(0)
+        self.merge(chunk)
+
+    def merge(self, other):
+        """Merge the counts of another SpaceSaving counter into this one
+        """
+        counts = {}
+        errors = {}
+        for item in set(self.counts.keys()) | set(other.counts.keys()):
+            counts[item] = self.counts.get(item, self.floor) + other.counts.get(item, other.floor)
+            errors[item] = self.errors.get(item, self.floor) + other.errors.get(item, other.floor)
+        self.counts = counts
+        self.errors = errors
+        self.total += other.total
+        self._truncate(self.floor + other.floor)
+
+    def _truncate(self, floor):
+        """Keep the capacity most frequent items, updating the bound on the count
+        of items that are not tracked
+        """
+        self.floor = floor
+        if len(self.counts) <= self.capacity:
+            return
+        ranked = sorted(self.counts.iteritems(), key=lambda x: x[1], reverse=True)
+        self.floor = max(floor, ranked[self.capacity][1])
+        for item, count in ranked[self.capacity:]:
+            del self.counts[item]
+            del self.errors[item]
+
+    def guaranteed(self, item):
+        """Return the lower bound of the count of an item
+        """
+        return self.counts.get(item, 0) - self.errors.get(item, 0)
+
+    def most_common(self, n=None):
+        """Return a list of the n most common items and their (estimated)
+        counts, from the most common to the least
+        """
+        ranked = sorted(self.counts.iteritems(), key=lambda x: x[1], reverse=True)
+        if n is None:
+            return ranked
+        return ranked[0:n]
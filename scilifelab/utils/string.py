@@ -19,6 +19,36 @@ def hamming_distance(s1, s2):
     if len(s1) != len(s2): raise ValueError('strings of unequal length')
     return sum(ch1 != ch2 for ch1, ch2 in zip(s1, s2))    
 
+def hamming_neighbours(s, distance=1, alphabet="ACGTN", fixed="-"):
+    """Generate all strings within a Hamming distance of a string, including
+    the string itself. Characters in fixed, e.g. the separator of a dual index, 
+    are never substituted.
+
+    :param s: string
+    :param distance: maximum Hamming distance
+    :param alphabet: characters to substitute
+    :param fixed: characters that are left as-is
+
+    :returns: set of strings
+    """
+    neighbours = set([s])
+    frontier = [s]
+    for d in xrange(distance):
+        extended = []
+        for n in frontier:
+            for i, ch in enumerate(n):
+                if ch in fixed or ch != s[i]:
+                    continue
+                for sub in alphabet:
+                    if sub == ch:
+                        continue
+                    m = n[:i] + sub + n[i+1:]
+                    if m not in neighbours:
+                        neighbours.add(m)
+                        extended.append(m)
+        frontier = extended
+    return neighbours
+
 def strip_extensions(fn, ext=[]):
     """Strip extensions from a filename.
 
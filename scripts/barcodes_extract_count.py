@@ -2,26 +2,17 @@
 import argparse
 import sys
 import csv
-from scilifelab.utils.fastq_utils import BarcodeExtractor
-from scilifelab.utils.string import hamming_distance
 from scilifelab.illumina.hiseq import HiSeqRun
-from scilifelab.illumina import map_index_name
-from collections import Counter
+from scilifelab.illumina.barcodes import count_barcodes, exclusion_set, DEFAULT_CAPACITY
       
-def extract_barcodes(fqfile, lane, nindex=25, casava18=True, offset=101, bclen=6, expected=[], mismatch=True):
-    """Parse the fastq file and extract barcodes. Return a dict structure suitable for upload to StatusDB
+def extract_barcodes(fqfile, lane, nindex=25, casava18=True, offset=101, bclen=6, expected=[], mismatch=True, capacity=DEFAULT_CAPACITY, workers=1, max_reads=None):
+    """Parse the fastq file and extract barcodes. Return a dict structure suitable for upload to StatusDB.
+    The counting uses bounded memory, so for files with more than capacity distinct
+    barcodes the reported counts are upper bounds of the true counts
     """
     
-    bcx = BarcodeExtractor(fqfile, casava18, offset, bclen)
-    c = Counter(bcx)
-    c = remove_expected(c,expected,mismatch)
-    counts = []
-    header = ['lane', 'sequence', 'count', 'index_name']
-    for bc, count in c.most_common(nindex):
-        counts.append(dict(zip(header,
-                               [lane, bc, count, ','.join(map_index_name(bc,int(mismatch)))])))
-        
-    return [header, counts]
+    c = count_barcodes(fqfile, casava18, offset, bclen, exclusion_set(expected, mismatch), capacity, workers, max_reads, lane=lane, mismatch=int(mismatch))
+    return [c.header, c.rows(nindex)]
 
 def write_metrics(header, counts):
     """Write the counts to stdout
@@ -32,40 +23,6 @@ def write_metrics(header, counts):
         csvw.writeheader()
         csvw.writerows(counts)
           
-def generate_mismatches(src):
-    """
-    Generate a list of all possible nucleotide sequences with one 
-    mismatch from the supplied sequence.
-    """
-    seqs = []
-    # Mutate each position
-    src_list = list(src)
-    for i in xrange(len(src_list)):
-        # Change to all possible nucleotides
-        for n in "ACGTN":
-            src_list[i] = n
-            seqs.append("".join(src_list))
-        # Reset the mutated nucleotide
-        src_list[i] = src[i]
-        
-    return list(set(seqs))
-
-def remove_expected(bc_counter, expected_bc, mismatch=False):
-    """
-    Remove the entries corresponding to the supplied list of expected barcodes, 
-    optionally allowing for one mismatch 
-    """
-    for bc in expected_bc:
-        if mismatch:
-            bcs = generate_mismatches(bc)
-        else:
-            bcs = [bc]
-            
-        for b in bcs:
-            del bc_counter[b]
-            
-    return bc_counter
-    
 def get_expected(csv_file, lane):
     """Extract the expected barcodes in a lane from a supplied csv samplesheet
     """
@@ -89,6 +46,12 @@ def main():
     parser.add_argument('--csv-file', dest='csvfile', action='store', default=None, 
                         help="The csv samplesheet for the run. If supplied, will be used together with lane " \
                         "to exclude expected barcodes")
+    parser.add_argument('-c','--capacity', dest='capacity', action='store', type=int, default=DEFAULT_CAPACITY, 
+                        help="The maximum number of distinct barcodes tracked while counting. Default is %(default)s")
+    parser.add_argument('-w','--workers', dest='workers', action='store', type=int, default=1, 
+                        help="The number of worker processes used for counting")
+    parser.add_argument('-s','--sample', dest='sample', action='store', type=float, default=None, 
+                        help="Only count the barcodes of the first SAMPLE million reads")
     parser.add_argument('infile', action='store',
                         help="The input FastQ file to process. Can be gzip compressed")
     parser.add_argument('lane', action='store', default=None, 
@@ -99,7 +62,8 @@ def main():
     if args.csvfile is not None:
         expected = get_expected(args.csvfile,args.lane)
     
-    header, counts = extract_barcodes(args.infile, args.lane, int(args.nindex), args.casava18, int(args.offset), int(args.barcode_length), expected, args.mismatch)
+    header, counts = extract_barcodes(args.infile, args.lane, int(args.nindex), args.casava18, int(args.offset), int(args.barcode_length), expected, args.mismatch, 
+                                     args.capacity, args.workers, None if args.sample is None else int(args.sample*1000000))
     write_metrics(header, counts)
     
 if __name__ == "__main__":
@@ -1,73 +1,103 @@
 import os
 import sys
+import csv
+import itertools
+import numpy as np
 import scilifelab.utils.fastq_utils as fastq_utils
 import argparse
 
-def main():
+def parse_args(argv=None):
     
     parser = argparse.ArgumentParser(description="Filter reads from a pair of FastQ files based on the average quality."\
                                      "If the average quality of one of the reads in the pair is below the given threshold, "\
                                      "the pair is discarded. Output is a file named as INPUT.Q[T].[EXT], where T is the threshold "\
-                                     "and EXT is the file extension. Accepts uncompressed or gzip-compressed input files")
+                                     "and EXT is the file extension. Several thresholds can be given and are written in a single pass. "\
+                                     "Accepts uncompressed or gzip-compressed input files")
 
-    parser.add_argument('-T','--threshold', action='store', default=20, 
-                        help="if any read in the pair has an average quality below this threshold, the pair is discarded. Default is 20.")
+    parser.add_argument('-T','--threshold', action='append', type=int, default=None,
+                        help="if any read in the pair has an average quality below this threshold, the pair is discarded. "\
+                        "Several thresholds can be given by repeating the option, as in -T 20 -T 30. Default is 20.")
     parser.add_argument('-p','--phred', action='store', default=33, 
                         help="the Phred quality score offset. Default is 33 (Sanger)")
     parser.add_argument('--1.7', dest='casava17', action='store_true', default=False, 
                         help="the fastq files were generated by a Casava version < 1.8")
+    parser.add_argument('--histogram', action='store', default=None,
+                        help="write a csv histogram of the number of pairs per pair quality (the lowest average quality of the reads in the pair) to this file")
     parser.add_argument('fastq1', action='store', default=None, 
                         help="the first sequence file of the pair")
     parser.add_argument('fastq2', action='store', default=None, 
                         help="the second sequence file of the pair")
     
-    args = parser.parse_args()
-    process_fastq(args.fastq1, args.fastq2, [int(args.threshold)], int(args.phred), args.casava17)
+    args = parser.parse_args(argv)
+    if args.threshold is None:
+        args.threshold = [20]
+    return args
+
+def main():
+    args = parse_args()
+    histogram = process_fastq(args.fastq1, args.fastq2, args.threshold, int(args.phred), args.casava17)
+    if args.histogram is not None:
+        with open(args.histogram,"w") as fh:
+            print_average_quals(histogram, fh)
+
+def print_average_quals(histogram, fh=sys.stdout):
+    """Write a csv histogram with the number of read pairs per pair quality
+    """
+    cw = csv.writer(fh)
+    cw.writerow(["quality","pairs"])
+    for quality, pairs in enumerate(histogram):
+        cw.writerow([quality,pairs])
+
+def pair_quality(records1, records2, phred_offset):
+    """Return the lowest rounded average quality of the reads in each pair as a numpy array.
+    The average quality is rounded as int(round(avgQ(record))), with python's round on the
+    distinct averages of the batch, so that pairs are binned exactly as per record
+    """
+    avg = np.minimum(fastq_utils.quality_stats(records1,phred_offset)['avgQ'],
+                     fastq_utils.quality_stats(records2,phred_offset)['avgQ'])
+    values, inverse = np.unique(avg, return_inverse=True)
+    rounded = np.array([int(round(round(x,1))) for x in values.tolist()], dtype=int)
+    return rounded[inverse]
 
-def print_average_quals(qualities):
-    
-    first = True
-    for bin, avg_quality in sorted(qualities.items()):
-        if first:
-            print ",".join([str(i) for i in range(len(avg_quality)+1)])
-            first = False
-        avg_quality.insert(0,bin)
-        print ",".join([str(i) for i in avg_quality])
-        
 def process_fastq(fastq_r1, fastq_r2, bins, phred_offset, casava17):
-    
+    """Write the read pairs to one output pair per quality threshold in bins, in a single
+    pass over the input. Returns the histogram of pair qualities as a numpy array
+    """
     fh_r1 = fastq_utils.FastQParser(fastq_r1)
     fh_r2 = fastq_utils.FastQParser(fastq_r2)
+    pool = fastq_utils.FastQWriterPool()
     oh1 = {}
     oh2 = {}
     root1, ext1 = os.path.splitext(fastq_r1)
     root2, ext2 = os.path.splitext(fastq_r2)
     for b in bins:
-        oh1[b] = fastq_utils.FastQWriter("%s.Q%d%s" % (root1,b,ext1))
-        oh2[b] = fastq_utils.FastQWriter("%s.Q%d%s" % (root2,b,ext2))
-    
-    for r1 in fh_r1:
-        r2 = fh_r2.next()
-        assert fastq_utils.is_read_pair(r1,r2,not casava17), "FATAL: Read identifiers differ for paired reads ({:s} and {:s})".format(r1[0],r2[0])
+        oh1[b] = pool.writer("%s.Q%d%s" % (root1,b,ext1))
+        oh2[b] = pool.writer("%s.Q%d%s" % (root2,b,ext2))
+
+    histogram = np.zeros(0, dtype=np.int64)
+    for r1, r2 in fastq_utils.paired_batches(fh_r1, fh_r2):
+        keys1 = fastq_utils.read_pair_keys(r1, not casava17)
+        keys2 = fastq_utils.read_pair_keys(r2, not casava17)
+        if keys1 != keys2 or None in keys1:
+            for p1, p2 in itertools.izip(r1, r2):
+                assert fastq_utils.is_read_pair(p1,p2,not casava17), "FATAL: Read identifiers differ for paired reads ({:s} and {:s})".format(p1[0],p2[0])
+
+        quality = pair_quality(r1, r2, phred_offset)
+        counts = np.bincount(quality)
+        if len(counts) > len(histogram):
+            histogram = np.concatenate([histogram, np.zeros(len(counts) - len(histogram), dtype=np.int64)])
+        histogram[0:len(counts)] += counts
 
-        bin = min(int(round(fastq_utils.avgQ(r1,phred_offset))),int(round(fastq_utils.avgQ(r2,phred_offset))))
-        
         for b in bins:
-            if bin >= b:
-                oh1[b].write(r1)
-                oh2[b].write(r2)
-        
+            keep = (quality >= b).tolist()
+            pool.write_batch(oh1[b].name(), list(itertools.compress(r1, keep)))
+            pool.write_batch(oh2[b].name(), list(itertools.compress(r2, keep)))
+
     for oh in oh1.values() + oh2.values():
         oh.close()
 
+    return histogram
 
-def quality_average(quality_str, phred_offset):
-    sum = 0.
-    for qual in quality_str:
-        sum += ord(qual)
-    sum -= len(quality_str)*phred_offset
-    return sum/len(quality_str)
-    
 if __name__ == "__main__":
     sys.exit(main())
-    
+
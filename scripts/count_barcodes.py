@@ -1,56 +1,6 @@
 import sys, optparse
-import gzip
-from operator import itemgetter
-
-illumina_idx = {'ATCACG':'index1', 
-                'ATCACGA':'index1', 
-                'CGATGT':'index2',
-                'CGATGTA':'index2',
-                'TTAGGC':'index3',
-                'TTAGGCA':'index3',
-                'TGACCA':'index4',
-                'TGACCAA':'index4',
-                'ACAGTG':'index5',
-                'ACAGTGA':'index5',
-                'GCCAAT':'index6',
-                'GCCAATA':'index6',
-                'CAGATC':'index7',
-                'CAGATCA':'index7',
-                'ACTTGA':'index8',
-                'ACTTGAA':'index8',
-                'GATCAG':'index9',
-                'GATCAGA':'index9',
-                'TAGCTT':'index10',
-                'TAGCTTA':'index10',
-                'GGCTAC':'index11',
-                'GGCTACA':'index11',
-                'CTTGTA':'index12',
-                'CTTGTAA':'index12',
-                'AGTCAA':'index13',
-                'AGTCAAA':'index13',
-                'AGTTCC':'index14',
-                'AGTTCCA':'index14',
-                'ATGTCA':'index15',
-                'ATGTCAA':'index15',
-                'CCGTCC':'index16',
-                'CCGTCCA':'index16',
-                'GTCCGC':'index18',
-                'GTCCGCA':'index18',
-                'GTGAAA':'index19',
-                'GTGAAAA':'index19',
-                'GTGGCC':'index20',
-                'GTGGCCA':'index20',
-                'GTTTCG':'index21',
-                'GTTTCGA':'index21',
-                'CGTACG':'index22',
-                'CGTACGA':'index22',
-                'GAGTGG':'index23',
-                'GAGTGGA':'index23',
-                'ACTGAT':'index25',
-                'ACTGATA':'index25',
-                'ATTCCT':'index27',
-                'ATTCCTA':'index27',
-                }
+from scilifelab.illumina import map_index_names
+from scilifelab.illumina.barcodes import count_barcodes, DEFAULT_CAPACITY
 
 usage = """
 Count the barcodes occurring in a FASTQ file.
@@ -61,50 +11,29 @@ python count_barcodes.py <FASTQ file (can be gzipped; make sure the file extensi
 -o, --olb: The FASTQ file is generated by OLB or otherwise does not include the barcode in the header. Forces specification of start and length of barcode
 -s, --start: Starting position of barcode (default 101)
 -l, --length: Length of barcode (default 6)
-"""
+-w, --workers: Number of worker processes (default 1)
+-c, --capacity: Maximum number of distinct barcodes tracked (default %d)
+""" % DEFAULT_CAPACITY
 
 if len(sys.argv) < 2:
     print usage
     sys.exit(0)
 
 parser = optparse.OptionParser()
-parser.add_option('-o', '--olb', action="store_true", dest="old", default="False", help="Use if the FASTQ file is generated by OLB or otherwise does not include the barcode in the header.")
+parser.add_option('-o', '--olb', action="store_true", dest="old", default=False, help="Use if the FASTQ file is generated by OLB or otherwise does not include the barcode in the header.")
 parser.add_option('-s', '--start', action="store", dest="bcstart", default="101", help="Specify starting position of barcode (default 101)")
 parser.add_option('-l', '--length', action="store", dest="bclen", default="6", help="Specify length of barcode (default 6")
+parser.add_option('-w', '--workers', action="store", dest="workers", default="1", help="Specify the number of worker processes (default 1)")
+parser.add_option('-c', '--capacity', action="store", dest="capacity", default=str(DEFAULT_CAPACITY), help="Specify the maximum number of distinct barcodes tracked (default %d)" % DEFAULT_CAPACITY)
 
 (opts, args) = parser.parse_args()
-    
-bcodes = {} # collect counts for all observed barcodes
-
-gz = False
-if sys.argv[1][-2:] == 'gz': gz = True
-
-cntr = 0
-last_was_header = False
-pos = int(opts.bcstart)
-lgth = int(opts.bclen)
-
-if gz: fh = gzip.open(sys.argv[1])
-else: fh = open(sys.argv[1])
-
-if opts.old == True:    
-    for line in fh: 
-        if not last_was_header:
-            if line[0]=="@": last_was_header=True
-            continue
-        bcode = line[pos:(pos+lgth)].strip()
-        if bcodes.has_key(bcode): bcodes[bcode] += 1
-        else: bcodes[bcode] = 1
-        if last_was_header: last_was_header = False
 
-else:
-    for line in fh:
-        if line[0:4] == "@HWI": # Header 
-            bcode = line.strip().split(':')[-1]
-            if bcodes.has_key(bcode): bcodes[bcode] += 1
-            else: bcodes[bcode] = 1
+counts = count_barcodes(args[0], casava18=(not opts.old), offset=int(opts.bcstart), length=int(opts.bclen),
+                        capacity=int(opts.capacity), workers=int(opts.workers))
 
-for e in sorted(bcodes.items(), key=itemgetter(1)):
-    illum = '(no exact match to Illumina)'
-    if illumina_idx.has_key(e[0]): illum = illumina_idx[e[0]]
-    print e[0] + "\t" + str(e[1]) + "\t" + illum
+top = counts.most_common()
+index_names = map_index_names([bc for bc, count in top])
+for bc, count in reversed(top):
+    names = index_names[bc]
+    illum = ','.join(names) if len(names) > 0 else '(no exact match to Illumina)'
+    print bc + "\t" + str(count) + "\t" + illum
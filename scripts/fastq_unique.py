@@ -1,64 +1,65 @@
 """
-Reads a FastQ file from stdin and writes a file with unique records to sdout
+Reads a FastQ file (or a pair of FastQ files) and writes the unique records
+to INFILE-unique.fastq.gz, where INFILE is the input file name without the
+.fastq/.fq and .gz suffixes. Of records with identical sequences (for pairs,
+identical sequences of both reads), the copy with the highest average quality
+is kept.
 usage:
-    %s < in.fastq > out.unique.fastq
-
-see: http://hackmap.blogspot.com/2010/10/bloom-filter-ing-repeated-reads.html
+    %s [options] in.fastq [in_2.fastq]
 """
-from bloomfaster import Elf
-import collections
+import re
 import sys
+import itertools
+import argparse
 
-# Slight modification to read from input file instead of stdin
-from scilifelab.utils.fastq_utils import (FastQParser, FastQWriter)
+from scilifelab.utils.fastq_utils import (FastQParser, FastQWriterPool, unique_records, DEFAULT_MAX_MEMORY)
 
 __doc__ %= sys.argv[0]
-if len(sys.argv) > 2:
-    print sys.argv
-    print __doc__
-    sys.exit()
 
-print >>sys.stderr, "Command: ", " ".join(sys.argv)
-infile = sys.argv[1]
-fp = FastQParser(infile)
-for _ in fp:
-    pass
-records = fp.rread()
-print >>sys.stderr, records, "records in file ", infile
+def output_name(infile):
+    """Return the output file name of infile, with the .fastq/.fq and
+    .gz suffixes replaced by -unique.fastq.gz
+    """
+    return "%s-unique.fastq.gz" % re.sub(r'\.(fastq|fq)$', '', re.sub(r'\.gz$', '', infile))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('infiles', nargs='+', metavar='fastq',
+                        help="fastq file, followed by the paired fastq file for paired-end data")
+    parser.add_argument('-n','--records', type=int, default=None,
+                        help="the number of records in the (first) file. Estimated from the file size if not given")
+    parser.add_argument('-m','--max-memory', type=int, default=DEFAULT_MAX_MEMORY/(1024*1024),
+                        help="the approximate memory in MB to use for sorting sequence fingerprints before spilling to disk. Default is %(default)s")
+    parser.add_argument('-p','--phred', type=int, default=33,
+                        help="the Phred quality score offset. Default is 33 (Sanger)")
+    parser.add_argument('--tmpdir', default=None,
+                        help="directory for temporary files")
+    args = parser.parse_args()
+    if len(args.infiles) > 2:
+        parser.error("at most two fastq files can be given")
+    outfiles = [output_name(infile) for infile in args.infiles]
+    if len(set(outfiles)) < len(outfiles):
+        parser.error("the paired fastq files would both be written to {}".format(outfiles[0]))
 
-# say 1 out of 1000 is false positive.
-bloom = Elf(records, error_rate=1e-3)
-fp.seek(0)
-checks = []
-for _,seq,_,_ in fp:
-    if seq in bloom:
-        checks.append(seq)
-    bloom.add(seq)
+    print >>sys.stderr, "Command: ", " ".join(sys.argv)
+    keep = unique_records(args.infiles[0],
+                          args.infiles[1] if len(args.infiles) > 1 else None,
+                          args.records,
+                          args.max_memory*1024*1024,
+                          args.phred,
+                          args.tmpdir)
+    print >>sys.stderr, len(keep), "records in file ", args.infiles[0]
 
-# now checks contains anything that could be a duplicate according to
-# the bloomfilter. for some, they were false positives.
-# for actual duplicated, just choose the first, but can also sort by quality.
-fp.seek(0)
-checks = frozenset(checks)
-print >>sys.stderr, "checking %s potential duplicates in a python set" \
-                                            % len(checks)
-outfile = "%s-unique.fastq.gz" % infile.split(".")[0]                                            
-fw = FastQWriter(outfile)
+    pool = FastQWriterPool()
+    for infile, outfile in zip(args.infiles, outfiles):
+        n = 0
+        for batch in FastQParser(infile).batches():
+            pool.write_batch(outfile, list(itertools.compress(batch, keep[n:n+len(batch)].tolist())))
+            n += len(batch)
+        pool.close_file(outfile)
 
-putative_false_positives = collections.defaultdict(int)
-for header,seq,plus,qual in fp:
-    # it appeared only once, so just print it.
-    if not seq in checks:
-        fw.write([header,seq,plus,qual])
-        continue
-    # it appeared in the bloom-filter > 1x, so track and make sure not
-    # to print any others with same sequence.
-    putative_false_positives[seq] += 1
-    if putative_false_positives[seq] > 1:
-        continue
-    fw.write([header,seq,plus,qual])
+    unique = int(keep.sum())
+    print >>sys.stderr, unique, "unique records,", len(keep) - unique, "duplicates removed"
 
-fw.close()
-false_positives = sum(1 for count in putative_false_positives.values() \
-                                                        if count == 1)
-print >>sys.stderr,  false_positives, "false-positive duplicates in the bloom filter"
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,7 @@ import datetime
 import subprocess
 from platform import node as host_name
 from pprint import pprint
-import couchdb
+from scilifelab.db.connection import get_server, save_documents
 
 def main():
     parser = argparse.ArgumentParser(description="Formats uquota \
@@ -45,10 +45,9 @@ def main():
     if args.server == "":
         pprint(project_list)
     else:
-        couch = couchdb.Server(args.server)
+        couch = get_server(args.server)
         db = couch[args.db]
-        for fs_dict in project_list:
-            db.save(fs_dict)
+        save_documents(db, project_list)
 
 if __name__ == "__main__":
     main()
@@ -13,7 +13,7 @@ import os
 import argparse
 import subprocess
 import datetime
-import couchdb
+from scilifelab.db.connection import get_server
 import re
 
 
@@ -65,7 +65,7 @@ def parse_dirsizes(path, dirsizes={"errors": []}):
 def send_db(server, db, data):
     """ Submits provided data to database on server
     """
-    couch = couchdb.Server(server)
+    couch = get_server(server)
     db = couch[db]
     db.save(data)
     #with open("runsizes.log", "w") as fh:
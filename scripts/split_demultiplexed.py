@@ -3,11 +3,10 @@ Script that will split fastq files with demultiplex information in the (CASAVA 1
 """
 
 import os
-import csv
 import re
 import operator
 from scilifelab.miseq import (MiSeqSampleSheet, group_fastq_files)
-from scilifelab.utils.fastq_utils import (FastQParser, FastQWriter)
+from scilifelab.utils.fastq_utils import (FastQParser, FastQWriterPool, write_demultiplex_metrics)
  
 from optparse import OptionParser
 
@@ -42,39 +41,29 @@ def _split_fastq(fastq_input, outdir, outprefix, outsuffix, samples):
     if not os.path.exists(outdir):
         os.mkdir(outdir) 
     
-    out_handles = {}    
+    # buffer the output in a writer pool to limit the number of open files
+    pool = FastQWriterPool()
+    out_files = {}    
     for file in fastq_input:
         iter = FastQParser(file)
-        for record in iter:
-            index = record[0].rfind(":")
-            i = record[0][index+1:].strip()
-            # open a file handle to the index file if it's not already available
-            if i not in out_handles:
-                out_file = os.path.join(outdir,"%s_%s%s" % (outprefix,samples.get(i,i),outsuffix))
-                out_handles[i] = FastQWriter(out_file)
-            out_handles[i].write(record)
+        for batch in iter.batches():
+            for record in batch:
+                index = record[0].rfind(":")
+                i = record[0][index+1:].strip()
+                if i not in out_files:
+                    out_files[i] = os.path.join(outdir,"%s_%s%s" % (outprefix,samples.get(i,i),outsuffix))
+                pool.write(out_files[i],record)
     
-    # summarize the written records and close the file handles
+    # summarize the written records and close the files
+    pool.close()
     counts = {}
-    for i,oh in out_handles.items():
-        counts[i] = oh.rwritten()
-        oh.close()
+    for i,out_file in out_files.items():
+        counts[i] = pool.rwritten(out_file)
         
     return counts
     
 def _write_metrics(counts, outdir, outprefix, samples):
-    
-    if not os.path.exists(outdir):
-        os.mkdir(outdir)
-    
-    metrics_file = os.path.join(outdir,"%s.demultiplex_metrics" % outprefix)
-    with open(metrics_file,"wb") as fh:
-        cw = csv.writer(fh,dialect=csv.excel_tab)
-        cw.writerow(["index","samplesheet sample name","records"])
-        for index, count in counts.items():
-            cw.writerow([index,samples.get(index,"N/A"),count])
-
-    return metrics_file
+    return write_demultiplex_metrics(counts, outdir, outprefix, samples)
     
 if __name__ == "__main__":
     parser = OptionParser()
@@ -5,7 +5,7 @@ Otherwise prints the dictionaries.
 import argparse
 import datetime
 import subprocess
-import couchdb
+from scilifelab.db.connection import get_server, save_documents
 from platform import node as host_name
 
 def main():
@@ -45,10 +45,9 @@ def main():
     if args.server == "":
         print(file_systems)
     else:
-        couch = couchdb.Server(args.server)
+        couch = get_server(args.server)
         db = couch[args.db]
-        for fs_dict in file_systems:
-            db.save(fs_dict)
+        save_documents(db, file_systems)
 
 if __name__ == "__main__":
     main()
@@ -3,7 +3,7 @@ import tempfile
 import shutil
 import unittest
 from ..data import data_files
-from scilifelab.bcbio.qc import RunInfoParser
+from scilifelab.bcbio.qc import RunInfoParser, MetricsFileIndex
 
 filedir = os.path.abspath(os.path.realpath(os.path.dirname(__file__)))
 
@@ -28,3 +28,26 @@ class TestBcbioQC(unittest.TestCase):
         self.assertEqual(res["Instrument"], "SN0002")
         self.assertEqual(res["Date"], "120924")
 
+    def test_metrics_file_index(self):
+        """Classify the metrics files of a flowcell directory by lane, barcode id and metric"""
+        files = [os.path.join("fc", x) for x in ["1_120924_AC003CCCXX_nophix_1-sort-dup.align_metrics", "1_120924_AC003CCCXX_nophix_1-sort-dup.hs_metrics",
+                                                 "1_120924_AC003CCCXX_nophix_10-sort-dup.align_metrics", "2_120924_AC003CCCXX_1_nophix-sort-dup.dup_metrics",
+                                                 "1_120924_AC003CCCXX_1_1_screen.txt", "1_120924_AC003CCCXX_1_2_screen.txt",
+                                                 "fastqc/1_120924_AC003CCCXX_nophix_1-sort-dup_fastqc/fastqc_data.txt",
+                                                 "fastqc/1_120924_AC003CCCXX_nophix_1-sort-dup_fastqc/summary.txt",
+                                                 "1_120924_AC003CCCXX_barcode/1_120924_AC003CCCXX_nophix.bc_metrics",
+                                                 "P001_101_index1-bcbb-config.yaml", "1_120924_AC003CCCXX_nophix_1-sort-dup.bam",
+                                                 "1_120924_AC003CCCXX_2_nophix.filter_metrics", "nophix/1_120924_AC003CCCXX_nophix.filter_metrics"]]
+        index = MetricsFileIndex(files)
+        self.assertListEqual(index.get(1, 1, "picard"), files[0:2])
+        self.assertListEqual(index.get("1", "10", "picard"), files[2:3])
+        self.assertListEqual(index.get(2, 1, "picard"), files[3:4])
+        self.assertListEqual(index.get(1, 1, "fastq_screen"), files[4:6])
+        self.assertListEqual(index.get(1, 1, "fastqc"), files[6:7])
+        self.assertListEqual(index.get(1, None, "bc"), files[8:9])
+        self.assertListEqual(index.get(3, 1, "picard"), [])
+        self.assertListEqual(index.get(1, 2, "filter"), files[11:12])
+        # Filter metrics of a lane are not filed under a barcode id 'nophix'
+        self.assertListEqual(index.get(1, None, "filter"), files[12:13])
+        self.assertListEqual(index.get(1, "nophix", "filter"), [])
+        self.assertListEqual(index.metrics_files, files[0:7] + files[8:10] + files[11:13])
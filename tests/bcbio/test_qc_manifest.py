@@ -0,0 +1,78 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from scilifelab.bcbio.qc import SampleRunMetricsParser
+from scilifelab.bcbio.qc.manifest import QCManifest, MANIFEST_FILE
+from scilifelab.db.statusdb import SampleRunMetricsDocument
+
+class TestQCManifest(unittest.TestCase):
+    def setUp(self):
+        # The parsers ignore paths matching "tmp", so do not use the system temp dir
+        self.rootdir = tempfile.mkdtemp(prefix="test_qc_manifest_", dir=os.path.dirname(os.path.abspath(__file__)))
+        self.path = os.path.join(self.rootdir, MANIFEST_FILE)
+        self.files = []
+        for fn in ["1_120924_AC003CCCXX_1-sort-dup.align_metrics", "1_120924_AC003CCCXX_1_1_screen.txt",
+                   os.path.join("fastqc", "1_120924_AC003CCCXX_1-sort-dup_fastqc", "fastqc_data.txt"), "1_120924_AC003CCCXX_1-sort-dup.bam"]:
+            self.files.append(os.path.join(self.rootdir, fn))
+            if not os.path.exists(os.path.dirname(self.files[-1])):
+                os.makedirs(os.path.dirname(self.files[-1]))
+            with open(self.files[-1], "w") as fh:
+                fh.write(fn)
+        self.files = self.files[0:3]
+        self.obj = SampleRunMetricsDocument(flowcell="AC003CCCXX", date="120924", lane="1", barcode_name="P001_101_index1", sequence="ACGTAC")
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_metrics_files(self):
+        """Only hash the files that metrics are parsed from"""
+        parser = SampleRunMetricsParser(self.rootdir)
+        self.assertListEqual(sorted(self.files), sorted(parser.metrics_files()))
+
+    def test_inputs_changed(self):
+        """Parse a sample run only if its metrics files have changed since the last upload"""
+        manifest = QCManifest(self.path)
+        self.assertTrue(manifest.inputs_changed(self.obj["name"], self.files))
+        self.assertEqual(3, manifest.hashed)
+        manifest.commit(self.obj["name"])
+        manifest.save()
+        manifest = QCManifest(self.path)
+        self.assertTrue(manifest.known(self.obj["name"]))
+        self.assertFalse(manifest.inputs_changed(self.obj["name"], self.files))
+        self.assertEqual(0, manifest.hashed)
+        # Touching a file rehashes it, but the content is unchanged
+        os.utime(self.files[0], (time.time() + 10, time.time() + 10))
+        self.assertFalse(manifest.inputs_changed(self.obj["name"], self.files))
+        self.assertEqual(1, manifest.hashed)
+        self.assertTrue(manifest.inputs_changed(self.obj["name"], self.files, {"Barcode_lane_statistics":[]}))
+        with open(self.files[1], "a") as fh:
+            fh.write("changed")
+        self.assertTrue(manifest.inputs_changed(self.obj["name"], self.files))
+        # Staged changes are only recorded on commit
+        self.assertTrue(manifest.inputs_changed(self.obj["name"], self.files))
+
+    def test_document_changed(self):
+        """Upload a document only if its content has changed since the last upload"""
+        manifest = QCManifest(self.path)
+        self.assertTrue(manifest.document_changed(self.obj))
+        manifest.commit(self.obj["name"])
+        obj = SampleRunMetricsDocument(**self.obj)
+        obj["_id"] = "another_id"
+        obj["modification_time"] = "later"
+        self.assertFalse(manifest.document_changed(obj))
+        obj["bc_count"] = 1000
+        self.assertTrue(manifest.document_changed(obj))
+        self.assertEqual(1, manifest.skipped)
+
+    def test_save_unwritable(self):
+        """Warn instead of failing if the manifest can not be written"""
+        manifest = QCManifest(os.path.join(self.rootdir, "missing", MANIFEST_FILE))
+        self.assertTrue(manifest.save())
+        # A file in place of the manifest directory fails as a read-only directory would, also for root
+        manifest = QCManifest(os.path.join(self.files[0], MANIFEST_FILE))
+        manifest.inputs_changed(self.obj["name"], self.files)
+        manifest.commit(self.obj["name"])
+        self.assertFalse(manifest.save())
@@ -0,0 +1,90 @@
+"""Throughput benchmark for the fastq parser
+
+Compares the line-based parsing used before the block reader with
+record-by-record and batched parsing through FastQParser, on plain
+and gzip-compressed input. Run from the repository root:
+
+    python tests/benchmark/bench_fastq_parser.py [-n RECORDS]
+"""
+import os
+import sys
+import gzip
+import time
+import shutil
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
+import scilifelab.utils.fastq_utils as fu
+import tests.generate_test_data as td
+
+class LineFastQParser:
+    """The line-based parsing of FastQParser before the block reader
+    """
+    def __init__(self,file):
+        fh = open(file,"rb")
+        if file.endswith(".gz"):
+            self._fh = gzip.GzipFile(fileobj=fh)
+        else:
+            self._fh = fh
+        self._records_read = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        self._records_read += 1
+        return [self._fh.next().strip() for n in range(4)]
+
+def _line_parser(fname):
+    return LineFastQParser(fname)
+
+def _record_parser(fname):
+    return fu.FastQParser(fname)
+
+def _batch_parser(fname):
+    for batch in fu.FastQParser(fname).batches():
+        for record in batch:
+            yield record
+
+def write_fastq(fname, nrecords, pool=1000):
+    """Write nrecords fastq records, cycling over a pool of generated records
+    """
+    records = [td.generate_fastq_record() for i in xrange(pool)]
+    fqw = fu.FastQWriter(fname)
+    for i in xrange(nrecords):
+        fqw.write(records[i % pool])
+    fqw.close()
+    return fname
+
+def benchmark(fname, nrecords):
+    for name, parser in [("line-based", _line_parser),
+                         ("FastQParser.next", _record_parser),
+                         ("FastQParser.batches", _batch_parser)]:
+        start = time.time()
+        n = 0
+        for record in parser(fname):
+            n += 1
+        elapsed = time.time() - start
+        assert n == nrecords, "{} parsed {} records, expected {}".format(name,n,nrecords)
+        print "{:<12}{:<24}{:>10.2f} s{:>14.0f} reads/s".format(os.path.basename(fname).split(".",1)[1],
+                                                              name,
+                                                              elapsed,
+                                                              nrecords/elapsed)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark fastq parsing throughput")
+    parser.add_argument('-n','--records', type=int, default=1000000,
+                        help="number of records to parse. Default is 1000000")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="bench_fastq_parser_")
+    try:
+        for suffix in [".fastq",".fastq.gz"]:
+            fname = write_fastq(os.path.join(tmpdir,"bench{}".format(suffix)), args.records)
+            benchmark(fname, args.records)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
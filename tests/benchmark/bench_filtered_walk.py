@@ -0,0 +1,101 @@
+"""Benchmark for filtered directory walks
+
+Compares the os.walk based filtered_walk used before the scandir walker
+with iter_filtered_walk, sequentially and with parallel subtree walks,
+on a synthetic production tree of a multi-sample project. Run from the
+repository root:
+
+    python tests/benchmark/bench_filtered_walk.py [-n FILES] [-w WORKERS]
+"""
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
+from scilifelab.utils.misc import iter_filtered_walk
+
+## Subdirectories of a sample run directory, as set up by bcbb
+SAMPLE_RUN_DIRS = ["alignments", "fastqc", "fastq_screen", "nophix", "realign-split", "tx"]
+
+def os_walk_filtered_walk(rootdir, filter_fn, include_dirs=None, exclude_dirs=None, get_dirs=False):
+    """The os.walk based filtered_walk before the scandir walker
+    """
+    flist = []
+    dlist = []
+    for root, dirs, files in os.walk(rootdir):
+        if include_dirs and len(set(root.split(os.sep)).intersection(set(include_dirs))) == 0:
+            if re.search("|".join(include_dirs), root):
+                pass
+            else:
+                continue
+        if exclude_dirs and len(set(root.split(os.sep)).intersection(set(exclude_dirs))) > 0:
+            continue
+        if exclude_dirs and re.search("|".join(exclude_dirs), root):
+            continue
+        dlist = dlist + [os.path.join(root, x) for x in dirs]
+        flist = flist + [os.path.join(root, x) for x in filter(filter_fn, files)]
+    if get_dirs:
+        return dlist
+    else:
+        return flist
+
+def make_project(rootdir, nfiles, files_per_dir=50):
+    """Make a project tree of samples with one sample run each, spreading
+    nfiles files over the sample run directories and their subdirectories
+    """
+    ndirs = max(1, nfiles / files_per_dir)
+    nsamples = max(1, ndirs / (len(SAMPLE_RUN_DIRS) + 1))
+    n = 0
+    for i in xrange(nsamples):
+        sample = "P001_{}".format(101 + i)
+        sample_run = os.path.join(rootdir, "J.Doe_00_01", sample, "120924_AC003CCCXX")
+        for d in [sample_run] + [os.path.join(sample_run, x) for x in SAMPLE_RUN_DIRS]:
+            os.makedirs(d)
+            for j in xrange(files_per_dir):
+                suffix = "-bcbb-config.yaml" if j == 0 and d == sample_run else "_{}.txt".format(j)
+                open(os.path.join(d, "1_120924_AC003CCCXX_{}{}".format(sample, suffix)), "w").close()
+                n += 1
+    return n
+
+def benchmark(rootdir, workers):
+    def yaml_filter(f):
+        return re.search("-bcbb-config.yaml$", f) != None
+    project = os.path.join(rootdir, "J.Doe_00_01")
+    for label, kw in [("all files", dict(filter_fn=None)),
+                      ("config files, pruned", dict(filter_fn=yaml_filter, exclude_dirs=SAMPLE_RUN_DIRS))]:
+        walkers = [("os.walk filtered_walk", lambda: os_walk_filtered_walk(project, kw["filter_fn"], exclude_dirs=kw.get("exclude_dirs"))),
+                   ("iter_filtered_walk", lambda: list(iter_filtered_walk(project, **kw))),
+                   ("iter_filtered_walk -w {}".format(workers), lambda: list(iter_filtered_walk(project, workers=workers, **kw)))]
+        expected = None
+        for name, fn in walkers:
+            start = time.time()
+            flist = fn()
+            elapsed = time.time() - start
+            if expected is None:
+                expected = flist
+            assert flist == expected, "{} found {} files, expected {}".format(name, len(flist), len(expected))
+            print "{:<24}{:<28}{:>10.2f} s{:>10} files".format(label, name, elapsed, len(flist))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark filtered directory walks")
+    parser.add_argument('-n','--files', type=int, default=200000,
+                        help="number of files in the project tree. Default is 200000")
+    parser.add_argument('-w','--workers', type=int, default=4,
+                        help="number of threads for the parallel walk. Default is 4")
+    args = parser.parse_args()
+
+    # Not in the system temp dir, since the qc parsers skip paths matching 'tmp'
+    tmpdir = tempfile.mkdtemp(prefix="bench_filtered_walk_", dir=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        n = make_project(tmpdir, args.files)
+        print "Made a project tree of {} files".format(n)
+        benchmark(tmpdir, args.workers)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
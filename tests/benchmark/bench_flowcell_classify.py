@@ -0,0 +1,110 @@
+"""Benchmark for classifying the files of a flowcell
+
+Compares the per-file classification of Flowcell.collect_files before
+the file classifier, which matched every file against an alternation
+over all samples, with Flowcell.classify_files, on the file names of a
+synthetic HiSeq X flowcell in casava layout. The former fails for
+flowcells of more than about 100 samples, as the regular expression
+module of python 2 supports at most 100 groups. Run from the repository
+root:
+
+    python tests/benchmark/bench_flowcell_classify.py [-s SAMPLES] [-c CHUNKS]
+"""
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
+from scilifelab.bcbio.flowcell import Flowcell
+
+FLOWCELL = "H003CCCXX"
+LANES = range(1, 9)
+BASES = "ACGT"
+
+def make_samplesheet(outfile, samples_per_lane):
+    """Write a casava samplesheet of a flowcell with samples_per_lane
+    samples in each lane, split over two projects
+    """
+    with open(outfile, "w") as fh:
+        fh.write("FCID,Lane,SampleID,SampleRef,Index,Description,Control,Recipe,Operator,SampleProject\n")
+        for lane in LANES:
+            for i in xrange(samples_per_lane):
+                index = "".join(BASES[(i >> (2 * j)) & 3] for j in range(6))
+                project = "J.Doe_00_01" if i % 2 == 0 else "J.Doe_00_02"
+                fh.write("{},{},P00{}_{},hg19,{},{},N,R1,NN,{}\n".format(FLOWCELL, lane, 1 + i % 2, 101 + i + 1000 * lane, index, project, project))
+
+def make_files(fc, chunks):
+    """Make the file names of the sample runs of a flowcell, with chunks
+    fastq files per read, and result files and pipeline output
+    """
+    files = []
+    for sample in fc:
+        pfx = "{}_{}_L00{}".format(sample['name'], sample['sequence'], sample['lane'])
+        for read in [1, 2]:
+            files.extend(["{}_R{}_{:03d}.fastq.gz".format(pfx, read, j) for j in xrange(1, chunks + 1)])
+        files.extend(["{}-sort-dup.{}".format(pfx, x) for x in ["bam", "align_metrics", "dup_metrics", "insert_metrics", "hs_metrics"]])
+        files.append("{}-bcbb-config.yaml".format(sample['name']))
+    files.extend(["{:02d}_pipeline_step.txt".format(j) for j in range(1, 15)] + ["bcbb_software_versions.txt", "SampleSheet.csv"])
+    return files
+
+def legacy_classify_file(fc, f):
+    """Casava part of Flowcell.classify_file before the file classifier.
+    That used m.group(1), the group of the first sample name only; the
+    group that matched is used here."""
+    names = fc._column("name")
+    pattern = "|".join("^({}).*".format(x) for x in names)
+    m = re.compile(pattern).search(os.path.basename(f))
+    if m:
+        row = fc._row(names.index(m.group(m.lastindex)))
+        key = "{}_{}".format(row[0], row[10])
+        fc.append_to_entry(key, "files" if re.search("fastq(\.gz)?$", f) else "results", os.path.abspath(f))
+
+def legacy_collect_files(fc, files):
+    pattern = "|".join(fc.glob_pfx_str())
+    for f in [x for x in files if re.search(pattern, x) != None]:
+        legacy_classify_file(fc, f)
+    return fc
+
+def new_collect_files(fc, files):
+    fc.classify_files([x for x in files if fc.classifier().collect(x)])
+    return fc
+
+def benchmark(samplesheet, chunks):
+    files = make_files(Flowcell(samplesheet), chunks)
+    expected = None
+    for name, fn in [("alternation per file", legacy_collect_files), ("FileClassifier", new_collect_files)]:
+        fc = Flowcell(samplesheet)
+        start = time.time()
+        try:
+            fn(fc, files)
+        except AssertionError as e:
+            print "{:<24}failed: {}".format(name, e)
+            continue
+        elapsed = time.time() - start
+        if expected is None:
+            expected = fc.data
+        assert fc.data == expected, "{} classified the files differently".format(name)
+        print "{:<24}{:>10.2f} s{:>10} files{:>8} samples".format(name, elapsed, len(files), len(fc))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark flowcell file classification")
+    parser.add_argument('-s','--samples', type=int, default=12,
+                        help="number of samples per lane. Default is 12")
+    parser.add_argument('-c','--chunks', type=int, default=16,
+                        help="number of fastq files per read and sample. Default is 16")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="bench_flowcell_classify_")
+    try:
+        samplesheet = os.path.join(tmpdir, "{}.csv".format(FLOWCELL))
+        make_samplesheet(samplesheet, args.samples)
+        benchmark(samplesheet, args.chunks)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
@@ -283,6 +283,15 @@ class TestQCUpload(PmFullTest):
         s = self.s_con.get_entry("4_120924_AC003CCCXX_CGTTAA")
         self.assertIsNone(s["project_sample_name"])
         self.assertEqual(s["project_id"], "P003")
+
+    def test_qc_upload_workers(self):
+        """Test running qc upload with several workers"""
+        samples = {s["name"]:s for s in self.s_con.get_samples(fc_id="AC003CCCXX")}
+        self.app = self.make_app(argv = ['qc', 'upload-qc', flowcells[0], '--mtime',  '10000', '--workers', '4', '--no_manifest'], extensions=['scilifelab.pm.ext.ext_qc', 'scilifelab.pm.ext.ext_couchdb'])
+        self._run_app()
+        # Parsing in parallel gives the same documents, so none is modified
+        for s in self.s_con.get_samples(fc_id="AC003CCCXX"):
+            self.assertEqual(samples[s["name"]]["_rev"], s["_rev"])
         
     def test_qc_update(self):
         """Test running qc update of a project id"""
@@ -0,0 +1,95 @@
+"""Test the illumina/barcodes.py functionality
+"""
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from collections import Counter
+
+import scilifelab.utils.fastq_utils as fu
+import tests.generate_test_data as td
+from scilifelab.illumina.barcodes import (count_barcodes, exclusion_set, shard_offsets)
+
+class TestCountBarcodes(unittest.TestCase):
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_barcodes_")
+        self.fqfile = os.path.join(self.rootdir, "undetermined.fastq.gz")
+        self.indexes = ["ACGTAC", "TTGACA", "GGCATT", "CATGCA"]
+        barcodes = []
+        for i, ix in enumerate(self.indexes):
+            barcodes.extend([ix]*(100*(i + 1)))
+        barcodes.extend([td.generate_barcode() for n in xrange(500)])
+        random.shuffle(barcodes)
+        self.fqfile_plain = os.path.join(self.rootdir, "undetermined.fastq")
+        for fqfile in [self.fqfile, self.fqfile_plain]:
+            fqw = fu.FastQWriter(fqfile)
+            for bc in barcodes:
+                fqw.write(td.generate_fastq_record(index=bc))
+            fqw.close()
+        self.barcodes = barcodes
+        self.exact = Counter(barcodes)
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_exclusion_set(self):
+        """Exclude expected barcodes with and without mismatches
+        """
+        self.assertSetEqual(set(self.indexes), exclusion_set(self.indexes))
+        excluded = exclusion_set(["ACGTAC"], True)
+        self.assertEqual(1 + 6*4, len(excluded))
+        self.assertIn("ACGTAN", excluded)
+
+    def test_count_barcodes(self):
+        """Count the barcodes in chunks and across processes
+        """
+        for workers in [1, 2]:
+            c = count_barcodes(self.fqfile, capacity=2000, workers=workers, chunk_size=200)
+            self.assertEqual(len(self.barcodes), c.total)
+            self.assertDictEqual(dict(self.exact), c.counter.counts)
+        c = count_barcodes(self.fqfile, capacity=50, chunk_size=200)
+        self.assertListEqual(self.indexes[::-1], [bc for bc, count in c.most_common(4)])
+
+    def test_count_barcodes_excluded(self):
+        """Skip the excluded barcodes and sample the first reads
+        """
+        c = count_barcodes(self.fqfile, excluded=exclusion_set(self.indexes[-1:]))
+        self.assertNotIn(self.indexes[-1], c.counter.counts)
+        self.assertEqual(self.exact[self.indexes[0]], c.counter.counts[self.indexes[0]])
+        c = count_barcodes(self.fqfile, max_reads=100, chunk_size=30)
+        self.assertEqual(100, c.total)
+        self.assertDictEqual(dict(Counter(self.barcodes[0:100])), c.counter.counts)
+
+    def test_shard_offsets(self):
+        """Split an uncompressed file into byte ranges at record boundaries
+        """
+        shards = shard_offsets(self.fqfile_plain, 7)
+        self.assertEqual(0, shards[0][0])
+        self.assertEqual(os.path.getsize(self.fqfile_plain), shards[-1][1])
+        barcodes = []
+        for start, end in shards:
+            bcx = fu.BarcodeExtractor(self.fqfile_plain, start=start, end=end, blocksize=1000)
+            barcodes.extend(list(bcx))
+        self.assertListEqual(self.barcodes, barcodes)
+
+    def test_count_barcodes_sharded(self):
+        """Count the barcodes of an uncompressed file in byte ranges across processes
+        """
+        c = count_barcodes(self.fqfile_plain, workers=3, chunk_size=200, lane="1")
+        self.assertEqual(len(self.barcodes), c.total)
+        self.assertDictEqual(dict(self.exact), c.counter.counts)
+        rows = c.rows(4)
+        self.assertListEqual(self.indexes[::-1], [r['sequence'] for r in rows])
+        self.assertListEqual(["1"]*4, [r['lane'] for r in rows])
+        self.assertListEqual([str(self.exact[ix]) for ix in self.indexes[::-1]], c.to_dict(4)['count'])
+
+    def test_index_sequences(self):
+        """Extract the barcodes from CASAVA 1.8, CASAVA 1.7 and sequence positions
+        """
+        records = [("@SN1:1:FC:1:1101:1000:2000 1:N:0:ATCACG-CGATGT", "GATTACAGGG", "+", "IIIIIIIIII"),
+                   ("@HWI-ST1:1:1:1000:2000#TTAGGC/1", "CCCTTAGGCA", "+", "IIIIIIIIII")]
+        self.assertEqual("ATCACG-CGATGT", fu.index_sequences(records[0:1])[0])
+        self.assertEqual("TTAGGC", fu.index_sequences(records[1:], casava18=False, offset=None)[0])
+        self.assertEqual("TTAGGC", fu.index_sequences(records[1:], casava18=False, offset=3, length=6)[0])
@@ -9,7 +9,7 @@ import bcbio.utils as utils
 import tests.generate_test_data as td
 import scilifelab.illumina as illumina
 from scilifelab.illumina import IlluminaRun
-from scilifelab.illumina import map_index_name
+from scilifelab.illumina import map_index_name, map_index_names, ambiguous_indexes
         
 class TestIlluminaRun(unittest.TestCase):
     
@@ -54,6 +54,38 @@ class TestIlluminaRun(unittest.TestCase):
         for name in random_keys:
             self.assertIn(name,map_index_name(BASIC_LOOKUP[name],0),
                           "Exact mapping did not return expected index name")
+
+        # Compare the lookup to comparing against each index, for random sequences and neighbours of known indexes
+        sequences = [td.generate_barcode() for n in xrange(25)] + [BASIC_LOOKUP[name] for name in random_keys]
+        sequences += [s[:3] + "N" + s[4:] for s in sequences] + [s[:1] + "TT" + s[3:] for s in sequences]
+        for index in sequences:
+            for mismatch in [0,1,2]:
+                self.assertListEqual(illumina._scan_index_name(index,mismatch),map_index_name(index,mismatch),
+                                     "Mapping {} with {} mismatches did not match the exhaustive comparison".format(index,mismatch))
+
+    def test_map_index_name_variants(self):
+        """Map dual and 7 base index sequences to names
+        """
+        self.assertIn("index1", map_index_name("ATCACGA"))
+        self.assertIn("index1", map_index_name("ATCACC", 1))
+        self.assertNotIn("index1", map_index_name("ATCACC"))
+        self.assertIn("index1-index2", map_index_name("ATCACG-CGATGT"))
+        self.assertIn("index1-index2", map_index_name("ATCACG+CGATGT"))
+        self.assertListEqual([], map_index_name("ATCACG-AAAAAA"))
+        self.assertListEqual([], map_index_name("ATCACGTT"))
+        names = map_index_names(["ATCACG", "CGATGT", "ATCACG"])
+        self.assertListEqual(["ATCACG", "CGATGT"], sorted(names.keys()))
+        self.assertIn("index2", names["CGATGT"])
+
+    def test_ambiguous_indexes(self):
+        """Find sequences in the neighbourhoods of several index sequences
+        """
+        from scilifelab.illumina.index_definitions import BASIC_LOOKUP
+        self.assertDictEqual({}, ambiguous_indexes(0))
+        ambiguous = ambiguous_indexes(1)
+        for index, names in ambiguous.items():
+            self.assertListEqual(names, map_index_name(index, 1))
+            self.assertGreater(len(set([BASIC_LOOKUP[name] for name in names])), 1)
       
     def test_get_flowcell(self):
         """Get flowcell from analysis directory
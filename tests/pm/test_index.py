@@ -0,0 +1,34 @@
+"""
+Test index controller
+"""
+import os
+from cement.core import handler
+from test_default import PmTest
+from scilifelab.pm.core.index import IndexController
+from scilifelab.utils.fileindex import INDEX_FILE
+
+filedir = os.path.abspath(os.path.dirname(os.path.realpath(__file__)))
+project = os.path.join(filedir, "data", "projects", "j_doe_00_01")
+
+class PmIndexTest(PmTest):
+    def tearDown(self):
+        if os.path.exists(os.path.join(project, INDEX_FILE)):
+            os.unlink(os.path.join(project, INDEX_FILE))
+
+    def test_rebuild_status(self):
+        """Test indexing a project and showing the index status"""
+        self.app = self.make_app(argv=['index', 'rebuild', 'j_doe_00_01'])
+        handler.register(IndexController)
+        self._run_app()
+        self.assertTrue(os.path.exists(os.path.join(project, INDEX_FILE)))
+        self.app = self.make_app(argv=['index', 'status', project])
+        handler.register(IndexController)
+        self._run_app()
+        self.assertIn("root\t{}\n".format(project), self.app._output_data['stdout'].getvalue())
+
+    def test_rebuild_dry_run(self):
+        """Test indexing a project with dry run"""
+        self.app = self.make_app(argv=['index', 'rebuild', 'j_doe_00_01', '-n'])
+        handler.register(IndexController)
+        self._run_app()
+        self.assertFalse(os.path.exists(os.path.join(project, INDEX_FILE)))
@@ -81,6 +81,54 @@ class FlowcellTest(PmTest):
         print fc
         print fc.lane_files
 
+    def test_classify_files(self):
+        """Classify files by lane and sample with the flowcell file classifier"""
+        fc = Flowcell(runinfo)
+        for lane in fc.lanes():
+            fc.lane_files[lane] = []
+        files = [os.path.join(fc_dir, x) for x in ["1_120829_AA001AAAXX_nophix.bc_metrics", "1_120829_AA001AAAXX_nophix_10_1_fastq.txt",
+                                                   "1_120829_AA001AAAXX_nophix_10-sort-dup.bam", "2_120829_AA001AAAXX_nophix_unmatched.bam", "09_realign_sample.txt"]]
+        self.assertListEqual([(c.lane, c.key, c.group) for c in fc.classify_files(files)],
+                             [('1', None, 'lane_files'), ('1', '1_GCCAAT', 'files'), ('1', '1_GCCAAT', 'results'), ('2', None, 'lane_files')])
+        self.eq(fc.get_entry('1_GCCAAT', 'files'), files[1:2])
+        self.eq(fc.lane_files['1'], files[0:1])
+        self.assertTrue(all(fc.classifier().collect(os.path.basename(x)) for x in files))
+        self.assertFalse(fc.classifier().collect("1_120829_BB001BBBXX_nophix_10-sort-dup.bam"))
+
+    def test_classify_files_casava(self):
+        """Classify casava files by the longest sample name prefix"""
+        fc = Flowcell(samplesheet)
+        files = ["P001_101_index3_TGACCA_L001_R1_001.fastq.gz", "P001_102_index6_ACAGTG_L001_R1_001.fastq.gz", "P001_102_index6-sort-dup.bam", "P003_101_index3_TGACCA_L003_R1_001.fastq.gz"]
+        self.assertListEqual([(c.key, c.group) for c in fc.classify_files(files)],
+                             [('1_TGACCA', 'files'), ('1_ACAGTG', 'files'), ('1_ACAGTG', 'results')])
+        self.assertListEqual([fc.classifier().collect(x) for x in files], [True, True, True, False])
+
+    def test_flowcell_indexes(self):
+        """Look up lanes and names by index, and share entries with subsets"""
+        fc = Flowcell(runinfo)
+        fc_csv = Flowcell(samplesheet)
+        self.assertIsNot(fc.samples, fc_csv.samples)
+        self.assertIsNot(fc.lane_files, fc_csv.lane_files)
+        self.eq(fc.names('2'), ['P2_101_index19a', 'P2_102_index12a', 'P2_103_index3a', 'P2_104_index4a'])
+        self.eq(fc.barcodes('3'), [])
+        newfc = fc.subset("lane", "2").subset("name", "P2_103_index3a")
+        self.eq(len(newfc), 1)
+        self.eq(newfc.name_key("P2_103_index3a"), "2_TTAGGC")
+        newfc.set_entry("2_TTAGGC", "files", ["2_120829_AA001AAAXX_nophix_3_1_fastq.txt"])
+        self.eq(fc.get_entry("2_TTAGGC", "files"), ["2_120829_AA001AAAXX_nophix_3_1_fastq.txt"])
+        # Nested iteration does not share a cursor
+        self.eq(len([(x['name'], y['name']) for x in newfc for y in fc]), 11)
+
+    def test_to_dataframe(self):
+        """Get run information as a data frame"""
+        fc = Flowcell(runinfo)
+        df = fc.to_dataframe()
+        self.eq(list(df.columns), fc.keys)
+        self.eq(len(df), 11)
+        self.eq(list(df[df["lane"] == "2"]["sequence"]), fc.barcode_sequences('2'))
+        self.eq(len(fc.subset("sample_prj", "J.Doe_00_02").to_dataframe()), 4)
+        self.eq(len(Flowcell().to_dataframe()), 0)
+
     def test_unique_lanes(self):
         """Test that flowcell returns object with unique lanes"""
         fc = Flowcell(runinfo)
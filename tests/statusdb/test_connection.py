@@ -0,0 +1,132 @@
+"""Test the pooled couchdb connections against a local http server"""
+import json
+import threading
+import unittest
+import BaseHTTPServer
+import SocketServer
+
+import couchdb
+from scilifelab.db.connection import (ConnectionStats, RetryingSession, get_server, get_session, is_available, save_documents)
+
+class FlakyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers requests with a server error for the first failures requests"""
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.do_GET()
+
+    def do_GET(self):
+        self.server.requests += 1
+        if self.server.requests <= self.server.failures:
+            status, body = self.server.status, {"error":"unavailable", "reason":"try again"}
+        else:
+            status, body = 200, {"couchdb":"Welcome", "version":"1.2.0"}
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves each keep-alive connection in its own thread"""
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass
+
+class TestRetryingSession(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingServer(("127.0.0.1", 0), FlakyHandler)
+        self.server.requests = 0
+        self.server.failures = 0
+        self.server.status = 503
+        self.sessions = []
+        self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        # Close the pooled keep-alive connections so that the server threads exit
+        for session in self.sessions + [get_session(), get_session(retries=0)]:
+            for conns in session.connection_pool.conns.values():
+                for conn in conns:
+                    conn.close()
+            session.connection_pool.conns.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _session(self, **kw):
+        self.sessions.append(RetryingSession(timeout=5, backoff=0.01, **kw))
+        return self.sessions[-1]
+
+    def test_retry(self):
+        """Retry server errors with backoff and count the requests"""
+        self.server.failures = 2
+        stats = ConnectionStats()
+        server = couchdb.Server(self.url, session=self._session(retries=2, stats=stats))
+        self.assertEqual("1.2.0", server.version())
+        self.assertEqual(3, self.server.requests)
+        self.assertEqual(3, stats.requests)
+        self.assertEqual(2, stats.retries)
+        self.assertEqual(2, stats.errors)
+        self.assertGreater(stats.bytes_received, 0)
+        self.assertEqual(3, sum(n for b, n in stats.histogram()))
+
+    def test_no_retry(self):
+        """Give up after the retries, and do not retry client errors"""
+        self.server.failures = 5
+        stats = ConnectionStats()
+        server = couchdb.Server(self.url, session=self._session(retries=1, stats=stats))
+        self.assertRaises(couchdb.ServerError, server.version)
+        self.assertEqual(2, self.server.requests)
+        self.server.requests = 0
+        self.server.status = 404
+        self.assertRaises(couchdb.ResourceNotFound, server.version)
+        self.assertEqual(1, self.server.requests)
+
+    def test_no_retry_unsafe(self):
+        """Do not retry conflicts, nor server errors of requests that may have written"""
+        stats = ConnectionStats()
+        session = self._session(retries=2, stats=stats)
+        self.server.failures = 5
+        self.server.status = 409
+        self.assertRaises(couchdb.ResourceConflict, session.request, "GET", self.url)
+        self.assertEqual(1, self.server.requests)
+        self.server.requests = 0
+        self.server.status = 503
+        self.assertRaises(couchdb.ServerError, session.request, "POST", self.url + "/db", body="{}", headers={"Content-Type":"application/json"})
+        self.assertEqual(1, self.server.requests)
+        # Bulk fetches are POSTed but read-only
+        self.server.requests = 0
+        self.server.failures = 1
+        session.request("POST", self.url + "/db/_all_docs", body="{}", headers={"Content-Type":"application/json"})
+        self.assertEqual(2, self.server.requests)
+        self.assertEqual(1, stats.retries)
+
+    def test_shared_server(self):
+        """Share servers per url and check availability"""
+        self.assertIs(get_server(self.url), get_server(self.url + "/"))
+        self.assertIsNot(get_server(self.url), get_server(self.url, timeout=1))
+        self.assertTrue(is_available(get_server(self.url)))
+        self.server.failures = 100
+        self.assertFalse(is_available(get_server(self.url, retries=0)))
+
+class FakeDatabase(object):
+    """Database whose bulk updates conflict for documents with a _rev"""
+    name = "fake"
+
+    def update(self, docs):
+        return [("_rev" not in doc, doc["_id"], couchdb.ResourceConflict("conflict") if "_rev" in doc else "1-a") for doc in docs]
+
+class TestSaveDocuments(unittest.TestCase):
+    def test_save_documents(self):
+        """Raise on failed writes of a bulk save"""
+        db = FakeDatabase()
+        self.assertEqual(["a", "b"], save_documents(db, [{"_id":"a"}, {"_id":"b"}]))
+        self.assertRaises(couchdb.HTTPError, save_documents, db, [{"_id":"a"}, {"_id":"b", "_rev":"1-b"}])
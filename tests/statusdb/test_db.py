@@ -2,7 +2,18 @@ import os
 import unittest
 import ConfigParser
 import logbook
-from scilifelab.db.statusdb import  _match_barcode_name_to_project_sample
+import copy
+import shutil
+import tempfile
+from couchdb.client import Row
+from couchdb.http import ResourceConflict, ResourceNotFound, Resource
+from scilifelab.db import ViewProxy
+from scilifelab.db.cache import DocumentCache
+from uuid import uuid4
+from scilifelab.db.statusdb import  _match_barcode_name_to_project_sample, SampleRunMetricsConnection, SampleRunMetricsDocument, VIEWS
+from scilifelab.db.statusdb import ProjectSampleMatcher, review_matches, MATCH_EXACT, MATCH_PREFIX, MATCH_REVIEW
+from scilifelab.db.statusdb import _qc_projection, qc_frame, calc_avg_qv
+from scilifelab.report.qc import _srm_to_qc, assess_qc, assess_qc_frame
 
 from ..classes import has_couchdb_installation
 
@@ -75,4 +86,342 @@ class TestStatusdbFunctions(unittest.TestCase):
         res = _match_barcode_name_to_project_sample(bc, self.project_samples, True, force=True)
         self.assertEqual(None, res)
 
+    def test_match_all(self):
+        """Match the barcode names of a flowcell in one go and report the rules"""
+        self.project_samples["P001_10"] = {'customer_name':'10'}
+        self.project_samples["P002_11"] = {'customer_name':'gnu4'}
+        matcher = ProjectSampleMatcher(self.project_samples)
+        rule = lambda m: (m.sample_name, m.rule, m.confidence)
+        report = matcher.match_all(["P001_101_index1", "P001_102_index2", "P001_103_index3", "P005_5B_index5",
+                                    "SAMPLE_6A_index6", "gnu4_index4", "001_1_index1", None], extensive_matching=True)
+        self.assertEqual(("P001_101_index1", "exact", MATCH_EXACT), rule(report["P001_101_index1"]))
+        # The longest sample name prefix is used, so P001_10 does not match
+        self.assertEqual(("P001_102", "prefix", MATCH_PREFIX), rule(report["P001_102_index2"]))
+        self.assertEqual(("P001_103B", "prefix", MATCH_PREFIX), rule(report["P001_103_index3"]))
+        self.assertEqual(("5", "prefix_without_project_id", MATCH_PREFIX), rule(report["P005_5B_index5"]))
+        self.assertEqual(("SAMPLE_6A", "index_sample_name", MATCH_REVIEW), rule(report["SAMPLE_6A_index6"]))
+        self.assertIsNone(report["gnu4_index4"].sample_name)
+        self.assertListEqual(["4_index4", "P002_11"], report["gnu4_index4"].candidates)
+        self.assertIsNone(report["001_1_index1"].sample_name)
+        self.assertIsNone(report[None].sample_name)
+        accepted = review_matches(report, force=True)
+        self.assertListEqual(["P001_101_index1", "P001_102_index2", "P001_103_index3", "P005_5B_index5", "SAMPLE_6A_index6"], sorted(accepted.keys()))
+        self.assertEqual("gnu5", accepted["P005_5B_index5"]["project_sample"]["customer_name"])
+        self.assertIsNone(matcher.match("SAMPLE_6A_index6").sample_name)
 
+
+    def test_qc_frame(self):
+        """Compute the qc metrics of all sample runs at once"""
+        docs = [SampleRunMetricsDocument(flowcell="AC003CCCXX", date="120924", lane="1", sample_prj="J.Doe_00_01", barcode_name="P001_101_index1",
+                                         picard_metrics={"AL_PAIR":{"TOTAL_READS":"2000000", "PCT_PF_READS_ALIGNED":"0,95"},
+                                                         "DUP_metrics":{"PERCENT_DUPLICATION":"0.35"},
+                                                         "INS_metrics":{"MEAN_INSERT_SIZE":"212,5"},
+                                                         "HS_metrics":{"GENOME_SIZE":"3000000000", "FOLD_ENRICHMENT":"40", "TARGET_TERRITORY":"50000000",
+                                                                       "PCT_USABLE_BASES_ON_TARGET":"0.4", "PCT_TARGET_BASES_10X":"0.95"}},
+                                         fastqc={"stats":{"Per sequence quality scores":{"Count":["10", "30"], "Quality":["20", "30"]}}}),
+                SampleRunMetricsDocument(flowcell="AC003CCCXX", date="120924", lane="2", sample_prj="J.Doe_00_01", barcode_name="P001_102_index2")]
+        df = qc_frame([_qc_projection(doc) for doc in docs], application="reseq")
+        self.assertListEqual([doc["name"] for doc in docs], list(df.index))
+        for doc in docs:
+            expected = _srm_to_qc(doc, application="reseq")
+            for k, v in expected.items():
+                if isinstance(v, float):
+                    self.assertAlmostEqual(v, df.loc[doc["name"], k])
+                else:
+                    self.assertEqual(v, df.loc[doc["name"], k])
+        self.assertEqual(calc_avg_qv(docs[0]), df["avg_qv"].iloc[0])
+        self.assertTrue(df["avg_qv"].isnull().iloc[1])
+        df = assess_qc_frame(df, "seqcap")
+        self.assertListEqual(assess_qc(df.iloc[0], "seqcap")[-2:], ["{:>12}".format(x) for x in df[["dup_status", "status"]].iloc[0]])
+        self.assertListEqual(["HIGH", "OK"], list(df["dup_status"]))
+        self.assertListEqual(["PASS", "FAIL"], list(df["status"]))
+
+class ViewRows(list):
+    """Rows of a view query"""
+    total_rows = 0
+
+class FakeViewDatabase(object):
+    """In-memory database answering view queries on key, keys, startkey and endkey.
+    Views are given as python functions that return the (key, value) pairs of a document"""
+    def __init__(self, docs, views):
+        self.docs = {doc["_id"]:doc for doc in docs}
+        self.views = views
+        self.queries = []
+        self.resource = Resource("http://localhost:5984/{}".format(uuid4().hex), None)
+        self.seq = 0
+        self.changes_log = []
+
+        self.views["_all_docs"] = lambda doc: [(doc["_id"], {"rev":doc.get("_rev", None)})]
+
+    def get(self, id, default=None):
+        self.queries.append(dict(name="get", key=id))
+        return copy.deepcopy(self.docs[id]) if id in self.docs else default
+
+    def _changed(self, doc, deleted=False):
+        self.seq += 1
+        self.changes_log.append((self.seq, doc["_id"], doc.get("_rev", None), deleted))
+
+    def delete(self, doc):
+        self._changed(self.docs.pop(doc["_id"]), deleted=True)
+
+    def save(self, doc):
+        self.docs[doc["_id"]] = doc
+        self._changed(doc)
+
+    def info(self):
+        return {"update_seq":self.seq}
+
+    def changes(self, since=0, include_docs=False, limit=None):
+        self.queries.append(dict(name="_changes", key=since, limit=limit))
+        # Only the latest change of each document is reported
+        latest = {id:(seq, id, rev, deleted) for seq, id, rev, deleted in self.changes_log if seq > since}
+        results = [{"seq":seq, "id":id, "changes":[{"rev":rev}]} for seq, id, rev, deleted in sorted(latest.values())]
+        for res, (seq, id, rev, deleted) in zip(results, sorted(latest.values())):
+            if deleted:
+                res["deleted"] = True
+            elif include_docs:
+                res["doc"] = copy.deepcopy(self.docs[id])
+        results = results[0:limit] if limit is not None else results
+        return {"results":results, "last_seq":results[-1]["seq"] if len(results) > 0 else since}
+
+    def update(self, docs):
+        self.queries.append(dict(name="_bulk_docs", keys=[doc["_id"] for doc in docs]))
+        res = []
+        for doc in docs:
+            current = self.docs.get(doc["_id"], {})
+            if current.get("_rev", None) != doc.get("_rev", None):
+                res.append((False, doc["_id"], ResourceConflict("Document update conflict.")))
+                continue
+            doc["_rev"] = "{}-rev".format(int(current.get("_rev", "0-rev").split("-")[0]) + 1)
+            self.docs[doc["_id"]] = copy.deepcopy(doc)
+            self._changed(doc)
+            res.append((True, doc["_id"], doc["_rev"]))
+        return res
+
+    def view(self, name, reduce=False, key=None, keys=None, startkey=None, endkey=None, limit=None, include_docs=False):
+        self.queries.append(dict(name=name, key=key, keys=keys, startkey=startkey, endkey=endkey, limit=limit))
+        if name not in self.views:
+            raise ResourceNotFound(("not_found", "missing_named_view"))
+        rows = sorted([Row(id=doc["_id"], key=k, value=v, doc=copy.deepcopy(doc) if include_docs else None)
+                       for doc in self.docs.values() if not doc["_id"].startswith("_design")
+                       for k, v in self.views[name](doc)], key=lambda r: r.key)
+        total_rows = len(rows)
+        if key is not None:
+            rows = [r for r in rows if r.key == key]
+        if keys is not None:
+            rows = [r for r in rows if r.key in keys]
+        if startkey is not None:
+            rows = [r for r in rows if r.key >= startkey]
+        if endkey is not None:
+            rows = [r for r in rows if r.key <= endkey]
+        result = ViewRows(rows[0:limit] if limit is not None else rows)
+        result.total_rows = total_rows
+        return result
+
+class TestViewProxy(unittest.TestCase):
+    """Tests for lazy view lookups that don't require a couchdb connection"""
+    def setUp(self):
+        docs = [{"_id":"id{}".format(i), "name":"P001_{}".format(100 + i), "flowcell":"120924_AC003CCCXX"} for i in xrange(20)]
+        self.db = FakeViewDatabase(docs, {"names/name": lambda doc: [(doc["name"], None)],
+                                          "names/name_fc": lambda doc: [(doc["name"], doc["flowcell"])]})
+
+    def test_get(self):
+        """Look up keys on demand and cache the values"""
+        view = ViewProxy(self.db, "names/name", lambda row: row.id)
+        self.assertEqual("id3", view["P001_103"])
+        self.assertEqual("id3", view.get("P001_103"))
+        self.assertIsNone(view.get("P002_101"))
+        self.assertNotIn("P002_101", view)
+        self.assertRaises(KeyError, view.__getitem__, "P002_101")
+        self.assertEqual(2, len(self.db.queries))
+        self.assertEqual("P001_103", self.db.queries[0]["key"])
+        self.assertEqual("names/name", self.db.queries[0]["name"])
+
+    def test_prefetch_and_eviction(self):
+        """Fetch several keys in one query and evict the least recently used"""
+        view = ViewProxy(self.db, "names/name", lambda row: row.id, cache_size=3)
+        view.prefetch(["P001_101", "P001_102", "P001_103"])
+        self.assertEqual(["P001_101", "P001_102", "P001_103"], self.db.queries[0]["keys"])
+        view.get("P001_101")
+        view.get("P001_104")
+        self.assertEqual(2, len(self.db.queries))
+        view.get("P001_101")
+        self.assertEqual(2, len(self.db.queries))
+        view.get("P001_102")
+        self.assertEqual(3, len(self.db.queries))
+
+    def test_iterate(self):
+        """Iterate over the complete view or a key range"""
+        view = ViewProxy(self.db, "names/name_fc")
+        self.assertEqual(20, len(view))
+        self.assertEqual(20, len(list(view)))
+        self.assertListEqual(["P001_105", "P001_106"], view.keys(startkey="P001_105", endkey="P001_106"))
+        self.assertListEqual(["120924_AC003CCCXX"]*2, [row.value for row in view.values(startkey="P001_118")])
+
+class TestSampleIds(unittest.TestCase):
+    """Tests for sample lookups on the sample_ids views that don't require a couchdb connection"""
+    def setUp(self):
+        docs = []
+        for prj, fc in [("J.Doe_00_01", "AC003CCCXX"), ("J.Doe_00_01", "BB002BBBXX"), ("J.Doe_00_02", "AC003CCCXX")]:
+            for i in xrange(3):
+                docs.append({"_id":uuid4().hex, "name":"1_120924_{}_{}".format(fc, i), "flowcell":fc, "sample_prj":prj,
+                             "barcode_name":"P001_10{}".format(i), "lane":"1"})
+        views = {"sample_ids/flowcell": lambda doc: [([doc["flowcell"]], None)],
+                 "sample_ids/project": lambda doc: [([doc["sample_prj"]], None)],
+                 "sample_ids/project_flowcell": lambda doc: [([doc["sample_prj"], doc["flowcell"]], None)]}
+        self.db = FakeViewDatabase(docs, views)
+        self.con = SampleRunMetricsConnection.__new__(SampleRunMetricsConnection)
+        self.con.db = self.db
+        self.con.log = LOG
+
+    def test_install_views(self):
+        """Install the missing views, leaving existing views untouched"""
+        self.db.save({"_id":"_design/names", "views":{"name":{"map":"function(doc) {}"}}})
+        self.con.install_views(VIEWS["samples"])
+        self.assertEqual("function(doc) {}", self.db.get("_design/names")["views"]["name"]["map"])
+        self.assertListEqual(sorted(VIEWS["samples"]["names"].keys()), sorted(self.db.get("_design/names")["views"].keys()))
+        self.assertListEqual(sorted(VIEWS["samples"]["sample_ids"].keys()), sorted(self.db.get("_design/sample_ids")["views"].keys()))
+        self.assertListEqual(["name"], self.db.get("_design/name_to_id")["views"].keys())
+
+    def test_get_sample_ids(self):
+        """Get sample ids by flowcell and/or project with one view query"""
+        self.assertEqual(6, len(self.con.get_sample_ids(fc_id="AC003CCCXX")))
+        self.assertEqual(6, len(self.con.get_sample_ids(sample_prj="J.Doe_00_01")))
+        self.assertEqual(3, len(self.con.get_sample_ids(fc_id="BB002BBBXX", sample_prj="J.Doe_00_01")))
+        self.assertEqual(0, len(self.con.get_sample_ids(fc_id="BB002BBBXX", sample_prj="J.Doe_00_02")))
+        self.assertEqual(0, len(self.con.get_sample_ids()))
+        self.db.queries = []
+        samples = self.con.get_samples(fc_id="BB002BBBXX", sample_prj="J.Doe_00_01")
+        self.assertEqual(1, len(self.db.queries))
+        self.assertListEqual(["BB002BBBXX"]*3, [s["flowcell"] for s in samples])
+        self.assertListEqual(["sample_run_metrics"]*3, [s["entity_type"] for s in samples])
+
+    def test_missing_sample_ids_views(self):
+        """Scan the names/name_fc_proj view if the sample_ids views are missing"""
+        views = {"names/name_fc_proj": lambda doc: [(doc["name"], [doc["flowcell"], doc["sample_prj"]])]}
+        self.con.db = FakeViewDatabase(self.db.docs.values(), views)
+        self.assertEqual(6, len(self.con.get_sample_ids(fc_id="AC003CCCXX")))
+        self.assertEqual(6, len(self.con.get_sample_ids(sample_prj="J.Doe_00_01")))
+        self.assertEqual(0, len(self.con.get_sample_ids(fc_id="BB002BBBXX", sample_prj="J.Doe_00_02")))
+        samples = self.con.get_samples(fc_id="BB002BBBXX", sample_prj="J.Doe_00_01")
+        self.assertListEqual(["BB002BBBXX"]*3, [s["flowcell"] for s in samples])
+
+class TestBulkDocuments(unittest.TestCase):
+    """Tests for bulk fetching and saving of documents that don't require a couchdb connection"""
+    def setUp(self):
+        docs = [dict(SampleRunMetricsDocument(**{"_id":"id{}".format(i), "_rev":"1-rev", "lane":"1", "date":"120924", "flowcell":"AC003CCCXX",
+                                                  "sequence":"ACGTA{}".format("ACGT"[i]), "barcode_name":"P001_10{}".format(i)})) for i in xrange(4)]
+        self.names = [doc["name"] for doc in docs]
+        views = {"names/name": lambda doc: [(doc["name"], None)],
+                 "name_to_id/name": lambda doc: [(doc["name"], None)]}
+        self.db = FakeViewDatabase(docs, views)
+        self.con = SampleRunMetricsConnection.__new__(SampleRunMetricsConnection)
+        self.con.db = self.db
+        self.con.log = LOG
+        self.con.name_view = ViewProxy(self.db, "names/name", lambda row: row.id)
+
+    def test_get_entries(self):
+        """Get several documents with one view query and one _all_docs request"""
+        entries = self.con.get_entries(self.names[0:3] + ["missing"])
+        self.assertListEqual(["keys", "keys"], [k for q in self.db.queries for k in ["key", "keys"] if q.get(k)])
+        self.assertListEqual(["names/name", "_all_docs"], [q["name"] for q in self.db.queries])
+        self.assertIsNone(entries["missing"])
+        self.assertListEqual(self.names[0:3], [entries[name]["name"] for name in self.names[0:3]])
+        self.assertIsInstance(entries[self.names[0]], SampleRunMetricsDocument)
+
+    def test_cached_entries(self):
+        """Get entries through the document cache, dropping saved documents"""
+        self.con._use_doc_cache = True
+        self.con.get_entries(self.names[0:2])
+        self.assertEqual("P001_100", self.con.get_entry(self.names[0])["barcode_name"])
+        self.assertNotIn("get", [q["name"] for q in self.db.queries])
+        obj = self.con.get_entry(self.names[0])
+        obj["bc_count"] = 1000
+        self.con.save_many([obj])
+        self.assertEqual(1000, self.con.get_entry(self.names[0])["bc_count"])
+
+    def test_save_many(self):
+        """Save new and modified documents in one bulk request, reporting conflicts"""
+        objs = [SampleRunMetricsDocument(**self.db.get("id{}".format(i))) for i in xrange(4)]
+        objs[1]["bc_count"] = 1000
+        objs[2]["bc_count"] = 2000
+        new = SampleRunMetricsDocument(**{"lane":"2", "date":"120924", "flowcell":"AC003CCCXX", "sequence":"ACGTAC", "barcode_name":"P001_101"})
+        # A second copy of the third document conflicts with the first
+        duplicate = SampleRunMetricsDocument(**self.db.get("id2"))
+        duplicate["bc_count"] = 3000
+        self.db.queries = []
+        # Objects may be passed as a generator
+        status = self.con.save_many(x for x in objs + [new, duplicate])
+        self.assertEqual(["name_to_id/name", "_all_docs", "_bulk_docs"], [q["name"] for q in self.db.queries])
+        self.assertEqual("unchanged", status["id0"])
+        self.assertEqual("saved", status["id1"])
+        self.assertEqual(1000, self.db.docs["id1"]["bc_count"])
+        self.assertEqual("saved", status[new["_id"]])
+        self.assertIn(new["_id"], self.db.docs)
+        self.assertIsInstance(status["id2"], ResourceConflict)
+        self.assertEqual(2000, self.db.docs["id2"]["bc_count"])
+
+
+class TestDocumentCache(unittest.TestCase):
+    """Tests for the document cache that don't require a couchdb connection"""
+    def setUp(self):
+        docs = [{"_id":"id{}".format(i), "_rev":"1-rev", "name":"P001_10{}".format(i)} for i in xrange(4)]
+        self.db = FakeViewDatabase(docs, {})
+        self.rootdir = tempfile.mkdtemp(prefix="test_cache_")
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def _update(self, docid, **kw):
+        doc = self.db.get(docid)
+        doc.update(kw)
+        self.db.update([doc])
+
+    def test_get(self):
+        """Fetch documents once and drop them when they change"""
+        cache = DocumentCache(self.db)
+        self.assertEqual("P001_100", cache.get("id0")["name"])
+        cache.get("id0")["name"] = "modified"
+        self.assertEqual("P001_100", cache.get("id0")["name"])
+        self.assertIsNone(cache.get("missing"))
+        self.assertEqual((2, 2), (cache.hits, cache.misses))
+        self._update("id0", name="P001_200")
+        self.assertEqual("P001_100", cache.get("id0")["name"])
+        self.assertEqual(1, cache.poll(force=True))
+        self.assertEqual("P001_200", cache.get("id0")["name"])
+        self.db.queries = []
+        docs = cache.get_many(["id0", "id1", "id2", "missing"])
+        self.assertListEqual(["id0", "id1", "id2"], sorted(docs.keys()))
+        self.assertListEqual([["id1", "id2", "missing"]], [q["keys"] for q in self.db.queries if q["name"] == "_all_docs"])
+        cache.get("id1")
+        self.assertListEqual(["_all_docs"], [q["name"] for q in self.db.queries])
+
+    def test_disk_cache(self):
+        """Fetch only the documents that changed since the previous process"""
+        path = os.path.join(self.rootdir, "flowcells.sqlite")
+        cache = DocumentCache(self.db, path)
+        cache.get_many(["id0", "id1", "id2"])
+        cache.close()
+        self._update("id1", name="P001_201")
+        self.db.queries = []
+        cache = DocumentCache(self.db, path)
+        self.assertEqual("P001_100", cache.get("id0")["name"])
+        self.assertEqual("P001_201", cache.get("id1")["name"])
+        self.assertListEqual(["_changes", "get"], [q["name"] for q in self.db.queries])
+        self.assertEqual("id1", self.db.queries[1]["key"])
+        cache.close()
+
+    def test_shared_disk_cache(self):
+        """Share the on-disk cache between concurrently open caches"""
+        path = os.path.join(self.rootdir, "flowcells.sqlite")
+        caches = [DocumentCache(self.db, path) for i in xrange(2)]
+        caches[0].get_many(["id0", "id1"])
+        self.db.queries = []
+        self.assertEqual("P001_101", caches[1].get("id1")["name"])
+        self.assertNotIn("get", [q["name"] for q in self.db.queries])
+        # Documents dropped by one cache are fetched again by the other
+        caches[0].invalidate("id0")
+        self.assertEqual("P001_100", caches[1].get("id0")["name"])
+        self.assertEqual(["id0"], [q["key"] for q in self.db.queries if q["name"] == "get"])
+        for cache in caches:
+            cache.close()
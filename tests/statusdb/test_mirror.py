@@ -0,0 +1,100 @@
+"""Test local mirrors of statusdb, with no server"""
+import os
+import shutil
+import tempfile
+import unittest
+import logbook
+import couchdb
+
+from scilifelab.db.mirror import Mirror, sync_statusdb
+from scilifelab.db.statusdb import (SampleRunMetricsConnection, FlowcellRunMetricsConnection, ProjectSummaryConnection,
+                                    SampleRunMetricsDocument, FlowcellRunMetricsDocument, ProjectSummaryDocument,
+                                    VIEWS, PY_VIEWS, view_functions, get_qc_data, get_qc_frame)
+from .test_db import FakeViewDatabase
+
+LOG = logbook.Logger(__name__)
+
+DBNAMES = {"samples":"samples-test", "flowcells":"flowcells-test", "projects":"projects-test"}
+
+class FakeServer(dict):
+    """Databases keyed on name"""
+    pass
+
+class TestMirror(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_mirror_")
+        self.server = FakeServer({dbname:FakeViewDatabase([], view_functions(dbtype)) for dbtype, dbname in DBNAMES.items()})
+        for prj in ["J.Doe_00_01", "J.Doe_00_02"]:
+            self.server[DBNAMES["projects"]].save(ProjectSummaryDocument(project_name=prj, project_id="P0{}".format(prj[-2:]), application="WG re-seq",
+                                                                       samples={"P0{}_101".format(prj[-2:]):{"customer_name":"1"}}))
+        for fc, prjs in [("AC003CCCXX", ["J.Doe_00_01", "J.Doe_00_02"]), ("BB002BBBXX", ["J.Doe_00_01"])]:
+            self.server[DBNAMES["flowcells"]].save(FlowcellRunMetricsDocument("120924", fc, RunInfo={"Instrument":"SN0001"}))
+            for prj in prjs:
+                for i in xrange(3):
+                    self.server[DBNAMES["samples"]].save(SampleRunMetricsDocument(lane=str(i + 1), date="120924", flowcell=fc, sample_prj=prj,
+                                                                                  sequence="ACGTAC", barcode_name="P0{}_101_index{}".format(prj[-2:], i)))
+        self.mirror_dir = os.path.join(self.rootdir, "mirror")
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def _con(self, cls, dbtype, **kw):
+        return cls(dbname=DBNAMES[dbtype], log=LOG, db_mirror=self.mirror_dir, **kw)
+
+    def test_py_views(self):
+        """Provide a python equivalent of each statusdb view"""
+        for dbtype, designs in VIEWS.items():
+            self.assertListEqual(sorted(designs.keys()), sorted(PY_VIEWS[dbtype].keys()))
+            for design, views in designs.items():
+                self.assertListEqual(sorted(views.keys()), sorted(PY_VIEWS[dbtype][design].keys()))
+
+    def test_sync(self):
+        """Sync all documents, and then only the changes since the last sync"""
+        counts = sync_statusdb(self.server, self.mirror_dir, DBNAMES, batch_size=4)
+        self.assertDictEqual({"samples":9, "flowcells":2, "projects":2}, counts)
+        samples = self.server[DBNAMES["samples"]]
+        doc = samples.docs.values()[0]
+        doc["bc_count"] = 1000
+        samples.update([doc])
+        samples.delete(samples.docs.values()[1])
+        counts = sync_statusdb(self.server, self.mirror_dir, DBNAMES, batch_size=4)
+        self.assertDictEqual({"samples":2, "flowcells":0, "projects":0}, counts)
+        db = Mirror(self.mirror_dir)[DBNAMES["samples"]]
+        self.assertEqual(8, len(db))
+        self.assertEqual(1000, db.get(doc["_id"])["bc_count"])
+        self.assertEqual(samples.seq, db.info()["update_seq"])
+
+    def test_sync_project(self):
+        """Sync the documents of a project"""
+        counts = sync_statusdb(self.server, self.mirror_dir, DBNAMES, project_name="J.Doe_00_02")
+        self.assertDictEqual({"samples":3, "flowcells":1, "projects":1}, counts)
+        db = Mirror(self.mirror_dir)[DBNAMES["flowcells"]]
+        self.assertListEqual(["120924_AC003CCCXX"], [row.key for row in db.view("names/name")])
+
+    def test_connections(self):
+        """Run the statusdb connections against a mirror"""
+        self.assertRaises(Exception, self._con, SampleRunMetricsConnection, "samples")
+        sync_statusdb(self.server, self.mirror_dir, DBNAMES)
+        s_con = self._con(SampleRunMetricsConnection, "samples")
+        fc_con = self._con(FlowcellRunMetricsConnection, "flowcells")
+        p_con = self._con(ProjectSummaryConnection, "projects")
+        self.assertEqual(3, len(s_con.get_sample_ids(fc_id="BB002BBBXX")))
+        self.assertEqual(6, len(s_con.get_samples(sample_prj="J.Doe_00_01")))
+        self.assertEqual(3, len(s_con.get_samples(fc_id="AC003CCCXX", sample_prj="J.Doe_00_02")))
+        self.assertEqual("SN0001", fc_con.get_instrument("120924_AC003CCCXX"))
+        self.assertEqual("WG re-seq", p_con.get_entry("J.Doe_00_01", "application"))
+        self.assertEqual("1", p_con.get_project_sample("J.Doe_00_01", "P001_101_index1")["project_sample"]["customer_name"])
+        self.assertEqual(6, len(get_qc_data("J.Doe_00_01", p_con, s_con)))
+        df = get_qc_frame("J.Doe_00_01", p_con, s_con, fc_id="BB002BBBXX")
+        self.assertListEqual(["P001_101_index0", "P001_101_index1", "P001_101_index2"], sorted(df["sample"]))
+        self.assertListEqual(["WG re-seq"], list(df["application"].unique()))
+        self.assertListEqual(sorted(s_con.name_view.keys()), s_con.name_view.keys())
+        self.assertEqual(9, len(s_con.name_view))
+        obj = s_con.get_entry(s_con.name_view.keys()[0])
+        obj["bc_count"] = 10
+        # Saving fails unless writes to the mirror are asked for
+        self.assertRaises(couchdb.Forbidden, s_con.save_many, [obj])
+        self.assertRaises(couchdb.Forbidden, s_con.save, obj)
+        s_con = self._con(SampleRunMetricsConnection, "samples", db_mirror_writes=True)
+        self.assertDictEqual({obj["_id"]:"saved"}, s_con.save_many([obj]))
+        self.assertEqual(10, s_con.get_entry(obj["name"], "bc_count"))
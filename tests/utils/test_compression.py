@@ -0,0 +1,85 @@
+"""Test the utils/compression.py functionality
+"""
+import os
+import gzip
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+import scilifelab.utils.compression as cmp
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_compression_")
+        self.data = "".join(["line {}\n".format(i) for i in xrange(100000)])
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_parallel_gzip_writer(self):
+        """Write gzip members in a thread pool
+        """
+        fname = os.path.join(self.rootdir,"out.gz")
+        fh = cmp.ParallelGzipWriter(fname, blocksize=4096)
+        for line in self.data.splitlines(True):
+            fh.write(line)
+        fh.close()
+        self.assertEqual(self.data, gzip.GzipFile(fname).read(),
+                         "Multi-member gzip output could not be read back")
+        self.assertEqual(self.data, subprocess.check_output(["gzip","-dc",fname]),
+                         "Multi-member gzip output could not be read by gzip")
+
+        # An empty output should still be a valid gzip file
+        fh = cmp.ParallelGzipWriter(fname)
+        fh.close()
+        self.assertEqual("", gzip.GzipFile(fname).read(),
+                         "Empty multi-member gzip output could not be read back")
+
+    def test_process_file(self):
+        """Pipe through an external compression program
+        """
+        fname = os.path.join(self.rootdir,"out.gz")
+        fh = cmp.ProcessFile(fname, "w", "gzip")
+        fh.write(self.data)
+        fh.close()
+        self.assertEqual(self.data, gzip.GzipFile(fname).read(),
+                         "Output compressed by an external program could not be read back")
+        fh = cmp.ProcessFile(fname, "r", "gzip")
+        self.assertEqual(self.data, fh.read(),
+                         "Output decompressed by an external program did not match the input")
+        fh.close()
+
+        # Decompressing a corrupt file should raise an error
+        with open(fname,"w") as fh:
+            fh.write("not gzipped")
+        fh = cmp.ProcessFile(fname, "r", "gzip")
+        self.assertRaises(IOError, fh.read)
+        try:
+            cmp.ProcessFile(fname, "r", "gzip").read()
+        except IOError as e:
+            self.assertIn("not in gzip format", str(e),
+                          "The error output of the external program was not reported")
+
+    def test_open(self):
+        """Open files with all compression methods
+        """
+        for ext in ["", ".gz", ".bz2"]:
+            for method in cmp.METHODS:
+                fname = os.path.join(self.rootdir,"out.{}{}".format(method,ext))
+                fh = cmp.open_output(fname, method)
+                fh.write(self.data)
+                fh.close()
+                fh = cmp.open_input(fname, method)
+                self.assertEqual(self.data, fh.read(),
+                                 "Reading back {} written with method {} failed".format(os.path.basename(fname),method))
+                fh.close()
+        self.assertRaises(ValueError, cmp.open_output, fname, "unknown")
+
+    def test_default_method(self):
+        """Compress gzip output in the shared thread pool by default
+        """
+        fh = cmp.open_output(os.path.join(self.rootdir,"out.gz"), append=True)
+        self.assertIsInstance(fh, cmp.ParallelGzipWriter)
+        fh.close()
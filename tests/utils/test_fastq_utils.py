@@ -7,6 +7,8 @@ import shutil
 import random
 import unittest
 import copy
+import imp
+import sys
 import scilifelab.utils.fastq_utils as fu
 import tests.generate_test_data as td
 import scilifelab.illumina.hiseq as hi
@@ -70,7 +72,39 @@ class TestFastQParser(unittest.TestCase):
             pass
         self.assertEqual(expected,fqr.rread(),
                          "The returned number of filtered reads based on lanes did not match expected number")
-        
+
+    def test_block_reader(self):
+        """Parse records spanning block boundaries
+        """
+
+        # Parse the reference records with the default block size
+        fqr = fu.FastQParser(self.example_fq)
+        expected = [r for r in fqr]
+
+        # Use a block size that will split records and lines across blocks
+        fqr = fu.FastQParser(self.example_fq, blocksize=37)
+        self.assertListEqual(expected,[r for r in fqr],
+                             "Records parsed with a small block size did not match the expected records")
+        self.assertEqual(len(expected),fqr.rread(),
+                         "The number of records read did not match the expected number")
+
+        # Read the records in batches after first reading a single record
+        fqr = fu.FastQParser(self.example_fq, blocksize=1024)
+        observed = [fqr.next()]
+        for batch in fqr.batches():
+            observed.extend([list(r) for r in batch])
+        self.assertListEqual(expected,observed,
+                             "Records parsed in batches did not match the expected records")
+
+        # Write the records without a trailing newline and with DOS line endings
+        fd, fqfile = tempfile.mkstemp(suffix=".fastq", dir=self.rootdir)
+        os.close(fd)
+        with open(fqfile,"w") as fh:
+            fh.write("\r\n".join(["\r\n".join(r) for r in expected]))
+        fqr = fu.FastQParser(fqfile, blocksize=101)
+        self.assertListEqual(expected,[r for r in fqr],
+                             "Records parsed from a file without a trailing newline did not match the expected records")
+
 class TestFastQWriter(unittest.TestCase):
     """Test the FastQWriter functionality
     """
@@ -84,7 +118,39 @@ class TestFastQWriter(unittest.TestCase):
     def test_write_fastq(self):
         """Write a fastq file
         """
-        
+
+    def test_writer_pool(self):
+        """Write to more fastq files than the pool keeps open
+        """
+        for ext in [".fastq", ".fastq.gz"]:
+            pool = fu.FastQWriterPool(max_open=3, buffer_size=1000)
+            expected = {}
+            for n in xrange(10):
+                fname = os.path.join(self.rootdir,"out_{}{}".format(n,ext))
+                expected[fname] = []
+            # Create a writer that will not write any records
+            empty = pool.writer(os.path.join(self.rootdir,"empty{}".format(ext)))
+            for n in xrange(500):
+                fname = random.choice(expected.keys())
+                record = td.generate_fastq_record()
+                expected[fname].append(record)
+                pool.write(fname,record)
+            self.assertLessEqual(len(pool._handles),3,
+                                 "The pool has more open files than allowed")
+            empty.close()
+            pool.close()
+
+            self.assertTrue(os.path.exists(empty.name()),
+                            "A file was not created for an output without records")
+            stats = pool.stats()
+            for fname, records in expected.items():
+                self.assertListEqual(records,[r for r in fu.FastQParser(fname)],
+                                     "The records in {} did not match the expected".format(fname))
+                self.assertEqual(len(records),stats[fname]['records'],
+                                 "The number of records reported for {} did not match the expected".format(fname))
+                self.assertEqual(sum([len("\n".join(r)) + 1 for r in records]),stats[fname]['bytes'],
+                                 "The number of bytes reported for {} did not match the expected".format(fname))
+
 
 class TestFastQUtils(unittest.TestCase):
     
@@ -189,7 +255,83 @@ class TestFastQUtils(unittest.TestCase):
                              "The number of demultiplexed reads in file does not match expected")
             self.assertListEqual(sorted(headers),sorted(self.indexes[index]),
                                  "The parsed headers from demultiplexed fastq file do not match the expected")
-            
+
+    def test_demultiplex_unequal_fastq(self):
+        """Demultiplexing paired fastq files with different numbers of records should fail
+        """
+        records = [r for r in fu.FastQParser(self.fastq_1)]
+        # Extra records in the second file are in later batches than the last record of the first
+        truncated = os.path.join(self.rootdir,"truncated_R1.fastq.gz")
+        empty = os.path.join(self.rootdir,"empty_R1.fastq.gz")
+        for fname, n in [(truncated,len(records)-1),(empty,0)]:
+            fh = fu.FastQWriter(fname)
+            for record in records[0:n]:
+                fh.write(record)
+            fh.close()
+        for fastq1, fastq2 in [(truncated,self.fastq_2),(self.fastq_1,truncated),(empty,self.fastq_2)]:
+            outdir = tempfile.mkdtemp(dir=self.rootdir)
+            self.assertRaises(ValueError,fu.demultiplex_fastq,outdir,self.samplesheet,fastq1,fastq2)
+
+    def test_paired_batches(self):
+        """Read paired fastq files in lockstep batches
+        """
+        expected = [r for r in fu.FastQParser(self.fastq_1)]
+        # Use different block sizes so that the batches differ in length
+        fp1 = fu.FastQParser(self.fastq_1, blocksize=1000)
+        fp2 = fu.FastQParser(self.fastq_2, blocksize=1500)
+        pool = fu.FastQWriterPool()
+        outfile = os.path.join(self.rootdir,"paired_R1.fastq")
+        for r1, r2 in fu.paired_batches(fp1, fp2):
+            self.assertEqual(len(r1),len(r2),
+                             "Paired batches have different lengths")
+            self.assertListEqual(fu.read_pair_keys(r1),fu.read_pair_keys(r2),
+                                 "Paired batches do not contain read pairs")
+            pool.write_batch(outfile, r1)
+        pool.close()
+        self.assertListEqual(expected,[r for r in fu.FastQParser(outfile)],
+                             "Records written in batches did not match the expected records")
+
+        # Batches from files with different numbers of records should raise an error
+        fp1 = fu.FastQParser(self.fastq_1)
+        fp2 = fu.FastQParser(outfile)
+        fp2.next()
+        self.assertRaises(ValueError, list, fu.paired_batches(fp1, fp2))
+
+    def test_index_lookup(self):
+        """Precompute the index lookup table
+        """
+        lookup = fu.index_lookup(["AAAAAA","CCCCCC"],1)
+        self.assertEqual(2*(1+6*4),len(lookup),
+                         "The lookup table does not contain the expected number of sequences")
+        self.assertEqual("AAAAAA",lookup["AAAANA"],
+                         "A sequence with one mismatch did not map to the expected index")
+        self.assertNotIn("AAAACC",lookup,
+                         "A sequence with two mismatches should not be in the lookup table")
+        self.assertRaises(ValueError,fu.index_lookup,["AAAAAA","AAAACC"],1)
+
+    def test_demultiplex_mismatches(self):
+        """Demultiplex allowing mismatches in the index
+        """
+        fastq = os.path.join(self.rootdir,"mismatch_R1.fastq")
+        fqw = fu.FastQWriter(fastq)
+        for index in ["ACGTAC","ACGTAA","ACGTAA","GGGGGG"]:
+            fqw.write(td.generate_fastq_record(lane=1, index=index))
+        fqw.close()
+        samplesheet = td._write_samplesheet([["FCID","1","Sample_1","unknown","ACGTAC","DemuxTest","0","","","DemuxTestProject"]],
+                                            os.path.join(self.rootdir,"mismatch.csv"))
+
+        for mismatches, expected in [(0,1),(1,3)]:
+            outdir = os.path.join(self.rootdir,"mismatch_{}".format(mismatches))
+            os.mkdir(outdir)
+            outfiles = fu.demultiplex_fastq(outdir,samplesheet,fastq,mismatches=mismatches)
+            self.assertEqual(expected,len([r for r in fu.FastQParser(outfiles["1"]["ACGTAC"][0])]),
+                             "Demultiplexing with {} mismatches did not write the expected number of records".format(mismatches))
+            with open(os.path.join(outdir,"mismatch_R1_L001.demultiplex_metrics")) as fh:
+                metrics = [line.strip().split("\t") for line in fh]
+            self.assertListEqual(sorted([["ACGTAC","Sample_1",str(expected)],["unmatched","N/A",str(4-expected)]]),
+                                 sorted(metrics[1:]),
+                                 "The demultiplex metrics did not contain the expected counts")
+
 
 class TestBarcodeExtractor(unittest.TestCase):
     """Test class for the functionality
@@ -260,3 +402,166 @@ class TestBarcodeExtractor(unittest.TestCase):
                               "Extracted and expected barcode counts don't match")
          
         
+
+class TestQualityStats(unittest.TestCase):
+    """Test the quality statistics functions
+    """
+
+    def test_quality_stats(self):
+        """Compute quality statistics for a batch of records
+        """
+        records = [td.generate_fastq_record(sequence_length=random.randint(50,101)) for i in xrange(100)]
+        stats = fu.quality_stats(records)
+        self.assertListEqual([fu.avgQ(r) for r in records],[round(q,1) for q in stats['avgQ']],
+                             "Batch average qualities did not match the scalar average qualities")
+        self.assertListEqual([fu.gtQ30(r) for r in records],[round(q,1) for q in stats['gtQ30']],
+                             "Batch Q30 percentages did not match the scalar Q30 percentages")
+        self.assertEqual(sum([len(r[3]) for r in records]),stats['histogram'].sum(),
+                         "The quality histogram did not count all bases")
+
+        # Check the statistics on known quality strings
+        stats = fu.quality_stats([("","","","+5?"),("","","","I")])
+        self.assertListEqual([20.0,40.0],list(stats['avgQ']),
+                             "The average qualities did not match the expected")
+        self.assertListEqual([100.0/3,100.0],list(stats['gtQ30']),
+                             "The Q30 percentages did not match the expected")
+        self.assertListEqual([25.0,20.0,30.0],list(stats['position_mean']),
+                             "The per-position mean qualities did not match the expected")
+        self.assertListEqual([10,20,30,40],list(stats['histogram'].nonzero()[0]),
+                             "The quality histogram did not match the expected")
+
+    def test_pair_quality(self):
+        """Bin read pairs on the same quality as the per record rounding in bin_reads_by_quality
+        """
+        script = imp.load_source("bin_reads_by_quality", os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, "scripts", "bin_reads_by_quality.py"))
+        # Averages at x.45, x.5 and x.55 boundaries of 100 bp reads, where rounding
+        # 29.45 to one decimal gives 29.4 as it is stored as 29.4499...
+        records1 = []
+        for q in xrange(2,40):
+            for n in [55,50,45]:
+                records1.append(("","","",chr(q+33)*n + chr(q+34)*(100-n)))
+        records2 = [td.generate_fastq_record(sequence_length=100) for r in records1]
+        expected = [min(int(round(fu.avgQ(r1))), int(round(fu.avgQ(r2)))) for r1, r2 in zip(records1, records2)]
+        self.assertListEqual(expected, list(script.pair_quality(records1, records2, 33)),
+                             "The pair qualities did not match the per record rounded average qualities")
+        self.assertEqual(29, script.pair_quality([records1[81]], [records1[81]], 33)[0])
+        self.assertListEqual([], list(script.pair_quality([], [], 33)))
+
+    def test_threshold_arguments(self):
+        """Parse one or several quality thresholds of bin_reads_by_quality
+        """
+        script = imp.load_source("bin_reads_by_quality", os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, "scripts", "bin_reads_by_quality.py"))
+        for argv, thresholds in [(["-T", "20", "r1.fq", "r2.fq"], [20]),
+                                 (["-T", "20", "-T", "30", "r1.fq", "r2.fq"], [20, 30]),
+                                 (["r1.fq", "r2.fq"], [20])]:
+            args = script.parse_args(argv)
+            self.assertListEqual(thresholds, args.threshold)
+            self.assertListEqual(["r1.fq", "r2.fq"], [args.fastq1, args.fastq2])
+
+class TestUniqueRecords(unittest.TestCase):
+    """Test the removal of duplicate records
+    """
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_unique_records_")
+
+        # Generate paired records where some sequences are duplicated with different qualities
+        args = {'sequence_length': 50, 'pair': True}
+        self.records = []
+        for n in xrange(500):
+            if n > 0 and random.random() < 0.3:
+                record = list(random.choice(self.records))
+                record[0] = td.generate_fastq_header(read=1)
+                record[3] = td.generate_quality_sequence(**args)
+                record[4] = record[0].replace(' 1:',' 2:')
+                record[7] = td.generate_quality_sequence(**args)
+            else:
+                record = td.generate_fastq_record(**args)
+            self.records.append(record)
+        self.fastq_1 = os.path.join(self.rootdir,"unique_R1.fastq.gz")
+        self.fastq_2 = os.path.join(self.rootdir,"unique_R2.fastq.gz")
+        f1h = fu.FastQWriter(self.fastq_1)
+        f2h = fu.FastQWriter(self.fastq_2)
+        for record in self.records:
+            f1h.write(record[0:4])
+            f2h.write(record[4:])
+        f1h.close()
+        f2h.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def _expected(self, key, quality):
+        """Return the expected indexes of the records to keep
+        """
+        best = {}
+        for i, record in enumerate(self.records):
+            k = key(record)
+            if k not in best or quality(record) > quality(self.records[best[k]]):
+                best[k] = i
+        return sorted(best.values())
+
+    def test_estimate_records(self):
+        """Estimate the number of records from the file size
+        """
+        estimate = fu.estimate_records(self.fastq_1, sample_size=4096)
+        self.assertTrue(0.5*len(self.records) < estimate < 2*len(self.records),
+                        "The estimated number of records ({}) was too far off".format(estimate))
+
+    def test_unique_records(self):
+        """Keep the highest quality copy of duplicated sequences
+        """
+        expected = self._expected(lambda r: r[1],
+                                  lambda r: fu.quality_stats([r[0:4]])['avgQ'][0])
+        # Use a small memory limit to spill partitions to disk
+        for max_memory in [fu.DEFAULT_MAX_MEMORY, 1000]:
+            keep = fu.unique_records(self.fastq_1, max_memory=max_memory)
+            self.assertListEqual(expected,list(keep.nonzero()[0]),
+                                 "The records kept with max_memory {} did not match the expected".format(max_memory))
+
+    def test_unique_pairs(self):
+        """Keep the highest quality copy of duplicated read pairs
+        """
+        expected = self._expected(lambda r: r[1] + r[5],
+                                  lambda r: fu.quality_stats([r[0:4]])['avgQ'][0] + fu.quality_stats([r[4:]])['avgQ'][0])
+        keep = fu.unique_records(self.fastq_1, self.fastq_2, records=len(self.records))
+        self.assertListEqual(expected,list(keep.nonzero()[0]),
+                             "The read pairs kept did not match the expected")
+
+    def test_unique_trimmed_pairs(self):
+        """Tell apart read pairs of different lengths with the same concatenated sequence
+        """
+        pairs = [("ACG","T"),("AC","GT"),("ACG","T"),("A","CGT")]
+        fastq = [os.path.join(self.rootdir,"trimmed_R{}.fastq".format(read)) for read in [1, 2]]
+        fhs = [fu.FastQWriter(fname) for fname in fastq]
+        for i, pair in enumerate(pairs):
+            for read, (fh, seq) in enumerate(zip(fhs, pair)):
+                fh.write(["@r{} {}:N:0:ACGTAC".format(i, read + 1), seq, "+", "I"*len(seq)])
+        for fh in fhs:
+            fh.close()
+        keep = fu.unique_records(fastq[0], fastq[1], records=len(pairs))
+        self.assertListEqual([True, True, False, True], list(keep),
+                             "Trimmed read pairs with the same concatenated sequence were taken as duplicates")
+
+    def test_unique_script_pairs(self):
+        """Write the unique read pairs of files with dotted names to separate files
+        """
+        script = imp.load_source("fastq_unique", os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, "scripts", "fastq_unique.py"))
+        infiles = [os.path.join(self.rootdir,"s.R{}.fastq.gz".format(read)) for read in [1, 2]]
+        for src, dst in zip([self.fastq_1,self.fastq_2],infiles):
+            shutil.copy(src, dst)
+        expected = fu.unique_records(self.fastq_1, self.fastq_2)
+        argv = sys.argv
+        try:
+            sys.argv = ["fastq_unique.py"] + infiles
+            script.main()
+            # Output names that collide are refused
+            sys.argv = ["fastq_unique.py", os.path.join(self.rootdir,"x.fq"), os.path.join(self.rootdir,"x.fastq")]
+            self.assertRaises(SystemExit, script.main)
+        finally:
+            sys.argv = argv
+        for infile, offset in zip(infiles, [0, 4]):
+            outfile = os.path.join(self.rootdir,os.path.basename(infile).replace(".fastq.gz","-unique.fastq.gz"))
+            self.assertListEqual([r[offset:offset+4] for r, k in zip(self.records, expected) if k],
+                                 [list(r) for r in fu.FastQParser(outfile)],
+                                 "The unique records of {} were not written to {}".format(infile, outfile))
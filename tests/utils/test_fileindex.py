@@ -0,0 +1,76 @@
+import os
+import re
+import time
+import shutil
+import tempfile
+import unittest
+
+from scilifelab.utils.misc import filtered_walk, safe_makedir
+from scilifelab.utils.fileindex import FileIndex, indexed_walk, file_type, file_lane, INDEX_FILE
+
+class TestFileIndex(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_fileindex_")
+        self.project = os.path.join(self.rootdir, "J.Doe_00_01")
+        for sample in ["P001_101", "P001_102"]:
+            for d in ["120924_AC003CCCXX", os.path.join("120924_AC003CCCXX", "nophix"), os.path.join("120924_AC003CCCXX", "fastqc")]:
+                safe_makedir(os.path.join(self.project, sample, d))
+                for fn in ["1_120924_AC003CCCXX_1.fastq.gz", "1_120924_AC003CCCXX_1-sort.bam", "{}-bcbb-config.yaml".format(sample)]:
+                    open(os.path.join(self.project, sample, d, fn), "w").close()
+        self.yaml_filter = lambda f: re.search("-bcbb-config.yaml$", f) != None
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_classify(self):
+        """Classify files by type and lane"""
+        self.assertEqual("fastq", file_type("1_120924_AC003CCCXX_1.fastq.gz"))
+        self.assertEqual("yaml", file_type("P001_101-bcbb-config.yaml"))
+        self.assertIsNone(file_type("README"))
+        self.assertEqual("1", file_lane("1_120924_AC003CCCXX_1.fastq.gz"))
+        self.assertIsNone(file_lane("P001_101-bcbb-config.yaml"))
+
+    def test_queries(self):
+        """Query the files of an index by sample, pattern and extension"""
+        index = FileIndex(self.project)
+        self.assertEqual(9, index.rebuild())
+        self.assertEqual(18, index.status()["files"])
+        self.assertEqual({"fastq":6, "bam":6, "yaml":6}, index.status()["types"])
+        self.assertEqual(9, len(index.by_sample("P001_101")))
+        self.assertEqual(6, len(index.by_extension(".fastq.gz")))
+        self.assertListEqual([os.path.join(self.project, "P001_102", "120924_AC003CCCXX", "nophix", "1_120924_AC003CCCXX_1-sort.bam")],
+                             index.by_pattern("P001_102.*nophix.*bam$"))
+
+    def test_indexed_walk(self):
+        """Walk the index with the semantics of filtered_walk"""
+        self.assertListEqual(filtered_walk(self.project, self.yaml_filter), indexed_walk(self.project, self.yaml_filter))
+        FileIndex(self.project).rebuild()
+        self.assertTrue(os.path.exists(os.path.join(self.project, INDEX_FILE)))
+        sampledir = os.path.join(self.project, "P001_101")
+        for kw in [{}, {"include_dirs":["nophix"]}, {"exclude_dirs":["nophix", "fastqc"]}, {"get_dirs":True}]:
+            self.assertListEqual(sorted(filtered_walk(sampledir, self.yaml_filter, **kw)), sorted(indexed_walk(sampledir, self.yaml_filter, **kw)))
+        # Relative paths are kept relative
+        cwd = os.getcwd()
+        try:
+            os.chdir(self.rootdir)
+            self.assertListEqual(sorted(filtered_walk("J.Doe_00_01", self.yaml_filter)), sorted(indexed_walk("J.Doe_00_01", self.yaml_filter)))
+        finally:
+            os.chdir(cwd)
+
+    def test_update(self):
+        """Only list the directories modified since the last update"""
+        index = FileIndex(self.project)
+        index.rebuild()
+        # Directories modified within the mtime resolution are listed again
+        self.assertEqual(9, index.update())
+        past = time.time() - 10
+        for root, dirs, files in os.walk(self.project):
+            os.utime(root, (past, past))
+        index.update()
+        self.assertEqual(0, index.update(os.path.join(self.project, "P001_101")))
+        fcdir = os.path.join(self.project, "P001_101", "120924_AC003CCCXX")
+        os.remove(os.path.join(fcdir, "1_120924_AC003CCCXX_1-sort.bam"))
+        shutil.rmtree(os.path.join(fcdir, "nophix"))
+        self.assertEqual(1, index.update(os.path.join(self.project, "P001_101")))
+        self.assertEqual(5, len(index.by_sample("P001_101")))
+        self.assertListEqual(sorted(filtered_walk(self.project, None, get_dirs=True)), sorted(index.filtered_walk(self.project, None, get_dirs=True)))
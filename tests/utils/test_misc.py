@@ -5,7 +5,7 @@ import logbook
 
 import subprocess 
 
-from scilifelab.utils.misc import walk, filtered_walk, safe_makedir
+from scilifelab.utils.misc import walk, filtered_walk, iter_filtered_walk, safe_makedir
 
 filedir = os.path.abspath(__file__)
 LOG = logbook.Logger(__name__)
@@ -53,3 +53,11 @@ class TestMisc(unittest.TestCase):
         flist = filtered_walk("data", filter_fn=self.filter_fn, include_dirs=["nophix"], exclude_dirs=["fastqc"], get_dirs=False)
         self.assertEqual(set(flist), set(['data/nophix/file1.txt']))
 
+    def test_iter_filtered_walk(self):
+        """Generate the files of a walk lazily, in the order of os.walk, also when walking subdirectories in parallel"""
+        flist = [os.path.join(root, x) for root, dirs, files in os.walk("data") for x in files if self.filter_fn(x)]
+        self.assertListEqual(flist, list(iter_filtered_walk("data", self.filter_fn)))
+        self.assertListEqual(flist, list(iter_filtered_walk("data", self.filter_fn, workers=4)))
+        self.assertListEqual(['data/nophix/file1.txt'], list(iter_filtered_walk("data", self.filter_fn, include_dirs=["nophix"], exclude_dirs=["fastqc"], workers=4)))
+        self.assertListEqual([], list(iter_filtered_walk("data/fastqc", self.filter_fn, exclude_dirs=["fastqc"])))
+        self.assertEqual(len(walk("data")), 12)
@@ -0,0 +1,68 @@
+"""Test the utils/sketch.py functionality
+"""
+import random
+import unittest
+from collections import Counter
+
+from scilifelab.utils.sketch import SpaceSaving
+
+class TestSpaceSaving(unittest.TestCase):
+
+    def setUp(self):
+        # A skewed distribution with a few frequent items and many rare ones
+        self.items = []
+        for i in xrange(10):
+            self.items.extend(["frequent{}".format(i)]*(1000*(i + 1)))
+        self.items.extend(["rare{}".format(random.randint(0,5000)) for i in xrange(20000)])
+        random.shuffle(self.items)
+        self.exact = Counter(self.items)
+
+    def test_exact(self):
+        """Count exactly when the capacity exceeds the number of distinct items
+        """
+        ss = SpaceSaving(capacity=len(self.exact))
+        for i in xrange(0, len(self.items), 7000):
+            ss.update(self.items[i:i+7000])
+        self.assertEqual(dict(self.exact), ss.counts,
+                         "Counts did not match the exact counts")
+        self.assertEqual(len(self.items), ss.total,
+                         "The total number of items did not match")
+
+    def test_bounded(self):
+        """Bound the counts when the capacity is smaller than the number of distinct items
+        """
+        ss = SpaceSaving(capacity=100)
+        for i in xrange(0, len(self.items), 5000):
+            ss.update(self.items[i:i+5000])
+        self.assertLessEqual(len(ss.counts), 100,
+                             "More items than the capacity were tracked")
+        for item, count in self.exact.items():
+            if item in ss.counts:
+                self.assertTrue(ss.guaranteed(item) <= count <= ss.counts[item],
+                                "The true count of {} was outside the bounds".format(item))
+            else:
+                self.assertLessEqual(count, ss.floor,
+                                     "The count of untracked item {} exceeded the floor".format(item))
+        self.assertListEqual([x[0] for x in self.exact.most_common(10)],
+                             [x[0] for x in ss.most_common(10)],
+                             "The most common items did not match")
+
+    def test_merge(self):
+        """Merge counters of separate chunks
+        """
+        counters = []
+        for i in xrange(0, len(self.items), 10000):
+            ss = SpaceSaving(capacity=200)
+            ss.update(self.items[i:i+10000])
+            counters.append(ss)
+        merged = SpaceSaving(capacity=200)
+        for ss in counters:
+            merged.merge(ss)
+        self.assertEqual(len(self.items), merged.total,
+                         "The total number of items did not match")
+        for item, count in merged.most_common(10):
+            self.assertTrue(merged.guaranteed(item) <= self.exact[item] <= count,
+                            "The true count of {} was outside the bounds".format(item))
+        self.assertListEqual([x[0] for x in self.exact.most_common(10)],
+                             [x[0] for x in merged.most_common(10)],
+                             "The most common items did not match")